@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from completion_index import prompt_hash, set_journal_mode
+
+DEFAULT_STORE_PATH = "answer_store.sqlite"
+
+# ==========================
+#   Content-addressed answers
+# ==========================
+# The completion index says which questions of a directory are done; the answer store
+# keeps the answers themselves, keyed by what was actually asked: model, prompt template
+# and hash of system prompt + question. Re-running a generated experiment (another
+# session, another machine, after an analysis fix) then only queries the model for the
+# prompts it has never seen. The first answer stored for a key is the one reused.
+
+COLUMNS = ("model", "template", "prompt_hash", "question", "answer", "prompt_tokens", "generated_tokens",
+           "stop_reason", "params", "created_at")
+
+
+class AnswerStore:
+    """
+    SQLite file of answers keyed by (model, template, prompt hash). `params` holds the
+    sampler settings the answer was generated with (JSON), for reference only.
+    Same journal modes as CompletionIndex: "DELETE" when shared between nodes.
+    """
+
+    def __init__(self, path=None, journal_mode: str = "WAL"):
+        self.path = str(path or os.getenv("REACHABILITY_ANSWER_STORE", DEFAULT_STORE_PATH))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.n_hits = 0
+        self.n_stored = 0
+        try:
+            set_journal_mode(self.conn, journal_mode)
+        except RuntimeError:
+            self.conn.close()
+            raise
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " model TEXT, template TEXT, prompt_hash TEXT, question TEXT, answer TEXT,"
+                " prompt_tokens INTEGER, generated_tokens INTEGER, stop_reason TEXT, params TEXT, created_at REAL,"
+                " PRIMARY KEY (model, template, prompt_hash))"
+            )
+
+    def get(self, model: str, system_prompt: str, question: str, template: str = "user_assistant"):
+        """Stored record (dict of COLUMNS) of this exact prompt, None if it was never answered."""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM answers WHERE model=? AND template=? AND prompt_hash=?",
+                (model, template, prompt_hash(system_prompt, question))
+            ).fetchone()
+        return None if row is None else dict(zip(COLUMNS, row))
+
+    def lookup(self, model: str, system_prompt: str, questions, template: str = "user_assistant") -> dict:
+        """Stored records of the (seq_id, distances, question) tuples, by seq_id."""
+        hashes = {q[0]: prompt_hash(system_prompt, q[-1]) for q in questions}
+        rows = {}
+        unique = sorted(set(hashes.values()))
+        with self.lock:
+            # Chunked, SQLite limits the number of ? of a statement
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                for row in self.conn.execute(
+                        f"SELECT {', '.join(COLUMNS)} FROM answers WHERE model=? AND template=? "
+                        f"AND prompt_hash IN ({', '.join('?' * len(chunk))})", (model, template, *chunk)):
+                    record = dict(zip(COLUMNS, row))
+                    rows[record["prompt_hash"]] = record
+        return {seq_id: rows[h] for seq_id, h in hashes.items() if h in rows}
+
+    def put_many(self, records: list):
+        """Insert records (dicts of COLUMNS), keys already stored are left as they are."""
+        rows = [tuple(r.get(c) for c in COLUMNS) for r in records]
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(f"INSERT OR IGNORE INTO answers VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+            inserted = self.conn.total_changes - before
+        self.n_stored += inserted
+        return inserted
+
+    def serve(self, results, model: str, system_prompt: str, questions, template: str = "user_assistant") -> list:
+        """
+        Write the stored answers of questions through `results` (a ResultWriter) and
+        return the (seq_id, distances, question) tuples the model still has to answer.
+        """
+        found = self.lookup(model, system_prompt, questions, template)
+        for seq_id, distances, question in questions:
+            if seq_id in found:
+                results.put(seq_id, distances, question, found[seq_id]["answer"])
+        self.n_hits += len(found)
+        if found:
+            print(f"Answer store: {len(found)} of {len(questions)} questions reused for {model}")
+        return [q for q in questions if q[0] not in found]
+
+    def filler(self, model: str, system_prompt: str, template: str = "user_assistant"):
+        """
+        ResultWriter on_written callback storing the answers written with metadata
+        (results.put(..., generated_tokens=..., params=...)), answers served from the store have none.
+        """
+        def fill(records):
+            self.put_many([{
+                "model": model, "template": template,
+                "prompt_hash": prompt_hash(system_prompt, r["question"]),
+                "question": r["question"], "answer": r["answer"],
+                "prompt_tokens": r["meta"].get("prompt_tokens"),
+                "generated_tokens": r["meta"].get("generated_tokens"),
+                "stop_reason": r["meta"].get("stop_reason"),
+                "params": json.dumps(r["meta"].get("params"), sort_keys=True),
+                "created_at": time.time(),
+            } for r in records if r.get("meta") is not None])
+        return fill
+
+    # ==========================
+    #     Export / import
+    # ==========================
+    def export_jsonl(self, path, model: str = None) -> int:
+        """Write the records (of one model, or all) as JSON lines, returns their number."""
+        query = f"SELECT {', '.join(COLUMNS)} FROM answers"
+        with self.lock:
+            rows = self.conn.execute(query + " WHERE model=?", (model,)).fetchall() if model \
+                else self.conn.execute(query).fetchall()
+        with open(path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n")
+        return len(rows)
+
+    def import_jsonl(self, path) -> int:
+        """Merge an exported file, returns the number of new answers."""
+        with open(path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return self.put_many(records)
+
+    def stats(self) -> list:
+        """(model, template, number of answers) rows."""
+        with self.lock:
+            return self.conn.execute("SELECT model, template, COUNT(*) FROM answers GROUP BY model, template "
+                                     "ORDER BY model, template").fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def load_store(path=None, journal_mode: str = "WAL"):
+    """Store given by path or $REACHABILITY_ANSWER_STORE, None if unset (answers are not reused by default)."""
+    path = path or os.getenv("REACHABILITY_ANSWER_STORE")
+    return AnswerStore(path, journal_mode) if path else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / import the answer store, e.g. between the cluster and a laptop")
+    parser.add_argument("--store", default=None, help="store file (default: $REACHABILITY_ANSWER_STORE or answer_store.sqlite)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_cmd = commands.add_parser("export", help="write the answers to a JSONL file")
+    export_cmd.add_argument("path")
+    export_cmd.add_argument("--model", default=None, help="only the answers of this model")
+    import_cmd = commands.add_parser("import", help="merge JSONL files written by export")
+    import_cmd.add_argument("paths", nargs="+")
+    commands.add_parser("stats", help="number of answers per model and template")
+    args = parser.parse_args()
+
+    store = AnswerStore(args.store)
+    if args.command == "export":
+        print(f"✅ {store.export_jsonl(args.path, args.model)} answers exported to {args.path}")
+    elif args.command == "import":
+        for path in args.paths:
+            print(f"✅ {store.import_jsonl(path)} new answers from {path}")
+    else:
+        for model, template, count in store.stats():
+            print(f"{model}\t{template}\t{count}")
+    store.close()
@@ -0,0 +1,535 @@
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import queue
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from answer_store import load_store
+from completion_index import CompletionIndex
+from experiment_files import find_experiment_dirs, parse_questions, read_text
+from experiment_scheduler import SERVER_TEMPLATE, answer_meta, parse_model
+from llama_server_client import make_transport, run_bounded, stream_completion, wait_for_server_async
+from predict_budget import approx_token_count, load_budget
+from result_writer import ResultWriter, append_stop_word, chain_written, mark_in_index
+from run_experiment_chat import CHAT_STOP, CHAT_TEMPLATE, chat_prompt
+from stop_matcher import FINAL_ANSWER_PATTERN, generate_until_answer
+from telemetry import TelemetryWriter, record_from_server_result
+
+# ==========================
+#   Inference backends
+# ==========================
+# Every way the runners have of getting answers (llama_cpp in-process, llama-server,
+# the reachability_bench C++ binary, llama-cli) behind one interface, plus an offline
+# backend answering from chains.txt so that scheduling, I/O and analysis can be run
+# and profiled without a model.
+#
+# A result is a dict shaped like the one of llama_server_client.stream_completion:
+# content (the whole answer, final YES/NO included), stopping_word, stop_reason,
+# timings (prompt_n, cache_n, prompt_ms, predicted_n, predicted_ms), n_tokens,
+# time_to_first_token, total_time and id_slot.
+
+def make_result(content="", stop_reason="eos", prompt_n=None, cache_n=None, prompt_ms=None,
+                predicted_n=0, predicted_ms=None, time_to_first_token=None, total_time=None, id_slot=None) -> dict:
+    timings = {"prompt_n": prompt_n, "cache_n": cache_n, "prompt_ms": prompt_ms,
+               "predicted_n": predicted_n, "predicted_ms": predicted_ms}
+    return {"content": content, "stopping_word": "", "stop_reason": stop_reason,
+            "timings": {k: v for k, v in timings.items() if v is not None}, "n_tokens": predicted_n,
+            "time_to_first_token": time_to_first_token, "total_time": total_time, "id_slot": id_slot}
+
+
+class Backend:
+    """
+    `open_experiment` is called once per experiment directory (system prompt evaluation,
+    warm-up, ...), then `complete_batch` answers (seq_id, distances, question) tuples.
+    """
+
+    name = "backend"
+    template = None  # answer store template (prompt layout), the name when None
+    n_ctx = None
+
+    def open_experiment(self, exp_dir, system_prompt: str):
+        self.exp_dir = pathlib.Path(exp_dir)
+        self.system_prompt = system_prompt
+
+    def complete(self, item, n_predict: int = 256, on_token=None) -> dict:
+        raise NotImplementedError
+
+    def complete_batch(self, questions: list, n_predict=256, on_token=None, on_result=None) -> list[dict]:
+        """
+        Answer the questions, returns the results of the answered ones in the same order.
+        A question that fails (connection, process exit, no answer) is reported and skipped,
+        on_result is not called for it so that it stays pending.
+
+        Args:
+            n_predict: int, or callable(distances) -> int (see predict_budget)
+            on_token: optional callable(seq_id, piece), called as the text is generated
+            on_result: optional callable(item, result), called as soon as an answer is complete
+        """
+        results = []
+        for item in questions:
+            try:
+                result = self.complete(item, _n_predict(n_predict, item), _bind(on_token, item))
+            except (OSError, ValueError) as e:
+                print(f"[Q{item[0]}] ❌ Error:", e)
+                continue
+            if on_result is not None:
+                on_result(item, result)
+            results.append(result)
+        return results
+
+    def close(self):
+        pass
+
+
+def _n_predict(n_predict, item) -> int:
+    return n_predict(item[1]) if callable(n_predict) else n_predict
+
+
+def _bind(on_token, item):
+    return None if on_token is None else (lambda piece: on_token(item[0], piece))
+
+# ==========================
+#   llama_cpp (in-process)
+# ==========================
+class LlamaCppBackend(Backend):
+    """llama_cpp.Llama, the system prompt KV state is saved once and restored for each question."""
+
+    name = "llama_cpp"
+    template = "user_assistant"
+
+    def __init__(self, model_path: str, n_ctx: int = 2048, n_threads: int = 8):
+        from llama_cpp import Llama  # optional, only needed for this backend
+        self.n_ctx = n_ctx
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+
+    def open_experiment(self, exp_dir, system_prompt: str):
+        super().open_experiment(exp_dir, system_prompt)
+        # Same prompt layout as reachability_bench.py, split on a token boundary
+        self.prefix_tokens = self.llm.tokenize(f"{system_prompt}\nUser:".encode("utf-8"), add_bos=True)
+        self.llm.reset()
+        self.llm.eval(self.prefix_tokens)
+        self.prefix_state = self.llm.save_state()
+
+    def complete(self, item, n_predict: int = 256, on_token=None) -> dict:
+        _, _, question = item
+        self.llm.load_state(self.prefix_state)
+        tokens = self.llm.tokenize(f" {question}\nAssistant:".encode("utf-8"), add_bos=False, special=False)
+        start = time.perf_counter()
+        stats = {}
+        text, stop_reason, n_tokens = generate_until_answer(self.llm, self.prefix_tokens + tokens, max_tokens=n_predict,
+                                                            stop=["User:"], stats=stats, on_token=on_token)
+        total_time = time.perf_counter() - start
+        ttft = stats.get("time_to_first_token")
+        return make_result(text.strip(), stop_reason, len(tokens), len(self.prefix_tokens),
+                           ttft * 1000 if ttft is not None else None, n_tokens,
+                           (total_time - ttft) * 1000 if ttft is not None else None, ttft, total_time)
+
+# ==========================
+#   llama-server (HTTP)
+# ==========================
+class LlamaServerBackend(Backend):
+    """An already running llama-server, n_parallel streamed requests in flight."""
+
+    name = "llama_server"
+    template = SERVER_TEMPLATE
+
+    def __init__(self, base_url: str = "http://localhost:8080", n_parallel: int = 2, transport: str = "auto",
+                 payload: dict = None, n_ctx: int = None):
+        self.base_url = base_url
+        self.n_parallel = n_parallel
+        self.transport_kind = transport
+        self.payload = payload or {}
+        self.n_ctx = n_ctx
+
+    def complete(self, item, n_predict: int = 256, on_token=None) -> dict:
+        results = self.complete_batch([item], n_predict, None if on_token is None else (lambda _, p: on_token(p)))
+        if not results:
+            raise ConnectionError(f"llama-server did not answer question {item[0]}")
+        return results[0]
+
+    def complete_batch(self, questions: list, n_predict=256, on_token=None, on_result=None) -> list[dict]:
+        results = {}
+
+        async def run():
+            # The transport belongs to the event loop of this batch
+            transport = make_transport(self.base_url, self.transport_kind)
+            try:
+                await wait_for_server_async(transport)
+
+                async def handle(item):
+                    payload = dict(self.payload, prompt=f"{self.system_prompt}\n{item[2]}",
+                                   n_predict=_n_predict(n_predict, item), cache_prompt=True)
+                    payload.setdefault("stop", ["User:", "YES", "NO"])
+                    try:
+                        start = time.perf_counter()
+                        result = await stream_completion(transport, payload, on_token=_bind(on_token, item))
+                    except (OSError, ValueError) as e:
+                        print(f"[Q{item[0]}] ❌ Error:", e)
+                        return
+                    result["total_time"] = time.perf_counter() - start
+                    result["content"] = append_stop_word(result["content"].strip(), result["stopping_word"])
+                    results[item[0]] = result
+                    if on_result is not None:
+                        on_result(item, result)
+
+                await run_bounded(questions, handle, self.n_parallel)
+            finally:
+                await transport.close()
+
+        asyncio.run(run())
+        return [results[item[0]] for item in questions if item[0] in results]
+
+# ==========================
+#   reachability_bench (C++)
+# ==========================
+class CppBinaryBackend(Backend):
+    """
+    The reachability_bench binary run on a scratch copy of the experiment: the questions
+    not asked are listed in completed_seq_ids.txt, answers and timings are read back from
+    results.txt and telemetry.jsonl. Tokens are only reported once the binary is done.
+    """
+
+    name = "reachability_bench_cpp"
+
+    def __init__(self, binary: str = "reachability_bench", model_path: str = None, args=None):
+        self.binary = binary
+        self.model_path = model_path
+        self.args = list(args) if args is not None else ["-ns", "60", "-np", "42", "-b", "100000", "-c", "100000"]
+        self.output_dir = "output-" + pathlib.Path(model_path).stem
+
+    def complete(self, item, n_predict: int = 256, on_token=None) -> dict:
+        results = self.complete_batch([item], n_predict, None if on_token is None else (lambda _, p: on_token(p)))
+        if not results:
+            raise ChildProcessError(f"{self.binary} did not answer question {item[0]}")
+        return results[0]
+
+    def complete_batch(self, questions: list, n_predict=256, on_token=None, on_result=None) -> list[dict]:
+        work_dir = pathlib.Path(tempfile.mkdtemp(prefix="reachability_bench_"))
+        try:
+            (work_dir / "system.txt").write_text(self.system_prompt, encoding="utf-8")
+            # Line numbers are the seq_ids, the lines of the questions not in this batch are skipped
+            lines = {seq_id: "\t".join([distances[0], question] + list(distances[1:]))
+                     for seq_id, distances, question in questions}
+            n_lines = max(lines) + 1 if lines else 0
+            (work_dir / "reachability_questions.txt").write_text(
+                "\n".join(lines.get(i, "0\t") for i in range(n_lines)) + "\n", encoding="utf-8")
+            output = work_dir / self.output_dir
+            output.mkdir()
+            (output / "completed_seq_ids.txt").write_text(
+                "".join(f"{i}\n" for i in range(n_lines) if i not in lines), encoding="utf-8")
+            budgets = {item[0]: _n_predict(n_predict, item) for item in questions}
+            (output / "n_predict.txt").write_text(
+                "".join(f"{budgets.get(i, -1)}\n" for i in range(n_lines)), encoding="utf-8")
+
+            env = dict(os.environ, LLAMA_WORK_DIR=str(work_dir))
+            # Answers are written one by one, those of a crashed run are still good
+            process = subprocess.run([self.binary, "-m", self.model_path] + self.args, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if process.returncode != 0:
+                print(f"⚠️ {self.binary} exited with code {process.returncode}")
+
+            answers = {}
+            content = read_text(output / "results.txt") if (output / "results.txt").exists() else ""
+            for m in re.finditer(r'^\[Q\s*(\d+)\][^\n]*\nQuestion:[^\n]*\nAnswer:(.*?)(?=^\[Q\s*\d+\]|\Z)', content,
+                                 re.MULTILINE | re.DOTALL):
+                answers[int(m.group(1))] = m.group(2).strip()
+            telemetry = {}
+            if (output / "telemetry.jsonl").exists():
+                for line in read_text(output / "telemetry.jsonl").splitlines():
+                    record = json.loads(line)
+                    telemetry[record["seq_id"]] = record
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        results = []
+        for item in questions:
+            if not answers.get(item[0]):
+                print(f"[Q{item[0]}] ❌ Error: no answer from {self.binary}")
+                continue
+            t = telemetry.get(item[0], {})
+            ttft, total = t.get("time_to_first_token"), t.get("total_time")
+            result = make_result(answers[item[0]], t.get("stop_reason", "eos"), t.get("prompt_tokens"),
+                                 t.get("cached_tokens"), ttft * 1000 if ttft is not None else None,
+                                 t.get("generated_tokens", 0),
+                                 (total - ttft) * 1000 if total is not None and ttft is not None else None,
+                                 ttft, total, t.get("slot_id"))
+            if on_token is not None:
+                on_token(item[0], result["content"])
+            if on_result is not None:
+                on_result(item, result)
+            results.append(result)
+        return results
+
+# ==========================
+#   llama-cli
+# ==========================
+class LlamaCliBackend(Backend):
+    """One llama-cli process per question with the chat template, as run_experiment-win.py does."""
+
+    name = "llama_cli"
+    template = CHAT_TEMPLATE
+    PERF_PATTERNS = {
+        "prompt": re.compile(r"prompt eval time\s*=\s*([\d.]+)\s*ms\s*/\s*(\d+)"),
+        "eval": re.compile(r"\beval time\s*=\s*([\d.]+)\s*ms\s*/\s*(\d+)"),
+    }
+
+    def __init__(self, cli: str = "llama-cli", model_path: str = None, n_ctx: int = 32768, gpu_layers: int = 32):
+        self.cli = cli
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.gpu_layers = gpu_layers
+
+    def complete(self, item, n_predict: int = 512, on_token=None) -> dict:
+        command = [self.cli, "-c", str(self.n_ctx), "-m", self.model_path, "-ngl", str(self.gpu_layers),
+                   "--n-predict", str(n_predict), "--prompt", chat_prompt(self.system_prompt, item[2]),
+                   "-no-cnv", "--no-display-prompt"]
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   encoding="utf-8", errors="replace")
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.extend(process.stderr))
+        reader.start()
+        text, ttft = "", None
+        for piece in iter(lambda: process.stdout.read(64), ""):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            text += piece
+            if on_token is not None:
+                on_token(piece)
+        process.wait()
+        reader.join()
+        total_time = time.perf_counter() - start
+        if process.returncode != 0:
+            raise ChildProcessError(f"{self.cli} exited with code {process.returncode}: {''.join(stderr[-3:]).strip()}")
+
+        perf = {}
+        for key, pattern in self.PERF_PATTERNS.items():
+            m = pattern.search("".join(stderr))
+            if m:
+                perf[key] = (float(m.group(1)), int(m.group(2)))
+        prompt_ms, prompt_n = perf.get("prompt", (None, None))
+        predicted_ms, predicted_n = perf.get("eval", (None, 0))
+        answer = text.split(CHAT_STOP[0])[0].strip()
+        stop_reason = "answer" if FINAL_ANSWER_PATTERN.search(answer) else "eos"
+        return make_result(answer, stop_reason, prompt_n, 0, prompt_ms, predicted_n, predicted_ms, ttft, total_time)
+
+# ==========================
+#   Offline stand-in
+# ==========================
+class OfflineBackend(Backend):
+    """
+    Deterministic backend for CPU-only runs: answers are step-by-step walks along the
+    chain of chains.txt ending with the ground truth "FINAL ANSWER: YES/NO" (the sign of
+    the distance), and prompt processing / decoding costs are simulated per slot, the
+    system prompt being processed on the first request of every slot only.
+
+    Args:
+        prompt_tps, decode_tps: simulated speeds in tokens per second
+        n_parallel: number of simulated slots (worker threads)
+        time_scale: 0 to skip the sleeps (timings are still reported), 1 for real time
+        accuracy: share of correct answers, the wrong ones being drawn from `seed`
+    """
+
+    name = "offline"
+
+    def __init__(self, prompt_tps=1000.0, decode_tps=50.0, n_parallel=1, time_scale=1.0, accuracy=1.0, seed=0,
+                 n_ctx=4096):
+        self.prompt_tps = prompt_tps
+        self.decode_tps = decode_tps
+        self.n_parallel = n_parallel
+        self.time_scale = time_scale
+        self.accuracy = accuracy
+        self.seed = seed
+        self.n_ctx = n_ctx
+
+    def open_experiment(self, exp_dir, system_prompt: str):
+        super().open_experiment(exp_dir, system_prompt)
+        chains_path = self.exp_dir / "chains.txt"
+        self.chains = read_text(chains_path).splitlines() if chains_path.exists() else []
+        self.n_system_tokens = approx_token_count(system_prompt)
+        self.warm_slots = set()
+
+    def answer_text(self, item) -> str:
+        seq_id, distances, question = item
+        reachable = float(distances[0]) > 0
+        rng = random.Random(f"{self.seed}:{self.exp_dir.name}:{seq_id}")
+        answer = reachable if rng.random() < self.accuracy else not reachable
+
+        names = re.findall(r"`([^`.]+)\.?`", question)
+        source, target = (names + ["?", "?"])[:2]
+        chain = self.chains[seq_id].split("\t")[0].split() if seq_id < len(self.chains) else [source]
+        steps = ["Let's think step by step."]
+        steps += [f"`{a}` calls `{b}`." for a, b in zip(chain, chain[1:])]
+        if answer:
+            steps.append(f"So `{source}` calls `{target}` indirectly.")
+        else:
+            steps.append(f"`{chain[-1]}` does not call any other method, so `{target}` is never reached from `{source}`.")
+        steps.append(f"FINAL ANSWER: {'YES' if answer else 'NO'}")
+        return "\n".join(steps)
+
+    def _sleep(self, seconds: float):
+        if self.time_scale > 0 and seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def complete(self, item, n_predict: int = 256, on_token=None, id_slot: int = 0) -> dict:
+        pieces = re.findall(r"\S+\s*", self.answer_text(item))
+        stop_reason = "answer"
+        if len(pieces) > n_predict:
+            pieces, stop_reason = pieces[:n_predict], "length"
+
+        cache_n = self.n_system_tokens if id_slot in self.warm_slots else 0
+        prompt_n = approx_token_count(item[2]) + self.n_system_tokens - cache_n
+        self.warm_slots.add(id_slot)
+        prompt_ms = prompt_n / self.prompt_tps * 1000
+        start = time.perf_counter()
+        self._sleep(prompt_ms / 1000)
+        for piece in pieces:
+            self._sleep(1 / self.decode_tps)
+            if on_token is not None:
+                on_token(piece)
+        predicted_ms = len(pieces) / self.decode_tps * 1000
+        ttft = (prompt_ms + 1000 / self.decode_tps) / 1000
+        return make_result("".join(pieces).strip(), stop_reason, prompt_n, cache_n, prompt_ms, len(pieces),
+                           predicted_ms, ttft, (prompt_ms + predicted_ms) / 1000, id_slot)
+
+    def complete_batch(self, questions: list, n_predict=256, on_token=None, on_result=None) -> list[dict]:
+        pending = queue.Queue()
+        for i, item in enumerate(questions):
+            pending.put((i, item))
+        results = [None] * len(questions)
+        lock = threading.Lock()
+
+        def slot_worker(id_slot):
+            while True:
+                try:
+                    i, item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[i] = self.complete(item, _n_predict(n_predict, item), _bind(on_token, item), id_slot)
+                except (OSError, ValueError) as e:
+                    print(f"[Q{item[0]}] ❌ Error:", e)
+                    continue
+                if on_result is not None:
+                    with lock:
+                        on_result(item, results[i])
+
+        workers = [threading.Thread(target=slot_worker, args=(s,)) for s in range(max(1, self.n_parallel))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return [r for r in results if r is not None]
+
+
+def make_backend(kind: str, model_path: str = None, **options) -> Backend:
+    """'offline', 'llama_cpp', 'llama_server', 'cpp' or 'llama_cli'."""
+    if kind == "offline":
+        return OfflineBackend(**options)
+    if kind == "llama_cpp":
+        return LlamaCppBackend(model_path, **options)
+    if kind == "llama_server":
+        return LlamaServerBackend(**options)
+    if kind == "cpp":
+        return CppBinaryBackend(model_path=model_path, **options)
+    if kind == "llama_cli":
+        return LlamaCliBackend(model_path=model_path, **options)
+    raise ValueError(f"Unknown backend: {kind}")
+
+# ==========================
+#       Runner
+# ==========================
+def run_directory(backend: Backend, exp_dir: pathlib.Path, model_name: str, n_predict=256,
+                  index: CompletionIndex = None, store=None, seq_ids=None, lock_writes=False, answered: set = None) -> int:
+    """
+    Answer the pending questions of exp_dir with any backend, same outputs as the other runners.
+    seq_ids restricts the run to some questions (a work_queue lease); lock_writes is for
+    several processes writing to the same output directory. The seq_ids whose answers are
+    on disk (written by this run, or already in the index) are added to `answered`.
+    """
+    system_prompt = read_text(exp_dir / "system.txt")
+    questions = parse_questions(read_text(exp_dir / "reachability_questions.txt"))
+    if seq_ids is not None:
+        seq_ids = set(seq_ids)
+        questions = [q for q in questions if q[0] in seq_ids]
+    output_dir = exp_dir / model_name
+    if index is not None:
+        index.ingest_results_file(exp_dir, model_name, output_dir / "results.txt", system_prompt,
+                                  [(seq_id, q) for seq_id, _, q in questions])
+        pending = index.pending(exp_dir, model_name, system_prompt, questions)
+        if answered is not None:
+            answered.update(set(q[0] for q in questions) - set(q[0] for q in pending))
+        questions = pending
+    if not questions:
+        return 0
+
+    template = backend.template or backend.name
+    telemetry = TelemetryWriter(output_dir / "telemetry.jsonl")
+    queued_at = time.perf_counter()
+    on_written = chain_written(mark_in_index(index, exp_dir, model_name, system_prompt),
+                               store and store.filler(model_name, system_prompt, template),
+                               None if answered is None else (lambda records: answered.update(r["seq_id"] for r in records)))
+    with ResultWriter(output_dir, on_written=on_written, lock=lock_writes) as results:
+        if store is not None:
+            questions = store.serve(results, model_name, system_prompt, questions, template)
+
+        def on_result(item, result):
+            seq_id, distances, question = item
+            results.put(seq_id, distances, question, result["content"],
+                        **answer_meta(result, {"n_predict": _n_predict(n_predict, item), "backend": backend.name}))
+            total_time = result["total_time"]
+            telemetry.write(record_from_server_result(
+                result, max(0.0, time.perf_counter() - queued_at - (total_time or 0)), total_time, runner=f"backend_{backend.name}",
+                model=model_name, exp_dir=str(exp_dir), ctx_size=backend.n_ctx, seq_id=seq_id, distances=distances))
+
+        if questions:
+            backend.open_experiment(exp_dir, system_prompt)
+            backend.complete_batch(questions, n_predict, on_result=on_result)
+    telemetry.close()
+    return len(questions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the experiment directories through one of the inference backends")
+    parser.add_argument("roots", nargs="+", help="experiment root directories")
+    parser.add_argument("--backend", default="offline", choices=["offline", "llama_cpp", "llama_server", "cpp", "llama_cli"])
+    parser.add_argument("--model", default=None, help="model.gguf[:output-name] (output name 'offline' for the offline backend)")
+    parser.add_argument("--parallel", type=int, default=2, help="requests in flight (llama_server) or simulated slots (offline)")
+    parser.add_argument("--n-predict", type=int, default=256)
+    parser.add_argument("--budget", default=None, help="per-question n_predict model fitted by predict_budget.py ('default' for the unfitted one)")
+    parser.add_argument("--url", default="http://localhost:8080", help="llama-server url")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="offline: 0 to skip the simulated delays")
+    parser.add_argument("--accuracy", type=float, default=1.0, help="offline: share of correct answers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--index", default=None, help="completion index file (default: $REACHABILITY_INDEX or completion_index.sqlite)")
+    parser.add_argument("--answer-store", default=None,
+                        help="reuse and record answers in this store (default: $REACHABILITY_ANSWER_STORE, unset: off)")
+    args = parser.parse_args()
+
+    model_path, model_name = parse_model(args.model) if args.model else (None, "offline")
+    if args.backend == "offline":
+        backend = OfflineBackend(n_parallel=args.parallel, time_scale=args.time_scale, accuracy=args.accuracy, seed=args.seed)
+    elif args.backend == "llama_server":
+        backend = LlamaServerBackend(args.url, args.parallel)
+    else:
+        backend = make_backend(args.backend, model_path)
+    budget = load_budget(args.budget)
+    index = CompletionIndex(args.index)
+    store = load_store(args.answer_store)
+
+    start_all = time.time()
+    dirs = [d for root in args.roots for d in find_experiment_dirs(root)]
+    for d in dirs:
+        start = time.time()
+        n_questions = run_directory(backend, d, model_name, budget or args.n_predict, index, store)
+        print(f"[{model_name}] {d}: {n_questions} questions in {time.time() - start:.2f}s")
+    backend.close()
+    print(f"[{model_name}] {len(dirs)} directories in {time.time() - start_all:.2f}s")
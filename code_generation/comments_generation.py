@@ -1,5 +1,7 @@
 import random
 
+import emitters
+
 # Basic Latin-inspired words and syllables
 lorem_words = [
     "lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing",
@@ -22,6 +24,10 @@ lorem_words = [
 
 def generate_lorem_ipsum_comments(num_lines, language="java"):
     """Generate Lorem Ipsum comments in the specified language's comment style"""
+    return "\n".join(lorem_ipsum_comment_lines(num_lines, language))
+
+def lorem_ipsum_comment_lines(num_lines, language="java"):
+    """Lines of generate_lorem_ipsum_comments"""
     comments = []
     
     # Define comment styles for different languages
@@ -55,72 +61,13 @@ def generate_lorem_ipsum_comments(num_lines, language="java"):
         lorem_comment = f"{comment_prefix} {' '.join(sentence).capitalize()}."
         comments.append(lorem_comment)
     
-    return "\n".join(comments)
+    return comments
 
 def generate_chained_method_calls_with_comments(method_names, lines=20, language="java"):
     """Generate chained method calls with comments for the specified language"""
-    method_bodies = []
-    
-    # Loop through the list of method names
-    for i, method in enumerate(method_names):
-        # Generate comments for this method
-        comment = generate_lorem_ipsum_comments(lines, language)
-        
-        # Generate the method body based on language
-        if language.lower() in ["java"]:
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    public void {method}() {{\n        {next_method}();\n    }}"
-            else:
-                method_body = f"    public void {method}() {{\n        // End of chain\n    }}"
-        
-        elif language.lower() in ["cpp", "c++"]:
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    void {method}() {{\n        {next_method}();\n    }}"
-            else:
-                method_body = f"    void {method}() {{\n        // End of chain\n    }}"
-        
-        elif language.lower() in ["fortran", "f90"]:
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    subroutine {method}()\n        call {next_method}()\n    end subroutine {method}"
-            else:
-                method_body = f"    subroutine {method}()\n        ! End of chain\n    end subroutine {method}"
-        
-        elif language.lower() in ["pascal", "pas"]:
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    procedure {method};\n    begin\n        {next_method};\n    end;"
-            else:
-                method_body = f"    procedure {method};\n    begin\n        // End of chain\n    end;"
-        
-        elif language.lower() in ["ruby", "rb"]:
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"  def {method}\n    {next_method}\n  end"
-            else:
-                method_body = f"  def {method}\n    # End of chain\n  end"
-        
-        elif language.lower() == "php":
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    public function {method}() {{\n        $this->{next_method}();\n    }}"
-            else:
-                method_body = f"    public function {method}() {{\n        // End of chain\n    }}"
-        
-        else:
-            # Default to Java-style for unknown languages
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    public void {method}() {{\n        {next_method}();\n    }}"
-            else:
-                method_body = f"    public void {method}() {{\n        // End of chain\n    }}"
-        
-        # Combine comment and method body
-        method_bodies.append(f"{comment}\n{method_body}")
-    
-    return method_bodies
+    # Default to Java-style for unknown languages
+    template = emitters.TEMPLATES.get(language.lower(), emitters.TEMPLATES["java"])
+    return emitters.render_chain_methods(template, method_names, lines)
 
 # Backward compatibility - keep the original function name
 def generate_chained_method_calls(method_names, lines=20):
@@ -419,6 +419,17 @@ def generate_method_body(
     n_loops: int = 0, 
     n_if: int = 0
     ) -> str:
+    """Generate a method body with simple control flow, declarations, and method calls (see method_body_lines)."""
+    return "\n".join(method_body_lines(next_methods, vars, all_vars, return_var, n_loops, n_if))
+
+def method_body_lines(
+    next_methods: list[str] = [],
+    vars: list[Variable] = [], 
+    all_vars: list[Variable] = [],
+    return_var: Variable = None,
+    n_loops: int = 0, 
+    n_if: int = 0
+    ) -> list[str]:
     """Generate a method body with simple control flow, declarations, and method calls.
     
     Args: 
@@ -430,7 +441,7 @@ def generate_method_body(
         n_if (int): number of if statements to include
         
     Returns: 
-        str: Java method body with variable declarations, conditions, and method calls
+        list[str]: lines of the Java method body with variable declarations, conditions, and method calls
     """
     body = []
     variables = all_vars
@@ -543,7 +554,8 @@ def generate_method_body(
     if return_var:
         body.append(f"\treturn {return_var.name};") 
     
-    return "\n".join(body)
+    # Blocks (ifs, loops) span several lines
+    return [line for block in body for line in block.split("\n")]
 
 def generate_method_bodies(method_names: list) -> list:
     """Generate random method bodies for a list of method names.
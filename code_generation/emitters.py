@@ -0,0 +1,267 @@
+import argparse
+from contextlib import contextmanager
+import random
+from time import perf_counter
+
+import comments_generation
+
+# ==========================
+#   Source buffers
+# ==========================
+# Generated classes are written line by line into one buffer, indentation is a prefix
+# tracked by the writer (with writer.indented(): ...) instead of re-indenting finished
+# strings with replace("\n", "\n\t"). Each line is copied once, when the buffer is joined,
+# so the time to emit a context is linear in its size, whatever the padding or comments.
+
+class SourceWriter:
+    """List of source lines under construction, with the current indentation."""
+
+    def __init__(self, indent_unit: str = "\t"):
+        self.lines = []
+        self.indent_unit = indent_unit
+        self.prefix = ""
+
+    @contextmanager
+    def indented(self, unit: str = None):
+        """Indent the lines written in the block by one level (or by unit)."""
+        prefix = self.prefix
+        self.prefix += self.indent_unit if unit is None else unit
+        try:
+            yield self
+        finally:
+            self.prefix = prefix
+
+    def line(self, text: str = ""):
+        self.lines.append(self.prefix + text)
+
+    def extend(self, lines: list[str]):
+        """Write lines at the current indentation."""
+        prefix = self.prefix
+        self.lines.extend([prefix + line for line in lines])
+
+    def block(self, text: str):
+        """Write a multi-line string at the current indentation."""
+        self.extend(text.split("\n"))
+
+    def getvalue(self) -> str:
+        return "\n".join(self.lines)
+
+
+# ==========================
+#   Language templates
+# ==========================
+
+def compile_template(text: str) -> tuple:
+    """Split a template into the format functions of its lines, once."""
+    return tuple(line.format for line in text.split("\n"))
+
+
+def render(template: tuple, **fields) -> list[str]:
+    """Lines of a compiled template."""
+    return [line(**fields) for line in template]
+
+
+class LanguageTemplate:
+    """
+    Source templates of one language, method templates are relative to the class body
+    (indented by `indent`), class templates are the text before and after the methods.
+
+    Args:
+        call: method calling {next_method}
+        end: last method of a chain
+        header, footer: text before / after the methods of a class ({class_name})
+        declaration: line declaring a method in the header (Pascal), None when not needed
+    """
+
+    def __init__(self, name: str, indent: str, call: str, end: str, header: str, footer: str,
+                 declaration: str = None, declarations_end: str = None):
+        self.name = name
+        self.indent = indent
+        self.call = compile_template(call)
+        self.end = compile_template(end)
+        self.header = compile_template(header)
+        self.footer = compile_template(footer)
+        self.declaration = compile_template(declaration) if declaration else None
+        self.declarations_end = compile_template(declarations_end) if declarations_end else None
+
+
+TEMPLATES = {
+    "java": LanguageTemplate(
+        "java", "    ",
+        call="public void {method}() {{\n    {next_method}();\n}}",
+        end="public void {method}() {{\n    // End of chain\n}}",
+        header="public class {class_name} {{",
+        footer="}}"),
+    "cpp": LanguageTemplate(
+        "cpp", "    ",
+        call="void {method}() {{\n    {next_method}();\n}}",
+        end="void {method}() {{\n    // End of chain\n}}",
+        header="#include <iostream>\n\nclass {class_name} {{\npublic:",
+        footer="}};"),
+    "fortran": LanguageTemplate(
+        "fortran", "    ",
+        call="subroutine {method}()\n    call {next_method}()\nend subroutine {method}",
+        end="subroutine {method}()\n    ! End of chain\nend subroutine {method}",
+        header="module {class_name}\n    implicit none\n\ncontains\n",
+        footer="\nend module {class_name}"),
+    "pascal": LanguageTemplate(
+        "pascal", "    ",
+        call="procedure {method};\nbegin\n    {next_method};\nend;",
+        end="procedure {method};\nbegin\n    // End of chain\nend;",
+        header="unit {class_name};\n\ninterface\n\ntype\n    T{class_name} = class\n    public",
+        declaration="        procedure {method};",
+        declarations_end="    end;\n\nimplementation\n",
+        footer="\nend."),
+    "ruby": LanguageTemplate(
+        "ruby", "  ",
+        call="def {method}\n  {next_method}\nend",
+        end="def {method}\n  # End of chain\nend",
+        header="class {class_name}",
+        footer="end"),
+    "php": LanguageTemplate(
+        "php", "    ",
+        call="public function {method}() {{\n    $this->{next_method}();\n}}",
+        end="public function {method}() {{\n    // End of chain\n}}",
+        header="<?php\n\nclass {class_name} {{",
+        footer="}}\n?>"),
+}
+TEMPLATES["c++"] = TEMPLATES["cpp"]
+TEMPLATES["f90"] = TEMPLATES["fortran"]
+TEMPLATES["pas"] = TEMPLATES["pascal"]
+TEMPLATES["rb"] = TEMPLATES["ruby"]
+
+
+def get_template(language: str) -> LanguageTemplate:
+    language = language.lower()
+    if language not in TEMPLATES:
+        raise ValueError(f"Unsupported language: {language}. Supported languages: {list(TEMPLATES.keys())}")
+    return TEMPLATES[language]
+
+
+# ==========================
+#   Emitters
+# ==========================
+
+def write_comment(writer: SourceWriter, n_comment_lines: int, language: str):
+    """Lorem ipsum comment block, an empty block still takes a line (as in the generated experiments)."""
+    writer.extend(comments_generation.lorem_ipsum_comment_lines(n_comment_lines, language) or [""])
+
+
+def render_chain_methods(template: LanguageTemplate, method_names: list[str], n_comment_lines: int = None) -> list[str]:
+    """
+    Methods of a chain, each calling the next one, the last one ends the chain.
+    Unless n_comment_lines is None, each method is preceded by a comment block of that many lines.
+
+    Returns:
+        list[str]: one string per method (the methods of a class are shuffled)
+    """
+    method_bodies = []
+    last = len(method_names) - 1
+    for i, method in enumerate(method_names):
+        writer = SourceWriter(template.indent)
+        if n_comment_lines is not None:
+            write_comment(writer, n_comment_lines, template.name)
+        with writer.indented():
+            if i < last:
+                writer.extend(render(template.call, method=method, next_method=method_names[i + 1]))
+            else:
+                writer.extend(render(template.end, method=method))
+        method_bodies.append(writer.getvalue())
+    return method_bodies
+
+
+def render_class(template: LanguageTemplate, class_name: str, method_bodies: list[str]) -> str:
+    """Class/module/unit of the language around the methods, separated by a blank line."""
+    return "".join(iter_class(template, class_name, method_bodies))
+
+
+def iter_class(template: LanguageTemplate, class_name: str, method_bodies: list[str]):
+    """
+    Text of render_class piece by piece (header, then one method at a time, then footer),
+    to write a class to several files without joining it in memory.
+    """
+    # Fortran modules are lower case
+    if template.name == "fortran":
+        class_name = class_name.lower()
+
+    header = SourceWriter(template.indent)
+    header.extend(render(template.header, class_name=class_name))
+    if template.declaration is not None:
+        for body in method_bodies:
+            # this is wrong when we have some comments!
+            # // comments are ok in pascal, so are { } and (* *) comments
+            header.extend(render(template.declaration, method=body.split()[1].rstrip(';')))
+        header.extend(render(template.declarations_end))
+    yield header.getvalue()
+    for i, body in enumerate(method_bodies):
+        yield "\n\n" if i else "\n"
+        yield body
+    if not method_bodies:
+        yield "\n"
+    yield "\n"
+    yield "\n".join(render(template.footer, class_name=class_name))
+
+
+# ==========================
+#   Micro-benchmark
+# ==========================
+
+def benchmark(n_methods: int = 5000, comment_lines: list = (0, 5, 20), languages: list = None,
+              chain_size: int = 10, repeat: int = 3) -> list[dict]:
+    """
+    Throughput of the emitters: a class of n_methods in chains of chain_size for each
+    language and number of comment lines, plus the Java tree emitter (control flow).
+    Best of `repeat` runs.
+
+    Returns:
+        list[dict]: language, comment lines, methods/s, output size and KB/s of each case
+    """
+    # Imported here, generate_tree_chains uses this module
+    import generate_tree_chains as gen_tree
+    import method_tree
+    from experiment_config import TreeCallExperimentConfig
+
+    languages = languages or ["java", "cpp", "fortran", "pascal", "ruby", "php"]
+    names = [f"method{i}" for i in range(n_methods)]
+    chains = [names[i:i + chain_size] for i in range(0, n_methods, chain_size)]
+    results = []
+
+    def measure(language, n_comments, emit):
+        best, size = None, 0
+        for _ in range(repeat):
+            random.seed(0)
+            start = perf_counter()
+            size = len(emit())
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({"language": language, "comment_lines": n_comments, "methods_per_s": n_methods / best,
+                        "size_kb": size / 1024, "kb_per_s": size / 1024 / best})
+
+    for language in languages:
+        template = get_template(language)
+        for n_comments in comment_lines:
+            measure(language, n_comments, lambda: render_class(
+                template, "TheClass", [body for chain in chains for body in render_chain_methods(template, chain, n_comments)]))
+
+    # Java tree emitter: variables, loops and ifs in every method
+    for n_comments in comment_lines:
+        config = TreeCallExperimentConfig(name="benchmark", context_size=n_methods, depths=[chain_size],
+                                          n_questions=0, n_comment_lines=n_comments, n_vars=2, n_loops=1, n_if=1)
+        random.seed(0)
+        trees, _ = method_tree.generate_many_branches([list(chain) for chain in chains], config.n_params, config.n_vars)
+        measure("java (tree)", n_comments, lambda: render_class(
+            get_template("java"), "TheClass", gen_tree.generate_tree_method_calls(trees=trees, config=config)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the code emitters, in methods per second per language")
+    parser.add_argument("--methods", type=int, default=5000, help="methods per generated class")
+    parser.add_argument("--comments", type=int, nargs="+", default=[0, 5, 20], help="comment lines per method")
+    parser.add_argument("--languages", nargs="+", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'language':<14}{'comments':>9}{'methods/s':>12}{'size (KB)':>12}{'KB/s':>12}")
+    for r in benchmark(args.methods, args.comments, args.languages, repeat=args.repeat):
+        print(f"{r['language']:<14}{r['comment_lines']:>9}{r['methods_per_s']:>12.0f}{r['size_kb']:>12.0f}{r['kb_per_s']:>12.0f}")
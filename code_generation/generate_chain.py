@@ -1,3 +1,5 @@
+from bisect import bisect_right
+from itertools import accumulate
 import os
 import random
 import prompts as p
@@ -9,60 +11,113 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 """  Generation functions for Java methods and classes with chained method calls."""
 
+# There are 38 verbs, 49 nouns, and 45 complements.
+# This gives us a total of 38 * 49 * 45 = 83,790 unique method names.
+VERBS = [
+    "get", "set", "is", "calculate", "process", "fetch", "update", "create", "delete", 
+    "find", "check", "load", "save", "reset", "clear", "validate", "initialize", 
+    "convert", "apply", "enable", "disable", "sort", "merge", "copy", "generate", 
+    "retrieve", "parse", "extract", "compare", "build", "register", "unregister",
+    "sync", "execute", "dispatch", "resolve", "filter", "log"
+]
+
+NOUNS = [
+    "Data", "Item", "Value", "State", "Config", "Status", "Object", "Parameter", "Setting", 
+    "Resource", "Detail", "Info", "Message", "Handler", "Element", "Connection", "Index", 
+    "Entry", "Key", "Session", "Metric", "Field", "Action", "Notification", "Instance", 
+    "Node", "Task", "Job", "Event", "Request", "Response", "Flag", "File", "Directory", 
+    "Path", "Buffer", "User", "Account", "Transaction", "Cache", "Result", "List", 
+    "Map", "Queue", "Stack", "Collection", "Component", "Service", "Manager"
+]
+
+COMPLEMENTS = [
+    "ById", "ForUser", "WithFilter", "InCache", "FromDatabase", "FromFile", "ToJson", 
+    "FromXml", "IfAvailable", "OrDefault", "AsString", "FromUrl", "OnClick", "InMemory", 
+    "FromApi", "ForSession", "WithTimeout", "ForRequest", "FromResponse", "AtIndex", 
+    "WithKey", "WithIndex", "ForTransaction", "IfValid", "OnInit", "AsList", "ForRole", 
+    "ToBuffer", "ForMapping", "OnComplete", "AtPosition", "ToSet", "AsMap", "AsQueue", 
+    "WithLimit", "ToCollection", "ForEach", "IfEnabled", "WithPolicy", "InThread", 
+    "ForExecution", "InParallel", "AsObservable", "IfExists", "WithRetries"
+]
+
+def format_method_name(verb: str, noun: str, complement: str, style: str = "camelCase") -> str:
+    """Join the three parts of a method name in the naming style of a language."""
+    if style == "snake_case":
+        return f"{verb}_{noun}_{complement}".lower()
+    elif style == "PascalCase":
+        return f"{verb.capitalize()}{noun}{complement}"
+    return f"{verb}{noun}{complement}"
+
 def generate_random_java_method_name():
     """ Generates a random Java method name by combining a verb, a noun, and a complement. """
-    
-    # There are 38 verbs, 49 nouns, and 45 complements.
-    # This gives us a total of 38 * 49 * 45 = 83,790 unique method names.
-    verbs = [
-        "get", "set", "is", "calculate", "process", "fetch", "update", "create", "delete", 
-        "find", "check", "load", "save", "reset", "clear", "validate", "initialize", 
-        "convert", "apply", "enable", "disable", "sort", "merge", "copy", "generate", 
-        "retrieve", "parse", "extract", "compare", "build", "register", "unregister",
-        "sync", "execute", "dispatch", "resolve", "filter", "log"
-    ]
-    
-    nouns = [
-        "Data", "Item", "Value", "State", "Config", "Status", "Object", "Parameter", "Setting", 
-        "Resource", "Detail", "Info", "Message", "Handler", "Element", "Connection", "Index", 
-        "Entry", "Key", "Session", "Metric", "Field", "Action", "Notification", "Instance", 
-        "Node", "Task", "Job", "Event", "Request", "Response", "Flag", "File", "Directory", 
-        "Path", "Buffer", "User", "Account", "Transaction", "Cache", "Result", "List", 
-        "Map", "Queue", "Stack", "Collection", "Component", "Service", "Manager"
-    ]
-    
-    complements = [
-        "ById", "ForUser", "WithFilter", "InCache", "FromDatabase", "FromFile", "ToJson", 
-        "FromXml", "IfAvailable", "OrDefault", "AsString", "FromUrl", "OnClick", "InMemory", 
-        "FromApi", "ForSession", "WithTimeout", "ForRequest", "FromResponse", "AtIndex", 
-        "WithKey", "WithIndex", "ForTransaction", "IfValid", "OnInit", "AsList", "ForRole", 
-        "ToBuffer", "ForMapping", "OnComplete", "AtPosition", "ToSet", "AsMap", "AsQueue", 
-        "WithLimit", "ToCollection", "ForEach", "IfEnabled", "WithPolicy", "InThread", 
-        "ForExecution", "InParallel", "AsObservable", "IfExists", "WithRetries"
-    ]
-
-    verb = random.choice(verbs)
-    noun = random.choice(nouns)
-    complement = random.choice(complements)
-
-    return verb + noun + complement
-
-def generate_unique_method_names(n:int):
+    return random.choice(VERBS) + random.choice(NOUNS) + random.choice(COMPLEMENTS)
+
+class MethodNameAllocator:
+    """Unique method names drawn without replacement from the verb x noun x complement index space.
+
+    Index i is the name (i // (n_nouns * n_complements), i // n_complements % n_nouns, i % n_complements).
+    Draws are a lazy Fisher-Yates shuffle of the indices: each name costs one random number and
+    memory only grows with the number of names drawn, so asking for most of the 83,790 names is as
+    cheap as asking for a few, where retrying random names into a set degenerates as the set fills.
+    Names never repeat within one allocator, which can be shared by all the contexts of an experiment.
+
+    Args:
+        seed: seed of a private random.Random, None to draw from the global random module
+            (the generators seed it with random.seed)
+        style: naming style, see format_method_name
+        words: (verbs, nouns, complements) lists, the ones above by default
+    """
+
+    def __init__(self, seed=None, style: str = "camelCase", words: tuple = None):
+        self.words = words or (VERBS, NOUNS, COMPLEMENTS)
+        self.style = style
+        self.rng = random.Random(seed) if seed is not None else random
+        self.size = len(self.words[0]) * len(self.words[1]) * len(self.words[2])
+        self.n_drawn = 0
+        self._swaps = {}  # position -> index, for the positions of the shuffle that moved
+
+    @property
+    def remaining(self) -> int:
+        return self.size - self.n_drawn
+
+    def name(self, index: int) -> str:
+        verbs, nouns, complements = self.words
+        rest, complement = divmod(index, len(complements))
+        verb, noun = divmod(rest, len(nouns))
+        return format_method_name(verbs[verb], nouns[noun], complements[complement], self.style)
+
+    def draw_index(self) -> int:
+        if self.n_drawn >= self.size:
+            raise ValueError(f"All {self.size} method names have been allocated")
+        j = self.rng.randrange(self.n_drawn, self.size)
+        index = self._swaps.get(j, j)
+        # Position n_drawn is never looked at again, its index moves to j
+        self._swaps[j] = self._swaps.pop(self.n_drawn, self.n_drawn)
+        self.n_drawn += 1
+        return index
+
+    def allocate(self, n: int) -> list:
+        """The next n names."""
+        if n > self.remaining:
+            raise ValueError(f"Cannot allocate {n} method names, only {self.remaining} of {self.size} left")
+        return [self.name(self.draw_index()) for _ in range(n)]
+
+    def stream(self):
+        """Generator of the remaining names, for consumers that do not know how many they need."""
+        while self.remaining:
+            yield self.name(self.draw_index())
+
+def generate_unique_method_names(n:int, seed=None):
     """Generate a list of unique random Java method names.
 
     Args:
         n (int): Number of unique method names to generate.
+        seed (int, optional): Seed of the draw, the global random module is used if None.
 
     Returns:
         list: A list of unique random Java method names.
     """
-    
-    unique_names = set()
-    while len(unique_names) < n:
-        method_name = generate_random_java_method_name()
-        unique_names.add(method_name)
-    
-    return list(unique_names)
+    return MethodNameAllocator(seed=seed).allocate(n)
 
 def generate_chained_method_calls(method_names:list):
     """Generate a list of Java method bodies that call each other in a chain.
@@ -154,6 +209,49 @@ def select_n_of_distance(questions_with_distances_maybe_chain:list, distance:int
     # Randomly sample up to `n` questions from the filtered list
     return random.sample(filtered_questions, min(n, len(filtered_questions)))
 
+class StratifiedCandidates:
+    """Candidate questions grouped by distance, built lazily.
+    
+    Listing every question of a context and filtering it per distance formats a question for
+    each pair of methods, most of them are never selected. A stratum (the candidates of one
+    distance) is instead described by blocks: subclasses list the (size, key) blocks of a
+    distance in the order the eager generators list the questions, and build the question
+    at an offset of a block. Sampling draws indices, so with the same random state it selects
+    the same questions as random.sample over the filtered list.
+    """
+    def __init__(self):
+        self._strata = {}
+    
+    def blocks(self, distance: int) -> list[tuple]:
+        """(size, key) blocks of the candidates at this distance."""
+        raise NotImplementedError
+    
+    def build(self, distance: int, key, offset: int) -> dict:
+        """Question at offset of the block key."""
+        raise NotImplementedError
+    
+    def _stratum(self, distance: int) -> tuple[list[int], list]:
+        if distance not in self._strata:
+            blocks = [(size, key) for size, key in self.blocks(distance) if size > 0]
+            self._strata[distance] = (list(accumulate(size for size, _ in blocks)), [key for _, key in blocks])
+        return self._strata[distance]
+    
+    def count(self, distance: int) -> int:
+        """Number of candidates at this distance."""
+        ends, _ = self._stratum(distance)
+        return ends[-1] if ends else 0
+    
+    def candidate(self, distance: int, k: int) -> dict:
+        """k-th candidate at this distance."""
+        ends, keys = self._stratum(distance)
+        block = bisect_right(ends, k)
+        return self.build(distance, keys[block], k - (ends[block - 1] if block else 0))
+    
+    def sample(self, distance: int, n: int) -> list[dict]:
+        """Up to n random candidates at this distance."""
+        count = self.count(distance)
+        return [self.candidate(distance, k) for k in random.sample(range(count), min(n, count))]
+
 def count_distances(dict_list:list):
     """Count the occurrences of each distance in a list of dictionary.
 
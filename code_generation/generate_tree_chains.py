@@ -1,10 +1,11 @@
+from collections import deque
 from pathlib import Path
 import random
 import generate_chain as gen
 import method_tree
 import prompts
-import comments_generation
 import control_flow
+import emitters
 from experiment_config import TreeCallExperimentConfig
 
 """            
@@ -120,14 +121,19 @@ def generate_many_call_trees(dir:str, tree_depth:int, n_trees:int):
         
     return trees, method_names
 
-def generate_many_call_trees_v2(dir: str, config: TreeCallExperimentConfig):
+def generate_many_call_trees_v2(dir: str, config: TreeCallExperimentConfig, store: method_tree.CallTree = None,
+                                names: gen.MethodNameAllocator = None):
     """Generate a list of method bodies that call each other in a tree-like structure.
 
     Args:
         tree_depth (int): The depth of the tree to be generated.
         n_trees (int): The number of trees to generate.
+        store (CallTree, optional): Compact store to build all the trees in, linked Nodes when None.
+        names (MethodNameAllocator, optional): Allocator shared by the contexts of an experiment, so that
+            no name is used twice in it; a fresh one (names unique in this context only) when None.
     """
-    method_names = gen.generate_unique_method_names(config.context_size)
+    # deque: the builders take names from the front
+    method_names = deque((names or gen.MethodNameAllocator()).allocate(config.context_size))
         
     max_chain_length = max(config.depths)
     depth = max_chain_length//2 + 2
@@ -136,19 +142,19 @@ def generate_many_call_trees_v2(dir: str, config: TreeCallExperimentConfig):
     cmpt = 0
     while method_names:
         if cmpt % 4 == 0:
-            root = method_tree.build_comb_tree(depth, max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars)
+            root = method_tree.build_comb_tree(depth, max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars, store=store)
             if root:
                 trees.append(root)
         elif cmpt % 4 == 1:
-            root = method_tree.build_near_comb_tree(depth, max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars)
+            root = method_tree.build_near_comb_tree(depth, max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars, store=store)
             if root:
                 trees.append(root)
         elif cmpt % 4 == 2:
-            root = method_tree.build_unbalanced_binary_tree(max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars)
+            root = method_tree.build_unbalanced_binary_tree(max_chain_length, method_names, n_params=config.n_params, n_vars=config.n_vars, store=store)
             if root:
                 trees.append(root)
         else:
-            root = method_tree.build_binary_tree(3, method_names, n_params=config.n_params, n_vars=config.n_vars)
+            root = method_tree.build_binary_tree(3, method_names, n_params=config.n_params, n_vars=config.n_vars, store=store)
             trees.append(root)
         cmpt += 1
         
@@ -165,14 +171,19 @@ def generate_many_call_trees_v2(dir: str, config: TreeCallExperimentConfig):
         
     return trees, all_method_names
 
-def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
+def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig, store: method_tree.CallTree = None,
+                                names: gen.MethodNameAllocator = None):
     """Generate a list of method bodies that call each other in a tree-like structure.
 
     Args:
         tree_depth (int): The depth of the tree to be generated.
         n_trees (int): The number of trees to generate.
+        store (CallTree, optional): Compact store to build all the trees in, linked Nodes when None.
+        names (MethodNameAllocator, optional): Allocator shared by the contexts of an experiment, so that
+            no name is used twice in it; a fresh one (names unique in this context only) when None.
     """
-    method_names = gen.generate_unique_method_names(config.context_size)
+    # deque: the builders take names from the front
+    method_names = deque((names or gen.MethodNameAllocator()).allocate(config.context_size))
     
     max_chain_length = max(config.depths)
     comb_depth = max_chain_length//2 + 2
@@ -203,7 +214,8 @@ def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
                                                     method_names, 
                                                     n_params=config.n_params, 
                                                     n_vars=config.n_vars, 
-                                                    shape=shape)
+                                                    shape=shape,
+                                                    store=store)
             
         elif len(method_names) >= size_of_double_comb:
             print("Generating Double-Comb tree")
@@ -211,7 +223,8 @@ def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
                                                  method_names,
                                                  n_params=config.n_params,
                                                  n_vars=config.n_vars, 
-                                                 shape=shape)
+                                                 shape=shape,
+                                                 store=store)
             
         elif len(method_names) >= size_of_comb:
             if random.random() > 0.5:
@@ -221,7 +234,8 @@ def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
                                                    method_names,
                                                    n_params=config.n_params,
                                                    n_vars=config.n_vars, 
-                                                   shape=shape)
+                                                   shape=shape,
+                                                   store=store)
                 
             else:
                 print("Generating Near-Comb tree")
@@ -230,7 +244,8 @@ def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
                                                         method_names,
                                                         n_params=config.n_params,
                                                         n_vars=config.n_vars, 
-                                                        shape=shape)
+                                                        shape=shape,
+                                                        store=store)
                 
         else:
             remaining_size = len(method_names)
@@ -244,7 +259,8 @@ def generate_many_call_trees_v3(dir: str, config: TreeCallExperimentConfig):
             root = method_tree.build_binary_tree(k_depth, 
                                                  method_names, 
                                                  n_params=config.n_params, 
-                                                 n_vars=config.n_vars)
+                                                 n_vars=config.n_vars,
+                                                 store=store)
                         
         if root:
             trees.append(root)
@@ -285,7 +301,7 @@ def generate_tree_method_calls(trees:list, config: TreeCallExperimentConfig = No
 
 
 def generate_tree_method_calls_rec(tree: method_tree.Node, config: TreeCallExperimentConfig = None):
-    """Generate the methods from the tree structure recursively.
+    """Generate the methods from the tree structure.
 
     Args:
         tree (Node): A Node object representing a node of the tree.
@@ -293,11 +309,8 @@ def generate_tree_method_calls_rec(tree: method_tree.Node, config: TreeCallExper
     if tree is None:
         return []
     
-    method_bodies = [generate_single_method_body(tree, config)]
-    method_bodies += generate_tree_method_calls_rec(tree.left, config)
-    method_bodies += generate_tree_method_calls_rec(tree.right, config)
-    
-    return method_bodies
+    # Depth-first order, iterative (deep combs)
+    return [generate_single_method_body(node, config) for node in tree.get_list_of_nodes()]
 
 def generate_single_method_body(node: method_tree.Node, config: TreeCallExperimentConfig = None):
     param_string = ", ".join([f"{var.var_type} {var.name}" for var in (node.params or [])])
@@ -311,7 +324,10 @@ def generate_single_method_body(node: method_tree.Node, config: TreeCallExperime
     if config.language.lower() != "java":
         raise ValueError("Tree call experiments only supports Java language")
     
-    comment = comments_generation.generate_lorem_ipsum_comments(config.n_comment_lines, config.language)
+    # Comment and body are written indented in the class, an empty one still takes a line
+    writer = emitters.SourceWriter("\t")
+    with writer.indented():
+        emitters.write_comment(writer, config.n_comment_lines, config.language)
     
     next_methods = []
     
@@ -355,16 +371,18 @@ def generate_single_method_body(node: method_tree.Node, config: TreeCallExperime
     if len(next_methods) == 0:
         next_methods = None
     
-    method_body = control_flow.generate_method_body(next_methods=next_methods,
-                                                   vars=node.variables,
-                                                   all_vars=node.all_variables,
-                                                   return_var=node.return_variable,
-                                                   n_loops=config.n_loops,
-                                                   n_if=config.n_if)
+    method_body = control_flow.method_body_lines(next_methods=next_methods,
+                                                 vars=node.variables,
+                                                 all_vars=node.all_variables,
+                                                 return_var=node.return_variable,
+                                                 n_loops=config.n_loops,
+                                                 n_if=config.n_if)
 
-    comment = "\t" + comment.replace("\n", "\n\t")
-    method_body = "\t" + method_body.replace("\n", "\n\t")
-    return f"{comment}\n\tpublic {node.return_type} {node.name}({param_string}) {{\n{method_body}\n\t}}"
+    with writer.indented():
+        writer.line(f"public {node.return_type} {node.name}({param_string}) {{")
+        writer.extend(method_body or [""])
+        writer.line("}")
+    return writer.getvalue()
 
 
 def generate_class_from_multiple_trees(directory:str, class_name:str, trees:list, method_names:list, selection:list):
@@ -449,7 +467,8 @@ def find_all_valid_chains(trees:list) -> tuple[list, list]:
     """
     all_valid_chains = []
     for tree in trees:
-        chains = method_tree.find_all_valid_chains_depth_first(tree)
+        # Same chains as method_tree.find_all_valid_chains_depth_first, without a search per pair
+        chains = method_tree.ReachabilityIndex(tree).valid_chains()
         all_valid_chains.extend(chains)
     
     generate_questions_from_valid_chains(all_valid_chains)
@@ -471,7 +490,9 @@ def find_all_invalid_chains(trees:list) -> tuple[list, list]:
     # 2. Find the invalid chains across all trees (when a method is not reachable from another one because they are on different trees)
     all_invalid_chains = []
     for tree in trees:
-        invalid_chains = method_tree.find_all_invalid_chains_depth_first(tree)
+        # Same chains as method_tree.find_all_invalid_chains_depth_first, unreachable methods are
+        # the complement of the subtree interval of each method
+        invalid_chains = method_tree.ReachabilityIndex(tree).invalid_chains()
         all_invalid_chains.extend(invalid_chains)
     
     all_invalid_chains = generate_questions_from_invalid_chains(all_invalid_chains)
@@ -481,6 +502,65 @@ def find_all_invalid_chains(trees:list) -> tuple[list, list]:
     
     return all_invalid_chains
 
+def tree_call_question(caller: str, callee: str) -> str:
+    """Reachability question of a tree context"""
+    return (
+        f"Does `{caller}` call `{callee}`, either directly or indirectly? "
+        f"Think step-by-step by following the method calls from `{caller}`."
+    )
+
+class TreeCandidates(gen.StratifiedCandidates):
+    """
+    Questions of find_all_valid_chains (distance > 0) and find_all_invalid_chains (distance < 0)
+    by distance, from the reachability index of each tree, in the same order.
+    Distance d: one pair (a, a + d) per method a whose subtree has more than d methods.
+    Distance -d: the methods a (not a root) with d descendants, one question per method
+    outside the subtree of a.
+    """
+    def __init__(self, trees: list):
+        super().__init__()
+        self.indexes = [method_tree.ReachabilityIndex(tree) for tree in trees]
+    
+    def blocks(self, distance: int) -> list:
+        blocks = []
+        for t, index in enumerate(self.indexes):
+            if distance > 0:
+                callers = [a for a in range(len(index)) if index.size(a) > distance]
+                blocks.append((len(callers), (t, callers)))
+            elif distance < 0:
+                blocks.extend((len(index) - index.size(a), (t, a))
+                              for a in range(1, len(index)) if index.size(a) - 1 == -distance)
+        return blocks
+    
+    def build(self, distance: int, key, offset: int) -> dict:
+        if distance > 0:
+            t, callers = key
+            index = self.indexes[t]
+            a = callers[offset]
+            d = a + distance
+            chain = index.chain(a, d)
+            return {
+                "chain": chain,
+                "distance": distance,
+                "distance_with_backtracking": index.distance_with_backtracking(a, d),
+                "distance_height": index.distance_height(a, d),
+                "question": tree_call_question(chain[0], chain[-1]),
+            }
+        t, a = key
+        index = self.indexes[t]
+        chain, descendants, descendants_with_backtracking, height = index.traversal(a)
+        # offset-th method of the complement of the subtree interval of a
+        unreachable = index.names[offset if offset < a else offset + descendants + 1]
+        return {
+            "node": index.names[a],
+            "distance": -descendants,
+            "distance_with_backtracking": -descendants_with_backtracking,
+            "distance_height": height,
+            "chain": chain,
+            "question": tree_call_question(index.names[a], unreachable),
+            "target_method": unreachable,
+        }
+
 def generate_questions_from_valid_chains(chains:list, max_chain_length:int = None):
     """Generate questions from valid chains.
 
@@ -490,12 +570,7 @@ def generate_questions_from_valid_chains(chains:list, max_chain_length:int = Non
     """
     for item in chains:
         if max_chain_length is None or item["distance"] <= max_chain_length:
-            chain = item["chain"]
-            question = (
-                f"Does `{chain[0]}` call `{chain[-1]}`, either directly or indirectly? "
-                f"Think step-by-step by following the method calls from `{chain[0]}`."
-            )
-            item["question"] = question          
+            item["question"] = tree_call_question(item["chain"][0], item["chain"][-1])
             
     return
 
@@ -515,12 +590,7 @@ def generate_questions_from_invalid_chains(chains:list, max_chain_length:int = N
                 new_item = item.copy()
                 new_item.pop("unreachable_methods", None)  # Remove the field if it exists
                 
-                question = (
-                    f"Does `{item['node']}` call `{unreachable}`, either directly or indirectly? "
-                    f"Think step-by-step by following the method calls from `{item['node']}`."
-                )
-                
-                new_item["question"] = question 
+                new_item["question"] = tree_call_question(item['node'], unreachable)
                 new_item["target_method"] = unreachable
                 
                 generated_questions.append(new_item)
@@ -1,5 +1,9 @@
+import argparse
+import hashlib
 import os
 import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from collections import defaultdict
 from time import time
@@ -10,8 +14,10 @@ from math import ceil
 import prompts
 import control_flow
 import comments_generation
+import emitters
 import method_tree
 import generate_tree_chains as gen_tree
+from generate_chain import MethodNameAllocator, StratifiedCandidates, format_method_name
 from experiment_config import ExperimentConfig, LinearCallExperimentConfig, TreeCallExperimentConfig
 
 class MethodNameGenerator:
@@ -52,23 +58,19 @@ class MethodNameGenerator:
         prefix = random.choice(cls.PREFIXES)
         verb = random.choice(cls.VERBS)
         noun = random.choice(cls.NOUNS)
-        
-        if style == "camelCase":
-            return f"{prefix}{verb}{noun}"
-        elif style == "snake_case":
-            return f"{prefix}_{verb}_{noun}".lower()
-        elif style == "PascalCase":
-            return f"{prefix.capitalize()}{verb}{noun}"
-        else:
-            return f"{prefix}{verb}{noun}"
+        return format_method_name(prefix, verb, noun, style)
 
     @classmethod
-    def generate_unique_method_names(cls, n: int, style: str = "camelCase") -> List[str]:
-        """Generate n unique method names"""
-        unique_names = set()
-        while len(unique_names) < n:
-            unique_names.add(cls.generate_method_name(style))
-        return list(unique_names)
+    def allocator(cls, seed=None, style: str = "camelCase") -> MethodNameAllocator:
+        """Allocator of unique names over PREFIXES x VERBS x NOUNS, to share names out between contexts"""
+        return MethodNameAllocator(seed=seed, style=style, words=(cls.PREFIXES, cls.VERBS, cls.NOUNS))
+
+    @classmethod
+    def generate_unique_method_names(cls, n: int, style: str = "camelCase", seed=None,
+                                     names: MethodNameAllocator = None) -> List[str]:
+        """Generate n unique method names (sampled without replacement), from `names` when given so that
+        they are also unique across the contexts sharing it"""
+        return (names or cls.allocator(seed, style)).allocate(n)
 
 
 class LanguageGenerator(ABC):
@@ -90,6 +92,10 @@ class LanguageGenerator(ABC):
                                            config: TreeCallExperimentConfig, class_name: str ="TheClass") -> str:
         """Generate a class/module based on the trees generated"""
     
+    def stream_class_from_multiple_trees(self, trees: list, config: TreeCallExperimentConfig, class_name: str ="TheClass"):
+        """Iterator over the text of generate_class_from_multiple_trees, see FileWriter.write_class_and_prompt"""
+        return iter([self.generate_class_from_multiple_trees(trees=trees, config=config, class_name=class_name)])
+    
     @abstractmethod
     def get_file_extension(self) -> str:
         """Get the file extension for this language"""
@@ -140,17 +146,11 @@ class LanguageGenerator(ABC):
 class JavaGenerator(LanguageGenerator):
     """Java-specific code generator"""
     
+    template = emitters.TEMPLATES["java"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained method calls for Java"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    public void {method}() {{\n        {next_method}();\n    }}"
-            else:
-                method_body = f"    public void {method}() {{\n        // End of chain\n    }}"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], chain_generator: Callable) -> str:
         """Generate a Java class with multiple method chains"""
@@ -160,11 +160,7 @@ class JavaGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        class_body = f"public class {class_name} {{\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\n}"
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def generate_class_from_multiple_trees(self, trees: list, config: TreeCallExperimentConfig, class_name: str ="TheClass") -> str:
         """Generate a class with methods that call each other in a tree-like structure.
@@ -173,7 +169,12 @@ class JavaGenerator(LanguageGenerator):
             directory (str): The directory where the generated files will be saved.
             tree_depth (int): The depth of the tree to be generated.
         """
-        
+        return "".join(self.stream_class_from_multiple_trees(trees=trees, config=config, class_name=class_name))
+    
+    def stream_class_from_multiple_trees(self, trees: list, config: TreeCallExperimentConfig, class_name: str ="TheClass"):
+        """Same class as generate_class_from_multiple_trees, as an iterator over its header, methods and footer.
+        The methods are generated (and shuffled) by the call, only their concatenation is deferred.
+        """
         method_bodies = gen_tree.generate_tree_method_calls(trees=trees, config=config)
     
         print(f"Generated {len(method_bodies)} method bodies")
@@ -182,11 +183,7 @@ class JavaGenerator(LanguageGenerator):
         random.shuffle(method_bodies)
 
         # Construct the class with shuffled method bodies
-        class_body = f"public class {class_name} {{\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\n}"
-        
-        return class_body
+        return emitters.iter_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".java"
@@ -198,17 +195,11 @@ class JavaGenerator(LanguageGenerator):
 class CppGenerator(LanguageGenerator):
     """C++ specific code generator"""
     
+    template = emitters.TEMPLATES["cpp"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained method calls for C++"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"\tvoid {method}() {{\n\t\t{next_method}();\n    }}"
-            else:
-                method_body = f"\tvoid {method}() {{\n\t// End of chain\n    }}"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], chain_generator: Callable) -> str:
         """Generate a C++ class with multiple method chains"""
@@ -218,12 +209,7 @@ class CppGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        # Generate header section
-        class_body = f"#include <iostream>\n\nclass {class_name} {{\npublic:\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\n};"
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".cpp"
@@ -235,17 +221,11 @@ class CppGenerator(LanguageGenerator):
 class FortranGenerator(LanguageGenerator):
     """Fortran specific code generator"""
     
+    template = emitters.TEMPLATES["fortran"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained subroutine calls for Fortran"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    subroutine {method}()\n        call {next_method}()\n    end subroutine {method}"
-            else:
-                method_body = f"    subroutine {method}()\n        ! End of chain\n    end subroutine {method}"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], 
                                           chain_generator: Callable) -> str:
@@ -256,12 +236,7 @@ class FortranGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        # Generate Fortran module
-        class_body = f"module {class_name.lower()}\n    implicit none\n\ncontains\n\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += f"\n\nend module {class_name.lower()}"
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".f90"
@@ -273,17 +248,11 @@ class FortranGenerator(LanguageGenerator):
 class PascalGenerator(LanguageGenerator):
     """Pascal specific code generator"""
     
+    template = emitters.TEMPLATES["pascal"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained procedure calls for Pascal"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    procedure {method};\n    begin\n        {next_method};\n    end;"
-            else:
-                method_body = f"    procedure {method};\n    begin\n        // End of chain\n    end;"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], 
                                           chain_generator: Callable) -> str:
@@ -294,21 +263,7 @@ class PascalGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        # Generate Pascal unit
-        class_body = f"unit {class_name};\n\ninterface\n\ntype\n    T{class_name} = class\n    public\n"
-        
-        # Add procedure declarations
-        for body in method_bodies:
-            # this is wrong when we have some comments!
-            # // comments are ok in pascal, so are { } and (* *) comments
-            proc_name = body.split()[1].rstrip(';')
-            class_body += f"        procedure {proc_name};\n"
-        
-        class_body += "    end;\n\nimplementation\n\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\n\nend."
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".pas"
@@ -320,17 +275,11 @@ class PascalGenerator(LanguageGenerator):
 class RubyGenerator(LanguageGenerator):
     """Ruby specific code generator"""
     
+    template = emitters.TEMPLATES["ruby"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained method calls for Ruby"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"  def {method}\n    {next_method}\n  end"
-            else:
-                method_body = f"  def {method}\n    # End of chain\n  end"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], 
                                           chain_generator: Callable) -> str:
@@ -341,12 +290,7 @@ class RubyGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        # Generate Ruby class
-        class_body = f"class {class_name}\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\nend"
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".rb"
@@ -358,17 +302,11 @@ class RubyGenerator(LanguageGenerator):
 class PhpGenerator(LanguageGenerator):
     """PHP specific code generator"""
     
+    template = emitters.TEMPLATES["php"]
+    
     def generate_chained_method_calls(self, method_names: List[str]) -> List[str]:
         """Generate chained method calls for PHP"""
-        method_bodies = []
-        for i, method in enumerate(method_names):
-            if i < len(method_names) - 1:
-                next_method = method_names[i + 1]
-                method_body = f"    public function {method}() {{\n        $this->{next_method}();\n    }}"
-            else:
-                method_body = f"    public function {method}() {{\n        // End of chain\n    }}"
-            method_bodies.append(method_body)
-        return method_bodies
+        return emitters.render_chain_methods(self.template, method_names)
 
     def generate_class_with_multiple_chains(self, class_name: str, chains: List[List[str]], 
                                           chain_generator: Callable) -> str:
@@ -379,12 +317,7 @@ class PhpGenerator(LanguageGenerator):
         
         random.shuffle(method_bodies)
         
-        # Generate PHP class
-        class_body = f"<?php\n\nclass {class_name} {{\n"
-        class_body += "\n\n".join(method_bodies)
-        class_body += "\n}\n?>"
-        
-        return class_body
+        return emitters.render_class(self.template, class_name, method_bodies)
     
     def get_file_extension(self) -> str:
         return ".php"
@@ -397,53 +330,57 @@ class QuestionGenerator:
     """Generates reachability questions for method chains"""
     
     @staticmethod
-    def generate_call_questions_with_distances_and_chains(method_names: List[str], 
-                                                        language: str = "java") -> list[dict]:
-        """Generate questions, distances, and chains for all pairs of methods"""
-        questions_with_distances_and_chains = []
-        num_methods = len(method_names)
-        
-        # Language-specific terminology
+    def terms(language: str = "java") -> Tuple[str, str]:
+        """Language-specific terminology: call term, method term"""
         if language in ["fortran", "f90"]:
-            call_term = "call"
-            method_term = "subroutine"
+            return "call", "subroutine"
         elif language in ["pascal", "pas"]:
-            call_term = "call"
-            method_term = "procedure"
+            return "call", "procedure"
         elif language in ["cpp", "c++"]:
-            call_term = "call"
-            method_term = "function"
+            return "call", "function"
         elif language in ["ruby", "rb", "php", "java"]:
-            call_term = "call"
-            method_term = "method"
+            return "call", "method"
         else:  # others
-            call_term = "call"
-            method_term = "method"
+            return "call", "method"
+    
+    @staticmethod
+    def call_question(method_names: List[str], i: int, j: int, language: str = "java") -> dict:
+        """Question, distance and chains of the pair (i, j) of a chain"""
+        call_term, method_term = QuestionGenerator.terms(language)
+        question = (
+            f"Does `{method_names[i]}` {call_term} `{method_names[j]}`, either directly or indirectly? "
+            f"Think step-by-step by following the {method_term} calls from `{method_names[i]}.`"
+        )
+
+        if i < j:
+            chain = method_names[i:j + 1]
+            distance = len(chain) - 1
+        else:
+            chain = method_names[i:]
+            distance = -(len(chain) - 1)
+        
+        start_back_chain = max(0, i - len(chain))
+        back_chain = method_names[start_back_chain:i]
+        
+        return {
+            "question": question,
+            "distance": distance,
+            "chain": chain,
+            "back_chain": back_chain
+        }
+    
+    @staticmethod
+    def generate_call_questions_with_distances_and_chains(method_names: List[str], 
+                                                        language: str = "java") -> list[dict]:
+        """Generate questions, distances, and chains for all pairs of methods"""
+        questions_with_distances_and_chains = []
+        num_methods = len(method_names)
 
         for i in range(num_methods):
             for j in range(num_methods):
                 if i != j:
-                    question = (
-                        f"Does `{method_names[i]}` {call_term} `{method_names[j]}`, either directly or indirectly? "
-                        f"Think step-by-step by following the {method_term} calls from `{method_names[i]}.`"
-                    )
-
-                    if i < j:
-                        chain = method_names[i:j + 1]
-                        distance = len(chain) - 1
-                    else:
-                        chain = method_names[i:]
-                        distance = -(len(chain) - 1)
-                    
-                    start_back_chain = max(0, i - len(chain))
-                    back_chain = method_names[start_back_chain:i]
-                    
-                    questions_with_distances_and_chains.append({
-                        "question": question,
-                        "distance": distance,
-                        "chain": chain,
-                        "back_chain": back_chain
-                    })
+                    questions_with_distances_and_chains.append(
+                        QuestionGenerator.call_question(method_names, i, j, language))
         
         return questions_with_distances_and_chains
 
@@ -452,8 +389,35 @@ class QuestionGenerator:
         """Select up to n questions with a specified distance"""
         filtered = [q for q in questions_with_distances if q[field] == distance]
         return random.sample(filtered, min(n, len(filtered)))
-            
-        
+    
+    @staticmethod
+    def chain_candidates(chains: List[List[str]], language: str = "java") -> "ChainCandidates":
+        """Lazy version of generate_call_questions_with_distances_and_chains over all the chains"""
+        return ChainCandidates(chains, language)
+
+
+class ChainCandidates(StratifiedCandidates):
+    """
+    Questions of all the pairs of methods of linear chains, by distance.
+    Distance d > 0: the pairs (i, i + d) of each chain.
+    Distance -d: the pairs (i, j < i) with i the (d+1)-th method from the end of its chain,
+    the answer is NO and the whole end of the chain has to be followed.
+    """
+    def __init__(self, chains: List[List[str]], language: str = "java"):
+        super().__init__()
+        self.chains = chains
+        self.language = language
+    
+    def blocks(self, distance: int) -> list:
+        if distance > 0:
+            return [(len(chain) - distance, c) for c, chain in enumerate(self.chains)]
+        return [(len(chain) - 1 + distance, c) for c, chain in enumerate(self.chains)]
+    
+    def build(self, distance: int, c: int, offset: int) -> dict:
+        chain = self.chains[c]
+        if distance > 0:
+            return QuestionGenerator.call_question(chain, offset, offset + distance, self.language)
+        return QuestionGenerator.call_question(chain, len(chain) - 1 + distance, offset, self.language)
 
 
 class FileWriter:
@@ -473,6 +437,17 @@ class FileWriter:
             f.write(body)
             f.write(prompt["end"])
 
+    @staticmethod
+    def write_class_and_prompt(prompt: dict, parts, class_filename: Path, prompt_filename: Path) -> None:
+        """Write the class and the prompt containing it in one pass over the parts of the class
+        (e.g. LanguageGenerator.stream_class_from_multiple_trees), the class is never joined in memory"""
+        with open(class_filename, 'w') as class_file, open(prompt_filename, 'w') as prompt_file:
+            prompt_file.write(prompt["start"])
+            for part in parts:
+                class_file.write(part)
+                prompt_file.write(part)
+            prompt_file.write(prompt["end"])
+
     @staticmethod
     def write_questions_to_file(questions_with_distances: List[Tuple], filename: Path) -> None:
         """Writes the questions to a file, one per line."""
@@ -566,10 +541,26 @@ class LanguageFactory:
 class ExperimentRunner:
     """Main class for running experiments"""
     
-    def __init__(self):
+    def __init__(self, token_counter: Callable[[str], int] = None, seed: int = None):
         self.method_generator = MethodNameGenerator()
         self.question_generator = QuestionGenerator()
         self.file_writer = FileWriter()
+        # Optional callable(text) -> number of tokens, used to report the size of each context
+        self.token_counter = token_counter
+        # Base seed of the contexts, drawn from the random module when not given (random.seed
+        # beforehand still fixes it), so one worker or a pool write the same files for a seed
+        self.seed = random.randrange(2**32) if seed is None else seed
+
+    @staticmethod
+    def context_seed(directory: Path, seed: int = 0) -> int:
+        """Seed of one context, derived from its experiment and directory names (which spell out its config)"""
+        key = f"{seed}:{Path(directory).parent.name}/{Path(directory).name}"
+        return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+
+    def _start_context(self, directory: Path) -> float:
+        """Seed the random module for this context, returns the start time"""
+        random.seed(self.context_seed(directory, self.seed))
+        return time()
 
     @staticmethod
     def divide_list_into_chunks(lst: List, chunk_size: int) -> List[List]:
@@ -590,7 +581,8 @@ class ExperimentRunner:
         return count_dict
 
     def generate_single_linear_context(self, directory: Path, n_chains: int, chain_size: int, n_questions: int, 
-                               chain_generator: Callable, config: LinearCallExperimentConfig) -> None:
+                               chain_generator: Callable, config: LinearCallExperimentConfig,
+                               names: MethodNameAllocator = None) -> None:
         """Generate a single context with specified parameters"""
         # print(f"Generating {config.language} class with {config.context_size} methods")
         # Get language-specific generator
@@ -599,7 +591,8 @@ class ExperimentRunner:
         # Generate method names with appropriate naming style
         method_names = self.method_generator.generate_unique_method_names(
             config.context_size, 
-            lang_generator.get_method_name_style()
+            lang_generator.get_method_name_style(),
+            names=names
         )
         
         # Subdivide the list of method names into chains of methods
@@ -613,20 +606,14 @@ class ExperimentRunner:
             chain_generator
         )
                 
-        # Generate questions for all chains
-        all_questions = []
-        for chain in all_chains:
-            questions = self.question_generator.generate_call_questions_with_distances_and_chains(
-                chain,
-                config.language
-            )
-            all_questions.extend(questions)
+        # Questions of all chains, only the selected ones are formatted
+        candidates = self.question_generator.chain_candidates(all_chains, config.language)
                     
         # Select questions for each depth
         selection = []
         for depth in config.depths:
-            selection.extend(self.question_generator.select_questions_by_distance(all_questions, depth, n_questions))
-            selection.extend(self.question_generator.select_questions_by_distance(all_questions, -depth, n_questions))
+            selection.extend(candidates.sample(depth, n_questions))
+            selection.extend(candidates.sample(-depth, n_questions))
         
         # print(f"Chains:\n\tExpected total: {n_chains}\n\tGround truth: {len(all_chains)}")
         # print(f"Questions:\n\tExpected total: {2 * n_questions * len(config.depths)}\n\tGround truth: {len(selection)}")
@@ -654,7 +641,7 @@ class ExperimentRunner:
         self.file_writer.write_methods_to_file(method_names, directory / "methods.txt")
         
     def generate_single_linear_context_v2(self, directory: Path, n_chains: int, chain_size: int, n_questions: int, 
-                                          config: LinearCallExperimentConfig) -> None:
+                                          config: LinearCallExperimentConfig, names: MethodNameAllocator = None) -> None:
         """Generate a single context with specified parameters"""
         # Get language-specific generator
         lang_generator = LanguageFactory.get_generator(config.language)
@@ -662,7 +649,8 @@ class ExperimentRunner:
         # Generate method names with appropriate naming style
         method_names = self.method_generator.generate_unique_method_names(
             config.context_size, 
-            lang_generator.get_method_name_style()
+            lang_generator.get_method_name_style(),
+            names=names
         )
         
         # Subdivide the list of method names into chains of methods
@@ -670,26 +658,21 @@ class ExperimentRunner:
         
         trees, all_chains = method_tree.generate_many_branches(all_chains, config.n_params, config.n_vars)
         
-        # Generate questions for all chains
-        all_questions = []
-        for chain in all_chains:
-            questions = self.question_generator.generate_call_questions_with_distances_and_chains(
-                chain,
-                config.language
-            )
-            all_questions.extend(questions)
+        # Questions of all chains, only the selected ones are formatted
+        candidates = self.question_generator.chain_candidates(all_chains, config.language)
                     
         # Select questions for each depth
         selection = []
         for depth in config.depths:
-            selection.extend(self.question_generator.select_questions_by_distance(all_questions, depth, n_questions))
-            selection.extend(self.question_generator.select_questions_by_distance(all_questions, -depth, n_questions))
+            selection.extend(candidates.sample(depth, n_questions))
+            selection.extend(candidates.sample(-depth, n_questions))
         
         # print(f"Chains:\n\tExpected total: {n_chains}\n\tGround truth: {len(all_chains)}")
         # print(f"Questions:\n\tExpected total: {2 * n_questions * len(config.depths)}\n\tGround truth: {len(selection)}")
         # print(f"Distance distribution: {self.count_distances(selection)}")
 
-        the_class = lang_generator.generate_class_from_multiple_trees(trees=trees, config=config)
+        # Methods of the class, streamed to TheClass and system.txt
+        the_class = lang_generator.stream_class_from_multiple_trees(trees=trees, config=config)
 
         # Write all files
         directory.mkdir(parents=True, exist_ok=True)
@@ -706,8 +689,7 @@ class ExperimentRunner:
         
         # Use language-specific file extension
         class_filename = f"TheClass{lang_generator.get_file_extension()}"
-        self.file_writer.write_class_to_file(the_class, directory / class_filename)
-        self.file_writer.write_prompt_to_file(prompt, the_class, directory / "system.txt")
+        self.file_writer.write_class_and_prompt(prompt, the_class, directory / class_filename, directory / "system.txt")
         self.file_writer.write_questions_to_file(selection, directory / "reachability_questions.txt")
         self.file_writer.write_chains_to_file(selection, directory / "chains.txt", config)
         self.file_writer.write_methods_to_file(method_names, directory / "methods.txt")
@@ -773,13 +755,15 @@ class ExperimentRunner:
         
         return min_amount_of_questions
     
-    def generate_single_tree_context_v2(self, directory:str, config:TreeCallExperimentConfig, n_questions:int = 400) -> int:
+    def generate_single_tree_context_v2(self, directory:str, config:TreeCallExperimentConfig, n_questions:int = 400,
+                                        names: MethodNameAllocator = None) -> int:
         """Generate an experiment with multiple trees and save the class to a file.
 
         Args:
             directory (str): The name of the experiment.
             config (TreeCallExperimentConfig): Configuration for the experiment
             n_questions (int): Max number of questions to generate
+            names (MethodNameAllocator): Allocator of the experiment, a fresh one when None
             
         Returns:
             int: The actual number of questions generated
@@ -787,34 +771,31 @@ class ExperimentRunner:
         lang_generator = LanguageFactory.get_generator(config.language)
                 
         # trees, method_names = gen_tree.generate_many_call_trees(directory, tree_depth, n_trees)
-        trees, method_names = gen_tree.generate_many_call_trees_v2(directory, config)
-        valid_questions = gen_tree.find_all_valid_chains(trees=trees)
-        invalid_questions = gen_tree.find_all_invalid_chains(trees=trees)
+        # All the trees of the context in one compact store
+        trees, method_names = gen_tree.generate_many_call_trees_v2(directory, config, store=method_tree.CallTree(), names=names)
+        # Valid (distance > 0) and invalid (distance < 0) questions, only the selected ones are formatted
+        candidates = gen_tree.TreeCandidates(trees)
         
-        selection = []
-       
         max_chain_length = max(config.depths)
         
-        for depth in range(max_chain_length + 1):
-            selection.extend(QuestionGenerator.select_questions_by_distance(valid_questions, depth, n_questions))
-            # TODO : see if we can manage to get negative questions for all distances
-            selection.extend(QuestionGenerator.select_questions_by_distance(invalid_questions, -depth, n_questions))
-        
-        distance_dict = self.count_distances(selection)
-    
+        # As many questions for every distance as the rarest distance allows
         min_amount_of_questions = n_questions
-
-        for value in distance_dict.values():
-            if value < min_amount_of_questions:
-                min_amount_of_questions = value
+        
+        for depth in range(max_chain_length + 1):
+            for distance in (depth, -depth):
+                count = candidates.count(distance)
+                if 0 < count < min_amount_of_questions:
+                    min_amount_of_questions = count
 
         selection = []
         
         for depth in range(max_chain_length + 1):
-            selection.extend(QuestionGenerator.select_questions_by_distance(valid_questions, depth, min_amount_of_questions))
-            selection.extend(QuestionGenerator.select_questions_by_distance(invalid_questions, -depth, min_amount_of_questions))
+            selection.extend(candidates.sample(depth, min_amount_of_questions))
+            # TODO : see if we can manage to get negative questions for all distances
+            selection.extend(candidates.sample(-depth, min_amount_of_questions))
     
-        the_class = lang_generator.generate_class_from_multiple_trees(trees=trees, config=config)
+        # Methods of the class, streamed to TheClass and system.txt
+        the_class = lang_generator.stream_class_from_multiple_trees(trees=trees, config=config)
         
         if config.n_if >= 2 or config.n_loops >= 2:
             prompt = prompts.in_context_control_flow_2_tree_calls
@@ -828,21 +809,22 @@ class ExperimentRunner:
 
         # Use language-specific file extension
         class_filename = f"TheClass{lang_generator.get_file_extension()}"
-        self.file_writer.write_class_to_file(the_class, directory / class_filename)
-        self.file_writer.write_prompt_to_file(prompt, the_class, directory / "system.txt")
+        self.file_writer.write_class_and_prompt(prompt, the_class, directory / class_filename, directory / "system.txt")
         self.file_writer.write_questions_to_file(selection, directory / "reachability_questions.txt")
         self.file_writer.write_chains_to_file(selection, directory / "chains.txt", config)
         self.file_writer.write_methods_to_file(method_names, directory / "methods.txt")
         
         return min_amount_of_questions
     
-    def generate_single_tree_context_v3(self, directory:str, config:TreeCallExperimentConfig, n_questions:int = 400) -> int:
+    def generate_single_tree_context_v3(self, directory:str, config:TreeCallExperimentConfig, n_questions:int = 400,
+                                        names: MethodNameAllocator = None) -> int:
         """Generate an experiment with multiple trees and save the class to a file.
 
         Args:
             directory (str): The name of the experiment.
             config (TreeCallExperimentConfig): Configuration for the experiment
             n_questions (int): Max number of questions to generate
+            names (MethodNameAllocator): Allocator of the experiment, a fresh one when None
             
         Returns:
             int: The actual number of questions generated
@@ -850,32 +832,30 @@ class ExperimentRunner:
         lang_generator = LanguageFactory.get_generator(config.language)        
         
         # trees, method_names = gen_tree.generate_many_call_trees(directory, tree_depth, n_trees)
-        trees, method_names = gen_tree.generate_many_call_trees_v3(directory, config)
-        valid_questions = gen_tree.find_all_valid_chains(trees=trees)
-        invalid_questions = gen_tree.find_all_invalid_chains(trees=trees)
+        # All the trees of the context in one compact store
+        trees, method_names = gen_tree.generate_many_call_trees_v3(directory, config, store=method_tree.CallTree(), names=names)
+        # Valid (distance > 0) and invalid (distance < 0) questions, only the selected ones are formatted
+        candidates = gen_tree.TreeCandidates(trees)
         
-        selection = []
         max_chain_length = max(config.depths)
         
-        for depth in range(max_chain_length + 1):
-            selection.extend(QuestionGenerator.select_questions_by_distance(valid_questions, depth, n_questions))
-            selection.extend(QuestionGenerator.select_questions_by_distance(invalid_questions, -depth, n_questions))
-        
-        distance_dict = self.count_distances(selection)
-    
+        # As many questions for every distance as the rarest distance allows
         min_amount_of_questions = n_questions
-
-        for value in distance_dict.values():
-            if value < min_amount_of_questions:
-                min_amount_of_questions = value
+        
+        for depth in range(max_chain_length + 1):
+            for distance in (depth, -depth):
+                count = candidates.count(distance)
+                if 0 < count < min_amount_of_questions:
+                    min_amount_of_questions = count
 
         selection = []
         
         for depth in range(max_chain_length + 1):
-            selection.extend(QuestionGenerator.select_questions_by_distance(valid_questions, depth, min_amount_of_questions))
-            selection.extend(QuestionGenerator.select_questions_by_distance(invalid_questions, -depth, min_amount_of_questions))
+            selection.extend(candidates.sample(depth, min_amount_of_questions))
+            selection.extend(candidates.sample(-depth, min_amount_of_questions))
     
-        the_class = lang_generator.generate_class_from_multiple_trees(trees=trees, config=config)
+        # Methods of the class, streamed to TheClass and system.txt
+        the_class = lang_generator.stream_class_from_multiple_trees(trees=trees, config=config)
         
         if config.n_if >= 2 or config.n_loops >= 2:
             prompt = prompts.in_context_control_flow_2_tree_calls
@@ -889,8 +869,7 @@ class ExperimentRunner:
 
         # Use language-specific file extension
         class_filename = f"TheClass{lang_generator.get_file_extension()}"
-        self.file_writer.write_class_to_file(the_class, directory / class_filename)
-        self.file_writer.write_prompt_to_file(prompt, the_class, directory / "system.txt")
+        self.file_writer.write_class_and_prompt(prompt, the_class, directory / class_filename, directory / "system.txt")
         self.file_writer.write_questions_to_file(selection, directory / "reachability_questions.txt")
         self.file_writer.write_chains_to_file(selection, directory / "chains.txt", config)
         self.file_writer.write_methods_to_file(method_names, directory / "methods.txt")
@@ -899,21 +878,39 @@ class ExperimentRunner:
 
     def generate_experiment(self, config: ExperimentConfig) -> List[Path]:
         """Generate an experiment based on configuration (and its type)"""
-        print(f"Starting experiment with config {config}")
+        print(f"Starting experiment with config {config} (seed {self.seed})")
         # ! If write file stays here the context size will be inaccurate for tree calls
         # ! since context size can only be multiples of 15 for these depths
         # ! To have the updated version, it should be called after generating the experiment
         # TODO: check if that's sorted out, normally it should be already
         if config.type == "linear":
             ret = self.generate_linear_experiment(config)
-            config.write_file(os.path.join(config.name, "config.json"))
-            return ret
         elif config.type == "tree":
             ret = self.generate_tree_experiment(config)
-            config.write_file(os.path.join(config.name, "config.json"))
-            return ret
         else: 
             raise ValueError(f"Unknow experiment type: {config.type}")
+        config.write_file(os.path.join(config.name, "config.json"))
+        self.report_token_counts(config, ret)
+        return ret
+
+    def report_token_counts(self, config: ExperimentConfig, directories: List[Path]) -> None:
+        """Write the token count of each context's system prompt to <experiment>/token_counts.tsv
+
+        Args:
+            config (ExperimentConfig): Configuration of the generated experiment
+            directories (List[Path]): Context directories returned by the generation
+        """
+        if self.token_counter is None:
+            return
+        lines = []
+        for directory in directories:
+            with open(Path(directory) / "system.txt", "r") as f:  # same encoding as write_prompt_to_file
+                n_tokens = self.token_counter(f.read())
+            lines.append(f"{n_tokens}\t{Path(directory).name}\n")
+        with open(Path(config.name) / "token_counts.tsv", "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        counts = [int(line.split("\t")[0]) for line in lines]
+        print(f"Token counts for {config.name}: min {min(counts)}, max {max(counts)}")
         
     
     def generate_linear_experiment(self, config: LinearCallExperimentConfig):
@@ -957,6 +954,9 @@ class ExperimentRunner:
         # And we create new contexts until we have enough questions
         n_questions_left = config.n_questions
         
+        # One allocator for all the contexts: no method name appears in two contexts of the experiment
+        names = self.method_generator.allocator(style=LanguageFactory.get_generator(config.language).get_method_name_style())
+        
         while n_questions_left > 0:
             # Name the experiment sub-directory:
             depth_str = self._format_depths(config.depths)
@@ -982,12 +982,13 @@ class ExperimentRunner:
             chain_generator = lambda c: LanguageGenerator.chain_generator(method_names=c, config=config)
             
             # self.generate_single_linear_context(exp_dir, n_chains_in_context, chain_size, n_qs, chain_generator, config)
-            self.generate_single_linear_context_v2(exp_dir, n_chains_in_context, chain_size, n_qs, config)
+            start = self._start_context(exp_dir)
+            self.generate_single_linear_context_v2(exp_dir, n_chains_in_context, chain_size, n_qs, config, names)
             
             directories.append(exp_dir)
             n_questions_left -= n_chains_in_context
             
-            print(f"Output directory: {exp_dir}")
+            print(f"Output directory: {exp_dir} ({time() - start:.2f}s)")
         
         return directories
     
@@ -1035,6 +1036,9 @@ class ExperimentRunner:
         
         context_counter = 1
         
+        # One allocator for all the contexts (tree names come from generate_chain's words)
+        names = MethodNameAllocator()
+        
         while n_questions_left > 0:
             depth_str = self._format_depths(config.depths)
             exp_dir = base_dir / f"ctx-{config.context_size}_depths-{depth_str}_com-{config.n_comment_lines}_var-{config.n_vars}_loop-{config.n_loops}_if-{config.n_if}_params-{config.n_params}_qs-{context_counter}_{config.language}_tree"
@@ -1042,7 +1046,8 @@ class ExperimentRunner:
             
             # n_questions_generated = self.generate_single_tree_context(exp_dir, n_trees, tree_depth, config, max(config.depths), n_questions_left)
             # n_questions_generated = self.generate_single_tree_context_v2(exp_dir, config, n_questions_left)
-            n_questions_generated = self.generate_single_tree_context_v3(exp_dir, config, n_questions_left)
+            start = self._start_context(exp_dir)
+            n_questions_generated = self.generate_single_tree_context_v3(exp_dir, config, n_questions_left, names)
             n_questions_left -= n_questions_generated
             
             directories.append(exp_dir)
@@ -1052,7 +1057,7 @@ class ExperimentRunner:
 
             context_counter += 1
             
-            print(f"Output directory: {exp_dir}")
+            print(f"Output directory: {exp_dir} ({time() - start:.2f}s)")
         
         return directories
 
@@ -1063,10 +1068,39 @@ class ExperimentRunner:
             return f"{depths[0]}--{depths[-1]}"
         return "_".join(str(d) for d in depths)
 
-    def generate_batch_experiments(self, context_ranges: List[int], n_comments: int,
-                                   n_vars: int, n_loops:int, n_if: int, n_params: int,
-                                   language: str = "java", experiment_type: str = "linear") -> None:
-        """Generate multiple experiments for different context sizes"""
+    def generate_experiments(self, configs: List[ExperimentConfig], n_workers: int = 1) -> List[Path]:
+        """Generate several experiments, in a pool of n_workers processes when n_workers > 1
+
+        Each context is seeded from its directory name and the base seed of the runner (see
+        context_seed), so the files written do not depend on the number of workers.
+        An experiment is a unit of work: its contexts are generated in order by one worker, the
+        number of questions left for a tree context depends on the previous ones.
+
+        Returns:
+            list: Context directories, in the order of the configs
+        """
+        if n_workers <= 1:
+            return [directory for config in configs for directory in self.generate_experiment(config)]
+
+        results = {}
+        start = time()
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_generate_experiment_job, config, self.seed): i for i, config in enumerate(configs)}
+            for done, future in enumerate(as_completed(futures), 1):
+                config, directories, elapsed = future.result()
+                # Token counts are done here, the counter (a loaded tokenizer) stays in this process
+                self.report_token_counts(config, directories)
+                results[futures[future]] = directories
+                print(f"[{done}/{len(configs)}] {config.name}: {len(directories)} contexts in {elapsed:.2f}s "
+                      f"({time() - start:.0f}s elapsed)")
+        return [directory for i in range(len(configs)) for directory in results[i]]
+
+    @staticmethod
+    def batch_configs(context_ranges: List[int], n_comments: int,
+                      n_vars: int, n_loops:int, n_if: int, n_params: int,
+                      language: str = "java", experiment_type: str = "linear") -> List[ExperimentConfig]:
+        """Configs of the experiments of generate_batch_experiments, one per context size"""
+        configs = []
         for context_size in context_ranges:
             if experiment_type == "linear":
                 config = LinearCallExperimentConfig(
@@ -1103,24 +1137,28 @@ class ExperimentRunner:
             if n_if != 0 and n_loops != 0 and n_vars == 0:
                 config.n_vars = 1
             
-            # start_time = time.time()
-            self.generate_experiment(config)
-            # end_time = time.time()
-            
-            # print(f"Experiment {config.name} generated in {end_time - start_time:.2f} seconds")
-            
-            # Commented for debugging purposes
-            """
-            Path('slurms').mkdir(parents=True, exist_ok=True)
+            configs.append(config)
+        return configs
+
+    def generate_batch_experiments(self, context_ranges: List[int], n_comments: int,
+                                   n_vars: int, n_loops:int, n_if: int, n_params: int,
+                                   language: str = "java", experiment_type: str = "linear", n_workers: int = 1) -> None:
+        """Generate multiple experiments for different context sizes"""
+        configs = self.batch_configs(context_ranges, n_comments, n_vars, n_loops, n_if, n_params, language, experiment_type)
+        self.generate_experiments(configs, n_workers)
             
-            self.file_writer.write_slurm_script(
-                f'slurms/{config.name}',
-                config.name,
-                config.time_limit
-            )
-            """
-
-    def generate_all_experiments(self, languages: List[str] = ["java"]) -> None:
+        # Commented for debugging purposes
+        """
+        Path('slurms').mkdir(parents=True, exist_ok=True)
+        
+        self.file_writer.write_slurm_script(
+            f'slurms/{config.name}',
+            config.name,
+            config.time_limit
+        )
+        """
+
+    def generate_all_experiments(self, languages: List[str] = ["java"], n_workers: int = 1) -> None:
         """Generate all predefined experiments for specified languages"""
         # experiment_configs = [
         #     # ([50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500, 600, 700, 800, 900, 1000], 0),
@@ -1158,6 +1196,7 @@ class ExperimentRunner:
         #     ([50, 75, 100], 24, 2, 2, 2, 2),
         # ]
         
+        # Token counts of every context are written to token_counts.tsv when the runner has a token_counter
         experiment_configs = [
             # ([context], comments, vars, loops, if, params)
             ([50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500, 600, 700, 800, 900, 1000], 0, 0, 0, 0, 0),
@@ -1165,39 +1204,47 @@ class ExperimentRunner:
             ([50, 75, 100, 150, 200, 250], 0, 2, 2, 2, 2),
             
             ([50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500, 600, 700, 800, 900, 1000], 2, 0, 0, 0, 0),
-            ([50, 75, 100, 150, 200, 250, 300, 350, 400], 2, 1, 1, 1),
-            ([50, 75, 100, 150, 200, 250], 2, 2, 2, 2),
+            ([50, 75, 100, 150, 200, 250, 300, 350, 400], 2, 1, 1, 1, 1),
+            ([50, 75, 100, 150, 200, 250], 2, 2, 2, 2, 2),
             
             ([50, 75, 100, 150, 200, 250, 300, 350, 400, 450, 500], 4, 0, 0, 0, 0),
             ([50, 75, 100, 150, 200, 250, 300, 350], 4, 1, 1, 1, 1),
             ([50, 75, 100, 150, 200], 4, 2, 2, 2, 2),
             
-            ([50, 75, 100, 150, 200, 250, 300, 350, 400], 7, 0, 0, 0, 0), # token count 95549/96092 for 400 ctx
+            ([50, 75, 100, 150, 200, 250, 300, 350, 400], 7, 0, 0, 0, 0),
             ([50, 75, 100, 150, 200, 250, 300], 7, 1, 1, 1, 1),
             ([50, 75, 100, 150, 200], 7, 2, 2, 2, 2),
             
             ([50, 75, 100, 150, 200], 12, 0, 0, 0, 0),
             ([50, 75, 100, 150, 200], 12, 1, 1, 1, 1),
-            ([50, 75, 100, 150, 200], 12, 2, 2, 2, 2), # token count 99468/100178 for 200 ctx
+            ([50, 75, 100, 150, 200], 12, 2, 2, 2, 2),
             
             ([50, 75, 100], 24, 0, 0, 0, 0),
             ([50, 75, 100], 24, 1, 1, 1, 1),
             ([50, 75, 100], 24, 2, 2, 2, 2),
         ]
         
+        configs = []
         for type in ["linear", "tree"]:
-            print(f"\n=== Generating {type} experiments ===")
             for language in languages:
-                print(f"\n=== Generating experiments for {language.upper()} ===")
                 for context_ranges, n_comments, n_vars, n_loops, n_if, n_params in experiment_configs:
-                    self.generate_batch_experiments(context_ranges=context_ranges,
-                                                    n_comments=n_comments,
-                                                    n_vars=n_vars,
-                                                    n_loops=n_loops,
-                                                    n_if=n_if,
-                                                    n_params=n_params,
-                                                    language=language,
-                                                    experiment_type=type)
+                    configs.extend(self.batch_configs(context_ranges=context_ranges,
+                                                      n_comments=n_comments,
+                                                      n_vars=n_vars,
+                                                      n_loops=n_loops,
+                                                      n_if=n_if,
+                                                      n_params=n_params,
+                                                      language=language,
+                                                      experiment_type=type))
+        print(f"\n=== Generating {len(configs)} experiments ({', '.join(languages)}) with {n_workers} worker(s) ===")
+        self.generate_experiments(configs, n_workers)
+
+
+def _generate_experiment_job(config: ExperimentConfig, seed: int):
+    """Worker of ExperimentRunner.generate_experiments: one experiment, in a fresh runner"""
+    start = time()
+    directories = ExperimentRunner(seed=seed).generate_experiment(config)
+    return config, directories, time() - start
 
 
 # Backward compatibility - keep the original JavaMethodGenerator for existing code
@@ -1207,7 +1254,21 @@ JavaClassGenerator = LanguageFactory.get_generator("java")
 
 # Usage examples
 if __name__ == "__main__":
-    runner = ExperimentRunner()
+    parser = argparse.ArgumentParser(description="Generate the predefined experiments")
+    parser.add_argument("--languages", nargs="+", default=["java"], help="languages to generate (default: java)")
+    parser.add_argument("--workers", type=int, default=1, help="generation processes (default: 1)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="base seed, each context gets a seed derived from it and its config "
+                             "(default: a random base seed, printed at the start of each experiment)")
+    args = parser.parse_args()
+
+    token_counter = None
+    if os.getenv("LLAMA_MODEL"):
+        # The token cache lives with the runners, one directory up
+        sys.path.append(str(Path(__file__).resolve().parent.parent))
+        from token_cache import TokenCounter
+        token_counter = TokenCounter(os.getenv("LLAMA_MODEL"), os.getenv("LLAMA_TOKENIZER"))
+    runner = ExperimentRunner(token_counter=token_counter, seed=args.seed)
     
     # Generate for all supported languages
     supported_languages = LanguageFactory.get_supported_languages()
@@ -1218,7 +1279,7 @@ if __name__ == "__main__":
     # runner.generate_all_experiments(["cpp", "fortran"])
 
     # Or generate for a single language
-    runner.generate_all_experiments(["java"])
+    runner.generate_all_experiments(args.languages, n_workers=args.workers)
     
     # Example of generating a single experiment with custom config
     
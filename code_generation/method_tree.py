@@ -1,8 +1,53 @@
+from array import array
 import copy
+from collections import deque
 from pathlib import Path
 import random
 import control_flow
 
+def method_signature(n_params: int, n_vars: int, return_value: bool=False, parent_variables: list=None) -> tuple:
+    """Draw the parameters, variables and return variable of a new method.
+    
+    Args:
+        n_params (int): Number of parameters, taken from the variables of the caller.
+        n_vars (int): Number of variables defined in the body of the method.
+        return_value (bool, optional): Whether the method returns one of its variables.
+        parent_variables (list[Variable], optional): all_variables of the caller, None for a root.
+        
+    Returns:
+        tuple: params, variables and return variable (None when the method returns void).
+    """
+    # Params
+    # ! Be careful with building that at init, parents might get added later
+    # ! atm there is no issue with that, but it might break in the future
+    if parent_variables is None:
+        # We can't have parameters if it's the root
+        params = []
+        # But we have to have at least the same amount of variable as of parameters if the other methods have parameters
+        if n_vars < n_params:
+            n_vars = n_params
+            
+        # params = control_flow.random_variables(n_params)
+    else:
+        params = control_flow.choose_n_vars(n_params, parent_variables)
+        control_flow.rename_vars(params)
+    
+    # Get names of all param variables to avoid duplication
+    param_names = {var.name for var in params}
+    
+    # Variables
+    variables = []
+    
+    while len(variables) < n_vars:
+        additional_vars = control_flow.random_variables(n_vars - len(variables))
+        variables.extend([var for var in additional_vars if var.name not in param_names and var.name not in {v.name for v in variables}])
+    
+    # Return
+    tmp_return = control_flow.choose_n_vars(0, variables + params) # ! Fix when necessary
+    if tmp_return and return_value:
+        return params, variables, tmp_return[0]
+    return params, variables, None
+
 class Node:
     """
     A class representing a node in a binary tree.
@@ -42,44 +87,12 @@ class Node:
             path = []
         self.path = path.copy()
             
-        # Params
-        # ! Be careful with building that at init, parents might get added later
-        # ! atm there is no issue with that, but it might break in the future
-        if parent is None:
-            # We can't have parameters if it's the root
-            self.params = []
-            # But we have to have at least the same amount of variable as of parameters if the other methods have parameters
-            if n_vars < n_params:
-                n_vars = n_params
-                
-            # self.params = control_flow.random_variables(n_params)
-        else:
-            self.params = control_flow.choose_n_vars(n_params, parent.all_variables)
-            control_flow.rename_vars(self.params)
-        
-        # Get names of all param variables to avoid duplication
-        param_names = {var.name for var in self.params}
-        
-        # Variables
-        self.variables = []
-        
-        while len(self.variables) < n_vars:
-            additional_vars = control_flow.random_variables(n_vars - len(self.variables))
-            self.variables.extend([var for var in additional_vars if var.name not in param_names and var.name not in {v.name for v in self.variables}])
-        
+        self.params, self.variables, self.return_variable = method_signature(
+            n_params, n_vars, return_value, None if parent is None else parent.all_variables)
         self.all_variables = self.variables + self.params # Add parameters to the list of variables
         self.var_types = [var.var_type for var in self.all_variables]
+        self.return_type = self.return_variable.var_type if self.return_variable else "void"
         
-        # Return
-        tmp_return = control_flow.choose_n_vars(0, self.all_variables) # ! Fix when necessary
-        if tmp_return and return_value:
-            self.return_variable = tmp_return[0]
-            self.return_type = self.return_variable.var_type
-        else:
-            self.return_variable = None
-            self.return_type = "void"
-        
-            
     def __str__(self):
         parent_name = self.parent.name if self.parent else "None"
         left_name = self.left.name if self.left else "None"
@@ -101,13 +114,8 @@ class Node:
 
     def print_tree(self, indent: str = ""):
         """Prints the subtree to the standard output"""
-        if self is None:
-            return
-        print(indent + self.name)
-        if self.left:
-            self.left.print_tree(indent + "   L- ")
-        if self.right:
-            self.right.print_tree(indent + "   R- ")
+        for line in tree_lines(self, indent):
+            print(line)
 
     def write_tree_to_file(self, file_path: str):
         """Write the subtree to a file"""
@@ -115,44 +123,43 @@ class Node:
         path.parent.mkdir(parents=True, exist_ok=True)
         
         """Write the tree structure to a file in a readable format."""
-        def write_node(node, indent=""):
-            if node is None:
-                return
-            f.write(indent + node.name + "\n")
-            write_node(node.left, indent + "   L- ")
-            write_node(node.right, indent + "   R- ")
-            
         with open(file_path, 'w') as f:
-            write_node(self)
+            for line in tree_lines(self):
+                f.write(line + "\n")
     
-    def get_height(self, height: int = 0) -> int:
+    def get_height(self) -> int:
         """Get the height of the node"""
-        if self.parent is None:
-            return height
-        return self.parent.get_height(height=height+1)
+        height = 0
+        node = self.parent
+        while node is not None:
+            height += 1
+            node = node.parent
+        return height
     
-    def get_relative_height(self, relative_parent: "Node", height: int = 0) -> int:
+    def get_relative_height(self, relative_parent: "Node") -> int:
         """Get the height-distance of the node from its relative parent"""
-        if self == relative_parent:
-            return height
-        return self.parent.get_relative_height(relative_parent, height+1)
+        height = 0
+        node = self
+        while node != relative_parent:
+            height += 1
+            node = node.parent
+        return height
             
     def get_subtree_size(self):
         """Get the size of the subtree"""
-        size = 1
-        if self.left is not None:
-            size += self.left.get_subtree_size()
-        if self.right is not None:
-            size += self.right.get_subtree_size()
-        return size
+        return len(self.get_list_of_nodes())
     
     def get_list_of_nodes(self):
-        """Get the list of nodes of the subtree"""
-        nodes = [self]
-        if self.left is not None:
-            nodes.extend(self.left.get_list_of_nodes())
-        if self.right is not None:
-            nodes.extend(self.right.get_list_of_nodes())
+        """Get the list of nodes of the subtree (preorder)"""
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
         return nodes
     
     def get_method_names(self):
@@ -163,7 +170,223 @@ class Node:
     def get_number_of_variables(self):
         """Get the number of variables defined/used in the method."""
         return len(self.all_variables)
-                    
+
+
+def tree_lines(node: Node, indent: str = "") -> list[str]:
+    """Lines of the readable dump of a subtree: one method per line, children prefixed by L-/R-."""
+    lines = []
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        lines.append(indent + node.name)
+        if node.right is not None:
+            stack.append((node.right, indent + "   R- "))
+        if node.left is not None:
+            stack.append((node.left, indent + "   L- "))
+    return lines
+
+
+""" Compact tree store """
+
+class CallTree:
+    """
+    Array-backed store of call trees, an alternative to linked Node objects for large contexts.
+    A method is an index: parent/left/right links are parallel integer arrays (-1 when there is
+    none), names are interned and the path of a node is packed in an int (bit i set when the
+    i-th step goes right). Several trees can share one store.
+    
+    The builders and emitters work on TreeNode views of the store (store= argument of the builders),
+    traversals run on the arrays without recursion.
+    """
+    def __init__(self):
+        self.parent = array("i")
+        self.left = array("i")
+        self.right = array("i")
+        self.name_id = array("i")
+        self.path_len = array("i")
+        self.path_bits = []
+        self.names = []
+        self.name_ids = {}
+        # Variables of the methods, None when a method has none
+        self.params = []
+        self.variables = []
+        self.return_variable = []
+    
+    def __len__(self):
+        return len(self.parent)
+    
+    def intern(self, name: str) -> int:
+        """Id of a method name, added to the names of the store if it is new."""
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+    
+    def add_node(self, name: str, n_params: int=0, n_vars: int=0, return_value: bool=False,
+                 path: list[str]=None, parent: "TreeNode"=None) -> "TreeNode":
+        """Add a method, same arguments as Node (the parent must be a view of this store)."""
+        if parent is not None and parent.tree is not self:
+            raise ValueError(f"Parent {parent.name} belongs to another store")
+        index = len(self.parent)
+        
+        params, variables, return_variable = method_signature(
+            n_params, n_vars, return_value, None if parent is None else parent.all_variables)
+        
+        path = path or []
+        bits = 0
+        for step, direction in enumerate(path):
+            if direction == "right":
+                bits |= 1 << step
+        
+        self.parent.append(-1 if parent is None else parent.index)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.name_id.append(self.intern(name))
+        self.path_len.append(len(path))
+        self.path_bits.append(bits)
+        self.params.append(params or None)
+        self.variables.append(variables or None)
+        self.return_variable.append(return_variable)
+        return TreeNode(self, index)
+    
+    def node(self, index: int) -> "TreeNode":
+        """View of a method, None for -1."""
+        return None if index < 0 else TreeNode(self, index)
+    
+    def name(self, index: int) -> str:
+        return self.names[self.name_id[index]]
+    
+    def path(self, index: int) -> list[str]:
+        bits = self.path_bits[index]
+        return ["right" if bits >> step & 1 else "left" for step in range(self.path_len[index])]
+    
+    def preorder(self, index: int) -> list[int]:
+        """Indices of the subtree of a method in depth-first order (the order of the emitters)."""
+        left, right = self.left, self.right
+        order = []
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            if right[i] >= 0:
+                stack.append(right[i])
+            if left[i] >= 0:
+                stack.append(left[i])
+        return order
+    
+    def depth(self, index: int, ancestor: int = -1) -> int:
+        """Number of calls from ancestor (the root by default) down to the method."""
+        parent = self.parent
+        depth = 0
+        while index != ancestor:
+            index = parent[index]
+            if index < 0 and ancestor >= 0:
+                raise ValueError(f"{self.name(ancestor)} is not an ancestor")
+            depth += 1
+        return depth - 1 if ancestor < 0 else depth
+    
+    def nbytes(self) -> int:
+        """Size of the link, name and path arrays (variables not included)."""
+        arrays = (self.parent, self.left, self.right, self.name_id, self.path_len)
+        return sum(a.itemsize * len(a) for a in arrays) + sum(b.bit_length() // 8 + 1 for b in self.path_bits)
+
+
+class TreeNode(Node):
+    """
+    Node-like view of a method of a CallTree: same attributes and methods as Node, read from
+    (and links written to) the arrays of the store. Views are created on the fly, two views
+    of the same method are equal.
+    """
+    __slots__ = ("tree", "index")
+    
+    def __init__(self, tree: CallTree, index: int):
+        self.tree = tree
+        self.index = index
+    
+    def __eq__(self, other):
+        return isinstance(other, TreeNode) and other.tree is self.tree and other.index == self.index
+    
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+    
+    def __repr__(self):
+        return f"TreeNode({self.name}, index={self.index})"
+    
+    def _link(self, links: array, child: "TreeNode"):
+        if child is not None and child.tree is not self.tree:
+            raise ValueError(f"{child.name} belongs to another store")
+        links[self.index] = -1 if child is None else child.index
+    
+    @property
+    def name(self) -> str:
+        return self.tree.name(self.index)
+    
+    @property
+    def parent(self) -> "TreeNode":
+        return self.tree.node(self.tree.parent[self.index])
+    
+    @property
+    def left(self) -> "TreeNode":
+        return self.tree.node(self.tree.left[self.index])
+    
+    @left.setter
+    def left(self, child: "TreeNode"):
+        self._link(self.tree.left, child)
+    
+    @property
+    def right(self) -> "TreeNode":
+        return self.tree.node(self.tree.right[self.index])
+    
+    @right.setter
+    def right(self, child: "TreeNode"):
+        self._link(self.tree.right, child)
+    
+    @property
+    def path(self) -> list[str]:
+        return self.tree.path(self.index)
+    
+    @property
+    def params(self) -> list:
+        return self.tree.params[self.index] or []
+    
+    @property
+    def variables(self) -> list:
+        return self.tree.variables[self.index] or []
+    
+    @property
+    def all_variables(self) -> list:
+        return self.variables + self.params
+    
+    @property
+    def var_types(self) -> list[str]:
+        return [var.var_type for var in self.all_variables]
+    
+    @property
+    def return_variable(self):
+        return self.tree.return_variable[self.index]
+    
+    @property
+    def return_type(self) -> str:
+        return_variable = self.return_variable
+        return return_variable.var_type if return_variable else "void"
+    
+    def get_height(self) -> int:
+        return self.tree.depth(self.index)
+    
+    def get_relative_height(self, relative_parent: "TreeNode") -> int:
+        return self.tree.depth(self.index, relative_parent.index)
+    
+    def get_subtree_size(self):
+        return len(self.tree.preorder(self.index))
+    
+    def get_list_of_nodes(self):
+        return [TreeNode(self.tree, i) for i in self.tree.preorder(self.index)]
+    
+    def get_method_names(self):
+        return [self.tree.name(i) for i in self.tree.preorder(self.index)]
+    
+
 def write_trees_to_files(trees: list, dir: str):
     """Write individual tree files and a cumulative file."""
     Path(f"{dir}/tree_structures").mkdir(parents=True, exist_ok=True)
@@ -180,8 +403,28 @@ def write_trees_to_files(trees: list, dir: str):
 
 """ Tree generation functions """
 
-def build_binary_tree(depth: int, method_names: list[str], direction: str=None, parent: Node = None, n_params: int=0, n_vars: int=0
-                      ) -> Node:
+def take_method_name(method_names) -> str:
+    """Next name of the pool, the builders consume it from the front.
+
+    Pools are lists or deques: popping the front of a list moves all the names left,
+    with a deque of thousands of names (generate_many_call_trees_v2/v3) it is O(1).
+    """
+    if isinstance(method_names, deque):
+        return method_names.popleft()
+    return method_names.pop(0)
+
+def make_node(name: str, n_params: int=0, n_vars: int=0, path: list[str]=None, parent: Node=None,
+             store: CallTree=None) -> Node:
+    """Node of a builder: in the store of its parent when it is a TreeNode, in `store` for a
+    root, a linked Node otherwise."""
+    if isinstance(parent, TreeNode):
+        store = parent.tree
+    if store is not None:
+        return store.add_node(name, n_params=n_params, n_vars=n_vars, path=path, parent=parent)
+    return Node(name=name, n_params=n_params, n_vars=n_vars, path=path, parent=parent)
+
+def build_binary_tree(depth: int, method_names: list[str], direction: str=None, parent: Node = None, n_params: int=0, n_vars: int=0,
+                      store: CallTree = None) -> Node:
     """Build a binary tree from a list of method names.
 
     Args:
@@ -191,6 +434,7 @@ def build_binary_tree(depth: int, method_names: list[str], direction: str=None,
         parent (Node, optional): The parent node of the current node. Defaults to None.
         n_params (int, optional): Number of parameters per function. Defaults to 0.
         n_vars (int, optional): Number of variables per function. Defaults to 0.
+        store (CallTree, optional): Store to build the tree in, linked Nodes when None.
         
     Returns:
         Node: The root of the binary tree.
@@ -205,7 +449,7 @@ def build_binary_tree(depth: int, method_names: list[str], direction: str=None,
         path = []
 
     # Pop the current method name
-    node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, path=path, parent=parent)
+    node = make_node(take_method_name(method_names), n_params, n_vars, path, parent, store)
 
     # Build left and right subtrees, consuming names in-place
     node.left = build_binary_tree(depth - 1, method_names, "left", node, n_params, n_vars)
@@ -221,7 +465,8 @@ def build_jellyfish_tree(k_depth: int,
                          direction: str=None, 
                          n_params: int=0,
                          n_vars: int=0,
-                         shape: list=["left", "right"]
+                         shape: list=["left", "right"],
+                         store: CallTree = None
                          ) -> Node:
     """Build a jellyfish tree from a list of method names.
 
@@ -235,6 +480,7 @@ def build_jellyfish_tree(k_depth: int,
         n_params (int, optional): Number of parameters per function. Defaults to 0.
         n_vars (int, optional): Number of variables per function. Defaults to 0.
         shape (list, optional): Describes the shape of the comb parts of the tree. Defaults to ["left", "right"].
+        store (CallTree, optional): Store to build the tree in, linked Nodes when None.
 
     Returns:
         Node: The root of the binary tree
@@ -242,7 +488,7 @@ def build_jellyfish_tree(k_depth: int,
     comb_depth = max_distance//2 + 2
     
     # First we build the base of the jellyfish (ie. a complete balanced binary tree)
-    root = build_binary_tree(depth=k_depth, method_names=method_names, n_params=n_params, n_vars=n_vars)
+    root = build_binary_tree(depth=k_depth, method_names=method_names, n_params=n_params, n_vars=n_vars, store=store)
     
     # Then we build the comb parts of the tree
     current_node = root
@@ -280,7 +526,7 @@ def build_jellyfish_tree(k_depth: int,
         else:
             path = []
         # Create the new node
-        node = Node(method_names.pop(0), n_params, n_vars, path, parent)
+        node = Node(take_method_name(method_names), n_params, n_vars, path, parent)
         
         # If it's the extreme left/right bottom node of the complete part of the tree
         # We insert the comb parts of the tree
@@ -306,7 +552,8 @@ def build_double_comb(max_distance: int,
                       n_params: int = 0,
                       n_vars: int = 0,
                       parent: Node = None,
-                      shape: list[str] = ["left", "right"]):
+                      shape: list[str] = ["left", "right"],
+                      store: CallTree = None):
     """Build an double comb binary tree from a list of method names.
 
     Args:
@@ -316,6 +563,7 @@ def build_double_comb(max_distance: int,
         n_vars (int, optional): Number of variables per function. Defaults to 0.
         parent (Node, optional): Parent node to link the double comb with.
         shape (list, optional): Describes the shape of the comb parts of the tree. Defaults to ["left", "right"].
+        store (CallTree, optional): Store to build the tree in, linked Nodes when None.
         
     Returns:
         Node: The root of the double comb binary tree.
@@ -328,7 +576,7 @@ def build_double_comb(max_distance: int,
     if parent is not None:
         root = parent
     else:
-        root = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars)
+        root = make_node(take_method_name(method_names), n_params, n_vars, store=store)
     
     setattr(root, shape[0], build_comb_tree(comb_depth, max_distance, method_names, n_params, n_vars, root, shape))
     setattr(root, shape[1], build_near_comb_tree(comb_depth, max_distance, method_names, n_params, n_vars, root, shape))
@@ -341,7 +589,8 @@ def build_comb_tree(depth: int,
                     n_params: int=0, 
                     n_vars: int=0, 
                     parent: Node=None,
-                    shape: list=["left", "right"]
+                    shape: list=["left", "right"],
+                    store: CallTree=None
                     ) -> Node:
     """Build a comb binary tree from a list of method names.
 
@@ -353,6 +602,7 @@ def build_comb_tree(depth: int,
         n_vars (int, optional): Number of variables per function. Defaults to 0.
         parent (Node, optional): Parent node to link the comb with.
         shape (list, optional): Describes the shape of the comb parts of the tree. Defaults to ["left", "right"].
+        store (CallTree, optional): Store to build the tree in when there is no parent, linked Nodes when None.
         
     Returns:
         Node: The root of the comb binary tree.
@@ -362,7 +612,7 @@ def build_comb_tree(depth: int,
     
     
     current_index = 0
-    root = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=parent)
+    root = make_node(take_method_name(method_names), n_params, n_vars, parent=parent, store=store)
     current_index += 1
     current_node = root
     
@@ -372,7 +622,7 @@ def build_comb_tree(depth: int,
         if not method_names:
             return root
         
-        new_node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=current_node)
+        new_node = make_node(take_method_name(method_names), n_params, n_vars, parent=current_node)
         setattr(current_node, shape[0], new_node) 
         current_index += 1
         current_node = getattr(current_node, shape[0])
@@ -383,7 +633,7 @@ def build_comb_tree(depth: int,
         if not method_names:
             return root
         
-        new_node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=current_node)
+        new_node = make_node(take_method_name(method_names), n_params, n_vars, parent=current_node)
         setattr(current_node, shape[1], new_node)
         current_index += 1
         current_node = current_node.parent
@@ -402,7 +652,8 @@ def build_near_comb_tree(depth: int,
                         n_params: int=0, 
                         n_vars: int=0, 
                         parent: Node=None,
-                        shape: list=["left", "right"]
+                        shape: list=["left", "right"],
+                        store: CallTree=None
                         ) -> Node:
     """Build an near comb binary tree from a list of method names.
 
@@ -414,6 +665,7 @@ def build_near_comb_tree(depth: int,
         n_vars (int): Number of variables to include for each method node.
         parent (Node, optional): Parent node to link the near comb with.
         shape (list, optional): Describes the shape of the comb parts of the tree. Defaults to ["left", "right"].
+        store (CallTree, optional): Store to build the tree in when there is no parent, linked Nodes when None.
         
     Returns:
         Node: The root of the near comb binary tree.
@@ -422,7 +674,7 @@ def build_near_comb_tree(depth: int,
         return
     
     current_index = 0
-    root = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=parent)
+    root = make_node(take_method_name(method_names), n_params, n_vars, parent=parent, store=store)
     current_index += 1
     current_node = root
     
@@ -432,7 +684,7 @@ def build_near_comb_tree(depth: int,
         if not method_names:
             return root
     
-        new_node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=current_node)
+        new_node = make_node(take_method_name(method_names), n_params, n_vars, parent=current_node)
         setattr(current_node, shape[0], new_node)
         current_index += 1
         current_node = getattr(current_node, shape[0])
@@ -445,7 +697,7 @@ def build_near_comb_tree(depth: int,
         if not method_names:
             return root
         
-        new_node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, parent=current_node)
+        new_node = make_node(take_method_name(method_names), n_params, n_vars, parent=current_node)
         setattr(current_node, shape[1], new_node)
         current_index += 1
         current_node = current_node.parent
@@ -455,7 +707,7 @@ def build_near_comb_tree(depth: int,
     
     return root
 
-def build_unbalanced_binary_tree(max_distance: int, method_names: list, n_params: int=0, n_vars: int=0) -> Node:
+def build_unbalanced_binary_tree(max_distance: int, method_names: list, n_params: int=0, n_vars: int=0, store: CallTree=None) -> Node:
     """Build an unbalanced binary tree from a list of method names.
 
     Args:
@@ -463,6 +715,7 @@ def build_unbalanced_binary_tree(max_distance: int, method_names: list, n_params
         method_names (list): A list of method names to be used as node names in the tree.
         n_params (int, optional): Number of parameters per function. Defaults to 0.
         n_vars (int, optional): Number of variables per function. Defaults to 0.
+        store (CallTree, optional): Store to build the tree in, linked Nodes when None.
         
     Returns:
         Node: The root of the binary tree.
@@ -471,7 +724,7 @@ def build_unbalanced_binary_tree(max_distance: int, method_names: list, n_params
         return
     
     depth = max_distance
-    root = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars)
+    root = make_node(take_method_name(method_names), n_params, n_vars, store=store)
     
     build_left_branch(root, depth, method_names, n_params=n_params, n_vars=n_vars)
     
@@ -488,13 +741,14 @@ def build_left_branch(root: Node, depth: int, method_names: list, n_params: int=
         n_params (int): Number of parameters to include for each method node.
         n_vars (int): Number of variables to include for each method node.
     """
-    if (depth is not None and depth < 0) or not method_names: 
-        return
-
-    root.left = Node(name=method_names.pop(0), parent=root, n_params=n_params, n_vars=n_vars)
-    build_left_branch(root.left, depth-1 if depth is not None else depth, method_names, n_params=n_params, n_vars=n_vars)
-
-def build_branch(method_names: list, n_params: int=0, n_vars: int=0) -> Node:
+    # Iterative, a branch of a long linear chain is deeper than the recursion limit
+    while (depth is None or depth >= 0) and method_names:
+        root.left = make_node(take_method_name(method_names), n_params, n_vars, parent=root)
+        root = root.left
+        if depth is not None:
+            depth -= 1
+
+def build_branch(method_names: list, n_params: int=0, n_vars: int=0, store: CallTree=None) -> Node:
     """
     Build a branch. Used for linear tree calls.
     
@@ -503,11 +757,12 @@ def build_branch(method_names: list, n_params: int=0, n_vars: int=0) -> Node:
         method_names (list): A list of method names to be used as node names in the tree.
         n_params (int): Number of parameters to include for each method node.
         n_vars (int): Number of variables to include for each method node.
+        store (CallTree, optional): Store to build the branch in, linked Nodes when None.
     
     Returns:
         Node: The root of the branch
     """
-    root = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars)
+    root = make_node(take_method_name(method_names), n_params, n_vars, store=store)
     build_left_branch(root, None, method_names, n_params, n_vars)
     return root
 
@@ -537,7 +792,8 @@ def build_diamond_tree(method_names: list,
                         direction: str=None, 
                         n_params: int=0, 
                         n_vars: int=0, 
-                        parent: Node=None
+                        parent: Node=None,
+                        store: CallTree=None
                         ) -> Node:
     """
     Build a tree shaped like a diamond (broad at half height)
@@ -547,6 +803,7 @@ def build_diamond_tree(method_names: list,
         max_distance (int): The maximum distance for which we wish to ask negative questions.
         n_params (int): Number of parameters to include for each method node.
         n_vars (int): Number of variables to include for each method node.
+        store (CallTree, optional): Store to build the tree in, linked Nodes when None.
         
     Returns:
         Node: The root of the tree
@@ -562,7 +819,7 @@ def build_diamond_tree(method_names: list,
         path.append(direction)
     else:
         path = []
-    node = Node(name=method_names.pop(0), n_params=n_params, n_vars=n_vars, path=path, parent=parent)
+    node = make_node(take_method_name(method_names), n_params, n_vars, path, parent, store)
     
     node.left = build_diamond_tree(method_names, max_distance, "left", n_params, n_vars, node)
     if parent and (parent.path.count("left") % 2 == 0 and parent.path.count("right") % 2 == 0):
@@ -584,31 +841,13 @@ def depth_first_traversal(node: Node) -> tuple[list[str], int, int, int]:
         tuple[list[str], int, int, int]: List of method names, size of subtree, size of subtree with backtracking, relative height. 
     """
     
-    method_names = []
-    counter = -1
-    counter_with_backtracking = -1
-    node_traversal = node
-    
-    def dft_rec(current_node: Node):
-        nonlocal counter, counter_with_backtracking, node_traversal
-        if current_node is None:
-            return
-        
-        method_names.append(current_node.name)
-        counter += 1
-        counter_with_backtracking += 1
-        node_traversal = current_node
-        
-        dft_rec(current_node.left)
-        if current_node.left is not None:
-            counter_with_backtracking += 1
-        
-        dft_rec(current_node.right)
-        if current_node.right is not None:
-            counter_with_backtracking += 1
-        
-
-    dft_rec(node)
+    # Iterative: every method is visited once and every call is walked down and back up,
+    # except those leading to the last visited method
+    nodes = node.get_list_of_nodes()
+    method_names = [current_node.name for current_node in nodes]
+    counter = len(nodes) - 1
+    counter_with_backtracking = 2 * counter
+    node_traversal = nodes[-1]
     
     relative_height = node_traversal.get_relative_height(node)
     
@@ -808,6 +1047,127 @@ def find_list_of_unreachable_methods(node: Node, root: Node) -> list:
     return unreachable_methods
 
 
+""" Reachability index """
+
+class ReachabilityIndex:
+    """
+    Euler tour of one call tree, answers the chain questions without searching the tree again.
+    Methods are designated by their preorder rank (the order of depth_first_search), the subtree
+    of a method is then the interval [rank, rank + size) and, for a descendant d of a:
+    
+    - distance = rank[d] - rank[a] (methods visited before d)
+    - distance_height = depth[d] - depth[a]
+    - distance_with_backtracking = 2 * distance - distance_height (every call visited before d
+      is walked down and back up, except those leading to d)
+    
+    Same values as depth_first_search / depth_first_traversal, see valid_chains and invalid_chains.
+    
+    Attributes:
+        nodes (list[Node]): Methods in preorder.
+        names (list[str]): Their names.
+        depth (list[int]): Depth of each method from the root.
+        entry, exit (list[int]): Euler tour times at which each method is entered and left.
+        ranks (dict): Preorder rank of each node.
+    """
+    def __init__(self, root: Node):
+        self.nodes = []
+        self.names = []
+        self.depth = []
+        self.entry = []
+        self.exit = []
+        
+        time = 0
+        stack = [(root, 0, -1)]
+        while stack:
+            node, depth, rank = stack.pop()
+            if node is None:
+                # Every method of the subtree of rank has been visited
+                self.exit[rank] = time
+                time += 1
+                continue
+            rank = len(self.nodes)
+            self.nodes.append(node)
+            self.names.append(node.name)
+            self.depth.append(depth)
+            self.entry.append(time)
+            self.exit.append(-1)
+            time += 1
+            stack.append((None, depth, rank))
+            if node.right is not None:
+                stack.append((node.right, depth + 1, -1))
+            if node.left is not None:
+                stack.append((node.left, depth + 1, -1))
+        
+        self.ranks = {node: rank for rank, node in enumerate(self.nodes)}
+    
+    def __len__(self):
+        return len(self.nodes)
+    
+    def size(self, a: int) -> int:
+        """Number of methods of the subtree of a (entered and left once each in the tour)."""
+        return (self.exit[a] - self.entry[a] + 1) // 2
+    
+    def is_reachable(self, a: int, d: int) -> bool:
+        """Whether a calls d, directly or indirectly."""
+        return a != d and self.entry[a] < self.entry[d] and self.exit[d] < self.exit[a]
+    
+    def distance(self, a: int, d: int) -> int:
+        return d - a
+    
+    def distance_height(self, a: int, d: int) -> int:
+        return self.depth[d] - self.depth[a]
+    
+    def distance_with_backtracking(self, a: int, d: int) -> int:
+        return 2 * (d - a) - (self.depth[d] - self.depth[a])
+    
+    def chain(self, a: int, d: int) -> list[str]:
+        """Methods visited from a until d is found."""
+        return self.names[a:d + 1]
+    
+    def unreachable(self, a: int) -> list[str]:
+        """Methods a does not call: complement of its subtree interval, in preorder."""
+        return self.names[:a] + self.names[a + self.size(a):]
+    
+    def traversal(self, a: int) -> tuple[list[str], int, int, int]:
+        """Same as depth_first_traversal of the method of rank a."""
+        end = a + self.size(a)
+        distance = end - 1 - a
+        height = self.depth[end - 1] - self.depth[a]
+        return self.names[a:end], distance, 2 * distance - height, height
+    
+    def valid_chains(self) -> list[dict]:
+        """Same chains, in the same order, as find_all_valid_chains_depth_first."""
+        names, depth = self.names, self.depth
+        chains = []
+        for a in range(len(names)):
+            for d in range(a + 1, a + self.size(a)):
+                height = depth[d] - depth[a]
+                chains.append({
+                    "chain": names[a:d + 1],
+                    "distance": d - a,
+                    "distance_with_backtracking": 2 * (d - a) - height,
+                    "distance_height": height,
+                })
+        return chains
+    
+    def invalid_chains(self) -> list[dict]:
+        """Same chains, in the same order, as find_all_invalid_chains_depth_first."""
+        chains = []
+        # The root reaches every method of its tree
+        for a in range(1, len(self.names)):
+            chain, distance, distance_with_backtracking, height = self.traversal(a)
+            if distance != 0:
+                chains.append({
+                    "node": self.names[a],
+                    "unreachable_methods": self.unreachable(a),
+                    "distance": -distance,
+                    "distance_with_backtracking": -distance_with_backtracking,
+                    "distance_height": height,
+                    "chain": chain
+                })
+        return chains
+
+
 
 
 # Build a binary tree with a depth of 3 and method names
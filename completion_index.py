@@ -0,0 +1,125 @@
+import hashlib
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_PATH = "completion_index.sqlite"
+
+
+def prompt_hash(system_prompt: str, question: str) -> str:
+    """Hash identifying the exact prompt a question was asked with."""
+    h = hashlib.sha256()
+    h.update(system_prompt.encode("utf-8"))
+    h.update(b"\0")
+    h.update(question.encode("utf-8"))
+    return h.hexdigest()
+
+
+def parse_results_seq_ids(results_path) -> set[int]:
+    """Sequence ids already written in a results.txt ([Q<id>] blocks)."""
+    path = pathlib.Path(results_path)
+    if not path.exists():
+        return set()
+    content = path.read_text(encoding="utf-8", errors="replace")
+    return {int(m.group(1)) for m in re.finditer(r'^\[Q\s*(\d+)\]', content, re.MULTILINE)}
+
+
+def set_journal_mode(conn, journal_mode: str):
+    """Set the journal mode of a SQLite file, it cannot leave WAL while another process has it open."""
+    try:
+        mode = conn.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+    except sqlite3.OperationalError as e:
+        mode = str(e)
+    if mode.lower() != journal_mode.lower():
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        raise RuntimeError(f"Cannot open {path} with journal_mode={journal_mode} ({mode}), "
+                           f"close the other runners using it first")
+
+
+class CompletionIndex:
+    """
+    Persistent record of answered questions, keyed by experiment directory, model,
+    seq_id and the hash of system prompt + question. Runners consult it to skip
+    finished work and mark each question once its answer has been written, so a
+    job killed at the time limit resumes where it stopped.
+
+    WAL (the default) needs the processes to share memory, i.e. to run on the same
+    machine; an index shared by the workers of several nodes (work_queue.py) is
+    opened with journal_mode="DELETE", like the queue itself.
+    """
+
+    def __init__(self, path=None, journal_mode: str = "WAL"):
+        self.path = str(path or os.getenv("REACHABILITY_INDEX", DEFAULT_INDEX_PATH))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        try:
+            set_journal_mode(self.conn, journal_mode)
+        except RuntimeError:
+            self.conn.close()
+            raise
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " exp_dir TEXT, model TEXT, seq_id INTEGER, prompt_hash TEXT, completed_at REAL,"
+                " PRIMARY KEY (exp_dir, model, seq_id, prompt_hash))"
+            )
+
+    @staticmethod
+    def _dir_key(exp_dir) -> str:
+        return str(pathlib.Path(exp_dir).resolve())
+
+    def is_done(self, exp_dir, model: str, seq_id: int, system_prompt: str, question: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM completions WHERE exp_dir=? AND model=? AND seq_id=? AND prompt_hash=?",
+                (self._dir_key(exp_dir), model, seq_id, prompt_hash(system_prompt, question))
+            ).fetchone()
+        return row is not None
+
+    def done_seq_ids(self, exp_dir, model: str, system_prompt: str, questions) -> set[int]:
+        """Subset of the (seq_id, question) pairs that were already answered with this exact prompt."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT seq_id, prompt_hash FROM completions WHERE exp_dir=? AND model=?",
+                (self._dir_key(exp_dir), model)
+            ).fetchall()
+        done = set(rows)
+        return {seq_id for seq_id, question in questions if (seq_id, prompt_hash(system_prompt, question)) in done}
+
+    def pending(self, exp_dir, model: str, system_prompt: str, questions) -> list:
+        """Keep the (seq_id, distances, question) tuples that still have to be asked."""
+        done = self.done_seq_ids(exp_dir, model, system_prompt, [(q[0], q[-1]) for q in questions])
+        if done:
+            print(f"Resuming {exp_dir}: {len(done)} of {len(questions)} questions already answered by {model}")
+        return [q for q in questions if q[0] not in done]
+
+    def mark_done(self, exp_dir, model: str, seq_id: int, system_prompt: str, question: str):
+        """Record a completed question, to be called once its answer is on disk."""
+        self.mark_many_done(exp_dir, model, system_prompt, [(seq_id, question)])
+
+    def mark_many_done(self, exp_dir, model: str, system_prompt: str, questions):
+        """Record several (seq_id, question) pairs in a single transaction."""
+        now = time.time()
+        key = self._dir_key(exp_dir)
+        rows = [(key, model, seq_id, prompt_hash(system_prompt, question), now) for seq_id, question in questions]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?, ?)", rows)
+
+    def ingest_results_file(self, exp_dir, model: str, results_path, system_prompt: str, questions) -> int:
+        """
+        Mark as done every question already present in a results.txt, e.g. the one
+        written by the C++ binary or by a run started before the index existed.
+
+        Returns:
+            int: number of questions found in the file.
+        """
+        found = parse_results_seq_ids(results_path)
+        answered = [(seq_id, question) for seq_id, question in questions if seq_id in found]
+        self.mark_many_done(exp_dir, model, system_prompt, answered)
+        return len(answered)
+
+    def close(self):
+        self.conn.close()
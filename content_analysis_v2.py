@@ -7,6 +7,8 @@ from collections import defaultdict
 import shutil
 from typing import List
 
+from result_writer import format_result, read_results
+
 
 """ Utils functions """
 
@@ -152,10 +154,28 @@ def find_first_match(lst: list, target: str):
 
 """ File extraction function """
 
+def split_result_records(directory: Path, records: list) -> list[Path]:
+    """
+    Same as parse_result_file, from the records of results.jsonl (see result_writer.py):
+    no block splitting, the seq_id and distances are fields of each record.
+    """
+    created_files: List[Path] = []
+    for record in records:
+        # As for results.txt, the first distance names the file
+        target_path = Path(directory) / f"result{record['seq_id']}_{record['distances'][0]}.txt"
+        if target_path.exists():
+            continue
+        block = format_result(record["seq_id"], record["distances"], record["question"], record["answer"])
+        target_path.write_text(block.rstrip() + "\n", encoding="utf-8")
+        created_files.append(target_path)
+    return created_files
+
 def parse_result_file(directory: Path) -> list[Path]:
     """
     Parse `directory/results.txt` and write files named result{question_id}_{distance}.txt
-    for each block starting with [Q<id>].
+    for each block starting with [Q<id>]. The records of `directory/results.jsonl` are used first
+    when present, results.txt then only adds the questions missing from it (answered by an older
+    runner before the directory was resumed with one writing results.jsonl).
 
     Args:
         directory: Path to directory containing results.txt
@@ -164,9 +184,17 @@ def parse_result_file(directory: Path) -> list[Path]:
     Returns:
         List[Path] of files created.
     """
+    created_files: List[Path] = []
+    in_jsonl = set()
+    jsonl_path = Path(directory) / "results.jsonl"
+    if jsonl_path.exists():
+        records = read_results(jsonl_path)
+        created_files.extend(split_result_records(directory, records))
+        in_jsonl = {int(record["seq_id"]) for record in records}
+
     results_path = Path(directory) / "results.txt"
     if not results_path.exists():
-        return []
+        return created_files
     
     content = results_path.read_text(encoding="utf-8")
     
@@ -174,7 +202,7 @@ def parse_result_file(directory: Path) -> list[Path]:
     # We use a lookahead so the split keeps the [Q...] token at start of each block.
     blocks = re.split(r'(?=\[Q\s*\d+\])', content)
     
-    created_files: List[Path] = []
+    n_txt_only = 0
     for block in blocks:
         if not block or not block.strip():
             continue
@@ -185,6 +213,9 @@ def parse_result_file(directory: Path) -> list[Path]:
             # skip blocks that don't start with [Q...]
             continue
         q_id = int(q_match.group(1))
+        # The answers of results.jsonl are also in results.txt, they are already split
+        if q_id in in_jsonl:
+            continue
         
         # TODO!!: There will be an issue here when treating cases of tree shaped calls (because of multiple distance metrics used)
         # TODO!!: The format will then be "[QX] Distance=Y1, Y2, Y3" where Yi are the three different metrics... For now we keep the first 
@@ -206,7 +237,10 @@ def parse_result_file(directory: Path) -> list[Path]:
         # Write the block (preserve block content, but normalize trailing newlines)
         target_path.write_text(block.rstrip() + "\n", encoding="utf-8")
         created_files.append(target_path)
+        n_txt_only += 1
     
+    if in_jsonl and n_txt_only:
+        print(f"{directory}: {n_txt_only} answers only in results.txt (older runner) merged with results.jsonl")
     return created_files
 
 def extract_class_definition(java_file: Path, class_name: str) -> str:
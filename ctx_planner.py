@@ -0,0 +1,200 @@
+import argparse
+import os
+import pathlib
+import struct
+import subprocess
+
+# ==========================
+#   Slots and context sizing
+# ==========================
+# llama-server splits --ctx-size evenly between its --parallel slots and allocates the
+# KV cache for all of it up front. Rounding the per-slot need up to a power of two
+# (what the runners used to do) can nearly double the KV memory of a 60k token system
+# prompt; here the context is sized to the need (aligned to 256 tokens, llama.cpp pads
+# to that anyway) and the memory left gives the number of slots.
+
+GIB = 1 << 30
+CTX_ALIGN = 256
+
+# Bytes per element of the KV cache types (--cache-type-k / --cache-type-v)
+CACHE_TYPE_BYTES = {
+    "f32": 4.0, "f16": 2.0, "bf16": 2.0,
+    "q8_0": 34 / 32, "q5_1": 24 / 32, "q5_0": 22 / 32, "q4_1": 20 / 32, "q4_0": 18 / 32, "iq4_nl": 18 / 32,
+}
+
+# ==========================
+#       GGUF metadata
+# ==========================
+_GGUF_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_GGUF_STRING, _GGUF_ARRAY = 8, 9
+
+
+def _read_gguf_value(f, value_type):
+    if value_type in _GGUF_SCALARS:
+        fmt = _GGUF_SCALARS[value_type]
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+    if value_type == _GGUF_STRING:
+        (length,) = struct.unpack("<Q", f.read(8))
+        return f.read(length).decode("utf-8", errors="replace")
+    if value_type == _GGUF_ARRAY:
+        item_type, length = struct.unpack("<IQ", f.read(12))
+        return [_read_gguf_value(f, item_type) for _ in range(length)]
+    raise ValueError(f"Unknown GGUF value type {value_type}")
+
+
+def read_gguf_metadata(model_path, stop_prefix="tokenizer.") -> dict:
+    """
+    Key/value metadata of a GGUF file (v2+). Reading stops at the first key starting
+    with stop_prefix: the tokenizer vocabulary comes after the architecture keys and is large.
+    """
+    metadata = {}
+    with open(model_path, "rb") as f:
+        magic, version = struct.unpack("<4sI", f.read(8))
+        if magic != b"GGUF" or version < 2:
+            raise ValueError(f"{model_path} is not a GGUF v2+ file")
+        _, n_kv = struct.unpack("<QQ", f.read(16))
+        for _ in range(n_kv):
+            key = _read_gguf_value(f, _GGUF_STRING)
+            if stop_prefix and key.startswith(stop_prefix):
+                break
+            (value_type,) = struct.unpack("<I", f.read(4))
+            metadata[key] = _read_gguf_value(f, value_type)
+    return metadata
+
+
+def kv_bytes_per_token(model_path, cache_type_k="f16", cache_type_v="f16") -> int:
+    """KV cache bytes needed per context token, from the attention shape stored in the GGUF."""
+    meta = read_gguf_metadata(model_path)
+    arch = meta["general.architecture"]
+    n_layer = meta[f"{arch}.block_count"]
+    n_head = meta[f"{arch}.attention.head_count"]
+    n_head_kv = meta.get(f"{arch}.attention.head_count_kv", n_head)
+    # Some models (e.g. with sliding window layers) store one value per layer
+    heads_kv = n_head_kv if isinstance(n_head_kv, list) else [n_head_kv] * n_layer
+    n_head_ref = max(n_head) if isinstance(n_head, list) else n_head
+    head_dim = meta[f"{arch}.embedding_length"] // n_head_ref
+    key_length = meta.get(f"{arch}.attention.key_length", head_dim)
+    value_length = meta.get(f"{arch}.attention.value_length", head_dim)
+    per_token = sum(h * (key_length * CACHE_TYPE_BYTES[cache_type_k] + value_length * CACHE_TYPE_BYTES[cache_type_v])
+                    for h in heads_kv)
+    return int(per_token + 0.5)
+
+# ==========================
+#       Memory budget
+# ==========================
+def detect_memory_bytes():
+    """(bytes, source): total VRAM of the first GPU when nvidia-smi is there, else available RAM."""
+    try:
+        out = subprocess.run(["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+                             capture_output=True, text=True, timeout=10)
+        if out.returncode == 0 and out.stdout.strip():
+            return int(out.stdout.split()[0]) << 20, "vram"
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) << 10, "ram"
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES"), "ram"
+
+
+def kv_budget_bytes(memory_bytes: int, model_path=None, reserve_bytes: int = GIB) -> int:
+    """Memory left to the KV cache once the weights (size of the model file) and a compute reserve are taken."""
+    weights = pathlib.Path(model_path).stat().st_size if model_path else 0
+    return memory_bytes - weights - reserve_bytes
+
+# ==========================
+#         Planning
+# ==========================
+class SlotPlan:
+    """--parallel and --ctx-size for one experiment directory."""
+
+    def __init__(self, n_parallel: int, slot_ctx: int, kv_bytes: int):
+        self.n_parallel = n_parallel
+        self.slot_ctx = slot_ctx
+        self.ctx_size = n_parallel * slot_ctx
+        self.kv_bytes = kv_bytes  # KV cache size of the whole context
+
+    def __repr__(self):
+        return (f"SlotPlan(parallel={self.n_parallel}, ctx_size={self.ctx_size} ({self.slot_ctx}/slot), "
+                f"kv={self.kv_bytes / GIB:.2f} GiB)")
+
+
+def slot_context(sys_tokens: int, question_tokens: int = 100, answer_tokens: int = 500, align: int = CTX_ALIGN) -> int:
+    """Context one slot needs: system prompt, question and answer, aligned up to `align`."""
+    need = sys_tokens + question_tokens + answer_tokens
+    return -(-need // align) * align
+
+
+def plan_slots(sys_tokens: int, bytes_per_token: int, kv_budget: int, question_tokens: int = 100,
+               answer_tokens: int = 500, n_questions: int = None, max_parallel: int = 64) -> SlotPlan:
+    """
+    Largest number of slots whose KV cache fits in kv_budget, each slot holding
+    sys_tokens + question_tokens + answer_tokens. There is no point in having more
+    slots than questions.
+    """
+    slot_ctx = slot_context(sys_tokens, question_tokens, answer_tokens)
+    slot_bytes = slot_ctx * bytes_per_token
+    n_parallel = min(max_parallel, kv_budget // slot_bytes if slot_bytes > 0 else max_parallel)
+    if n_questions is not None:
+        n_parallel = min(n_parallel, max(1, n_questions))
+    if n_parallel < 1:
+        raise ValueError(f"A single slot of {slot_ctx} tokens needs {slot_bytes / GIB:.2f} GiB of KV cache, "
+                         f"only {kv_budget / GIB:.2f} GiB available")
+    return SlotPlan(int(n_parallel), slot_ctx, int(n_parallel) * slot_bytes)
+
+
+class SlotPlanner:
+    """
+    Plans of one model, given a total memory budget. Token counts come from a
+    callable(text) -> int, e.g. token_cache.TokenCounter.
+    """
+
+    def __init__(self, model_path, count_tokens, memory_bytes: int = None, reserve_bytes: int = GIB,
+                 bytes_per_token: int = None, cache_type_k="f16", cache_type_v="f16", max_parallel: int = 64,
+                 answer_tokens: int = 500):
+        if memory_bytes is None:
+            memory_bytes, source = detect_memory_bytes()
+            print(f"Memory budget: {memory_bytes / GIB:.1f} GiB ({source})")
+        self.count_tokens = count_tokens
+        self.bytes_per_token = bytes_per_token or kv_bytes_per_token(model_path, cache_type_k, cache_type_v)
+        self.kv_budget = kv_budget_bytes(memory_bytes, model_path, reserve_bytes)
+        self.max_parallel = max_parallel
+        self.answer_tokens = answer_tokens
+
+    def plan(self, system_prompt: str, questions: list, answer_tokens: int = None) -> SlotPlan:
+        """Plan for one directory; questions are (seq_id, distances, question) tuples."""
+        sys_tokens = self.count_tokens(system_prompt)
+        # The longest question (in characters) gives the question padding
+        longest = max((q for _, _, q in questions), key=len, default="")
+        question_tokens = self.count_tokens(longest) + 16 if longest else 100
+        return plan_slots(sys_tokens, self.bytes_per_token, self.kv_budget, question_tokens,
+                          answer_tokens or self.answer_tokens, len(questions), self.max_parallel)
+
+
+if __name__ == "__main__":
+    from experiment_files import find_experiment_dirs, parse_questions, read_text
+    from token_cache import TokenCounter
+
+    parser = argparse.ArgumentParser(description="Plan llama-server --parallel / --ctx-size for every experiment directory")
+    parser.add_argument("roots", nargs="+", help="experiment root directories")
+    parser.add_argument("--model", required=True, help="model.gguf (attention shape and tokenizer)")
+    parser.add_argument("--tokenizer", default=None, help="llama-tokenize executable, used if llama_cpp is missing")
+    parser.add_argument("--memory-gb", type=float, default=None, help="RAM/VRAM budget (default: detected)")
+    parser.add_argument("--reserve-gb", type=float, default=1.0, help="kept for compute buffers")
+    parser.add_argument("--kv-bytes-per-token", type=int, default=None, help="override the value read from the GGUF")
+    parser.add_argument("--cache-type", default="f16", choices=sorted(CACHE_TYPE_BYTES))
+    parser.add_argument("--answer-tokens", type=int, default=500)
+    args = parser.parse_args()
+
+    planner = SlotPlanner(args.model, TokenCounter(args.model, args.tokenizer),
+                          int(args.memory_gb * GIB) if args.memory_gb else None, int(args.reserve_gb * GIB),
+                          args.kv_bytes_per_token, args.cache_type, args.cache_type, answer_tokens=args.answer_tokens)
+    print(f"KV cache: {planner.bytes_per_token} bytes/token, {planner.kv_budget / GIB:.2f} GiB available")
+    for root in args.roots:
+        for d in find_experiment_dirs(root):
+            questions = parse_questions(read_text(d / "reachability_questions.txt"))
+            print(f"{planner.plan(read_text(d / 'system.txt'), questions)}\t{d}")
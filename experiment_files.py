@@ -0,0 +1,47 @@
+import os
+import pathlib
+
+# ==========================
+#   Experiment directories
+# ==========================
+# Reading the files of a generated context directory (system.txt, reachability_questions.txt),
+# shared by all the runners so they see the same questions with the same seq_ids. Answers are
+# written with result_writer.format_result, the layout content_analysis_v2.py parses.
+
+def read_text(path) -> str:
+    """Read a text file, falling back to cp1252 (small issue with windows encoding)."""
+    for encoding in ["utf-8", "cp1252"]:
+        try:
+            with open(path, "r", encoding=encoding) as f:
+                return f.read()
+        except UnicodeDecodeError:
+            continue
+    print(f"Error: Could not decode {path} with utf-8 or cp1252.")
+    return ""
+
+
+def find_experiment_dirs(root) -> list[pathlib.Path]:
+    """All directories under root holding a system.txt and a reachability_questions.txt."""
+    found = []
+    for current, dirs, files in os.walk(root):
+        dirs.sort()
+        if "system.txt" in files and "reachability_questions.txt" in files:
+            found.append(pathlib.Path(current))
+            dirs.clear()  # an experiment directory is a leaf for the runners
+    return found
+
+
+def parse_questions(questions_raw: str) -> list[tuple]:
+    """
+    Parse reachability_questions.txt into (seq_id, distances, question) tuples. The seq_id is
+    the line number, malformed lines are skipped; distances are the first column then the
+    columns after the question (distance_with_backtracking, distance_height for trees).
+    """
+    questions = []
+    for seq_id, line in enumerate(questions_raw.splitlines()):
+        parts = line.split("\t")
+        if len(parts) < 2:
+            print(f"Skipping malformed question line: {line}")
+            continue
+        questions.append((seq_id, [parts[0]] + parts[2:], parts[1]))
+    return questions
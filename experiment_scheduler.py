@@ -0,0 +1,302 @@
+import argparse
+import asyncio
+import pathlib
+import subprocess
+import time
+
+from answer_store import load_store
+from completion_index import CompletionIndex
+from ctx_planner import CACHE_TYPE_BYTES, GIB, SlotPlanner
+from experiment_files import find_experiment_dirs, parse_questions, read_text
+from llama_server_client import make_transport, run_bounded, stream_completion, wait_for_server_async
+from predict_budget import load_budget
+from result_writer import ResultWriter, append_stop_word, chain_written, mark_in_index
+from slot_scheduler import Experiment, SlotScheduler
+from telemetry import TelemetryWriter, record_from_server_result
+from token_cache import TokenCache, TokenCounter
+
+# ==========================
+#       Utilities
+# ==========================
+# A running server is restarted for a directory whose plan has at least this many times more slots
+REPLAN_MIN_GAIN = 1.5
+
+
+def required_ctx_size(sys_token_count: int, n_parallel: int, question_pad: int = 100, answer_pad: int = 500) -> int:
+    """Same sizing as reachability_bench_server_v2: padded prompt, rounded to a power of 2, per slot."""
+    token_count = sys_token_count + question_pad + answer_pad
+    return n_parallel * (1 << (token_count - 1).bit_length())
+
+# ==========================
+#       Server handling
+# ==========================
+class LlamaServer:
+    """A llama-server process that is only restarted when the context size has to change."""
+
+    def __init__(self, server_bin, model_path, n_parallel=2, gpu_layers=24, port=8080, extra_args=None):
+        self.server_bin = server_bin
+        self.model_path = model_path
+        self.n_parallel = n_parallel
+        self.gpu_layers = gpu_layers
+        self.port = port
+        self.extra_args = extra_args or []
+        self.ctx_size = None
+        self.proc = None
+        self.n_starts = 0
+        self.transport = make_transport(f"http://localhost:{port}")
+
+    def command(self, ctx_size: int, keep: int) -> list[str]:
+        return [
+            self.server_bin,
+            "--model", self.model_path,
+            "--ctx-size", str(ctx_size),
+            "--keep", str(keep),
+            "--gpu-layers", str(self.gpu_layers),
+            "--parallel", str(self.n_parallel),
+            "--cache-reuse", "128",
+            "--port", str(self.port),
+            "--kv-unified",
+            "--no-warmup",
+        ] + self.extra_args
+
+    async def ensure(self, ctx_size: int, keep: int, n_parallel: int = None) -> bool:
+        """Make sure a server with ctx_size (and n_parallel slots) is running, return True if it had to be (re)started."""
+        if (self.proc is not None and self.proc.poll() is None and ctx_size <= self.ctx_size
+                and n_parallel in (None, self.n_parallel)):
+            return False
+        self.stop()
+        if n_parallel is not None:
+            self.n_parallel = n_parallel
+        print(f"Starting LLaMA server (ctx-size {ctx_size}, parallel {self.n_parallel})...")
+        self.proc = subprocess.Popen(self.command(ctx_size, keep))
+        self.ctx_size = ctx_size
+        self.n_starts += 1
+        await wait_for_server_async(self.transport, timeout=600)
+        return True
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+    async def close(self):
+        self.stop()
+        await self.transport.close()
+
+# ==========================
+#       Scheduling
+# ==========================
+# Answer store template of the server runners: "{system}\n{question}", stopped on YES/NO
+SERVER_TEMPLATE = "server"
+
+
+def answer_meta(result: dict, params: dict) -> dict:
+    """ResultWriter.put metadata (answer store fields) of a stream_completion result or /completions JSON."""
+    return {"prompt_tokens": result.get("timings", {}).get("prompt_n"), "generated_tokens": result.get("n_tokens", result.get("tokens_predicted")),
+            "stop_reason": result.get("stop_reason"), "params": params}
+
+
+async def run_directory(transport, exp_dir: pathlib.Path, model_name: str, n_parallel: int, n_keep: int, n_predict: int = 4096,
+                        index: CompletionIndex = None, budget=None, ctx_size=None, store=None):
+    """
+    Ask every question of one experiment directory, results go to exp_dir/model_name/results.jsonl
+    and results.txt (and per-request telemetry to telemetry.jsonl next to them).
+    When a budget (callable(distances) -> n_predict) is given it replaces the flat n_predict.
+    Answers found in the answer store (answer_store.AnswerStore) are reused, the others are added to it.
+    """
+    system_prompt = read_text(exp_dir / "system.txt")
+    questions = parse_questions(read_text(exp_dir / "reachability_questions.txt"))
+    output_dir = exp_dir / model_name
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if index is not None:
+        index.ingest_results_file(exp_dir, model_name, output_dir / "results.txt", system_prompt,
+                                  [(seq_id, q) for seq_id, _, q in questions])
+        questions = index.pending(exp_dir, model_name, system_prompt, questions)
+
+    telemetry = TelemetryWriter(output_dir / "telemetry.jsonl")
+    queued_at = time.perf_counter()
+    on_written = chain_written(mark_in_index(index, exp_dir, model_name, system_prompt),
+                               store and store.filler(model_name, system_prompt, SERVER_TEMPLATE))
+    with ResultWriter(output_dir, on_written=on_written) as results:
+        if store is not None:
+            questions = store.serve(results, model_name, system_prompt, questions, SERVER_TEMPLATE)
+
+        async def handle(item):
+            seq_id, distances, actual_question = item
+            payload = {
+                "prompt": f"{system_prompt}\n{actual_question}",
+                "n_predict": budget(distances) if budget is not None else n_predict,
+                "cache_prompt": True,
+                "stop": ["User:", "YES", "NO"],
+                "n_keep": n_keep,
+            }
+            try:
+                start = time.perf_counter()
+                result = await stream_completion(transport, payload)
+            except (OSError, ValueError) as e:
+                print(f"[Q{seq_id}] ❌ Error:", e)
+                return
+            results.put(seq_id, distances, actual_question, append_stop_word(result["content"].strip(), result["stopping_word"]),
+                        **answer_meta(result, {"n_predict": payload["n_predict"], "stop": payload["stop"]}))
+            telemetry.write(record_from_server_result(
+                result, start - queued_at, time.perf_counter() - start, runner="experiment_scheduler",
+                model=model_name, exp_dir=str(exp_dir), ctx_size=ctx_size, seq_id=seq_id, distances=distances))
+
+        await run_bounded(questions, handle, n_parallel)
+    telemetry.close()
+    return len(questions)
+
+
+async def run_directories_pinned(transport, plan, model_name: str, n_parallel: int, n_predict: int = 4096,
+                                 index: CompletionIndex = None, budget=None, ctx_size=None, store=None):
+    """
+    Run several experiment directories at once on one server, each slot being pinned
+    to a directory (see slot_scheduler). plan holds (ctx_size, n_tokens, exp_dir) tuples.
+    """
+    experiments = []
+    files = []
+    for _, n_tokens, exp_dir in plan:
+        system_prompt = read_text(exp_dir / "system.txt")
+        questions = parse_questions(read_text(exp_dir / "reachability_questions.txt"))
+        output_dir = exp_dir / model_name
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if index is not None:
+            index.ingest_results_file(exp_dir, model_name, output_dir / "results.txt", system_prompt,
+                                      [(seq_id, q) for seq_id, _, q in questions])
+            questions = index.pending(exp_dir, model_name, system_prompt, questions)
+        results = ResultWriter(output_dir, on_written=chain_written(
+            mark_in_index(index, exp_dir, model_name, system_prompt),
+            store and store.filler(model_name, system_prompt, SERVER_TEMPLATE)))
+        telemetry = TelemetryWriter(output_dir / "telemetry.jsonl")
+        files += [results, telemetry]
+        if store is not None:
+            questions = store.serve(results, model_name, system_prompt, questions, SERVER_TEMPLATE)
+
+        def on_result(item, result, results=results, telemetry=telemetry, exp_dir=exp_dir):
+            seq_id, distances, actual_question = item
+            n_predict_used = budget(distances) if budget is not None else n_predict
+            results.put(seq_id, distances, actual_question, append_stop_word(result["content"].strip(), result["stopping_word"]),
+                        **answer_meta(result, {"n_predict": n_predict_used, "stop": ["User:", "YES", "NO"]}))
+            telemetry.write(record_from_server_result(
+                result, result["queue_wait"], result["total_time"], runner="experiment_scheduler",
+                model=model_name, exp_dir=str(exp_dir), ctx_size=ctx_size, seq_id=seq_id, distances=distances))
+
+        experiments.append(Experiment(exp_dir, system_prompt, questions, on_result, {"n_keep": n_tokens + 10}))
+
+    scheduler = SlotScheduler(transport, n_parallel, payload={
+        "n_predict": n_predict,
+        "stop": ["User:", "YES", "NO"],
+    }, n_predict_fn=budget)
+    try:
+        await scheduler.run(experiments)
+    finally:
+        for f in files:
+            f.close()
+    print(scheduler.report())
+
+
+async def schedule(roots, models, args):
+    """Run every experiment directory under the roots, with one long lived server per model."""
+    dirs = [d for root in roots for d in find_experiment_dirs(root)]
+    print(f"Found {len(dirs)} experiment directories")
+    index = CompletionIndex(args.index)
+    token_cache = TokenCache(args.token_cache)
+    budget = load_budget(args.budget)
+    store = load_store(args.answer_store)
+    extra_args = ["--cache-type-k", args.cache_type, "--cache-type-v", args.cache_type] if args.cache_type != "f16" else []
+
+    for model_path, model_name in models:
+        count_tokens = TokenCounter(model_path, args.tokenizer, token_cache)
+        planner = None
+        if args.memory_gb is not None or args.auto_parallel:
+            # --parallel / --ctx-size chosen per directory from the KV cache footprint (see ctx_planner)
+            planner = SlotPlanner(model_path, count_tokens, int(args.memory_gb * GIB) if args.memory_gb else None,
+                                  int(args.reserve_gb * GIB), args.kv_bytes_per_token, args.cache_type, args.cache_type)
+        plan = []
+        slot_plans = {}
+        for d in dirs:
+            system_prompt = read_text(d / "system.txt")
+            n_tokens = count_tokens(system_prompt)
+            if planner is None:
+                plan.append((required_ctx_size(n_tokens, args.parallel), n_tokens, d))
+                continue
+            questions = parse_questions(read_text(d / "reachability_questions.txt"))
+            # The answer padding is the largest per-question budget when there is one
+            answer_tokens = max((budget(q[1]) for q in questions), default=None) if budget is not None else None
+            slot_plans[d] = planner.plan(system_prompt, questions, answer_tokens)
+            print(f"[{model_name}] {d}: {slot_plans[d]}")
+            plan.append((slot_plans[d].slot_ctx, n_tokens, d))
+        # Largest contexts first: smaller ones then fit in the running server without restart
+        plan.sort(key=lambda p: -p[0])
+
+        server = LlamaServer(args.server, model_path, args.parallel, args.gpu_layers, args.port, extra_args)
+        start_all = time.time()
+        try:
+            if args.pin_slots and plan:
+                # Largest context first, so every directory fits in the server started for it
+                ctx_size, n_parallel = plan[0][0], args.parallel
+                if planner is not None:
+                    largest = plan[0][2]
+                    all_questions = [q for d in dirs for q in parse_questions(read_text(d / "reachability_questions.txt"))]
+                    pinned_plan = planner.plan(read_text(largest / "system.txt"), all_questions)
+                    ctx_size, n_parallel = pinned_plan.ctx_size, pinned_plan.n_parallel
+                await server.ensure(ctx_size, plan[0][1] + 10, n_parallel)
+                await run_directories_pinned(server.transport, plan, model_name, server.n_parallel, args.n_predict, index, budget,
+                                             server.ctx_size, store)
+                plan = []
+            for ctx_size, n_tokens, d in plan:
+                n_parallel = None
+                if d in slot_plans:
+                    slot_plan = slot_plans[d]
+                    ctx_size, n_parallel = slot_plan.ctx_size, slot_plan.n_parallel
+                    # A restart reloads the model: keep the running server while its slots are large
+                    # enough, unless the plan allows many more slots
+                    if (server.ctx_size and server.ctx_size // server.n_parallel >= slot_plan.slot_ctx
+                            and slot_plan.n_parallel < server.n_parallel * REPLAN_MIN_GAIN):
+                        ctx_size, n_parallel = server.ctx_size, server.n_parallel
+                await server.ensure(ctx_size, n_tokens + 10, n_parallel)
+                start = time.time()
+                n_questions = await run_directory(server.transport, d, model_name, server.n_parallel, n_tokens + 10, args.n_predict,
+                                                  index, budget, server.ctx_size, store)
+                print(f"[{model_name}] {d}: {n_questions} questions in {time.time() - start:.2f}s")
+        finally:
+            await server.close()
+        print(f"[{model_name}] {len(dirs)} directories, {server.n_starts} server start(s), "
+              f"total {time.time() - start_all:.2f}s")
+
+
+def parse_model(spec: str) -> tuple[str, str]:
+    """'path/to/model.gguf[:Name]' -> (path, name), the name defaults to the file stem."""
+    path, sep, name = spec.rpartition(":")
+    if not sep or "/" in name or "\\" in name:
+        # No name given (the colon, if any, belongs to a windows drive letter)
+        path, name = spec, ""
+    return path, name or pathlib.Path(path).stem
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run all experiment directories keeping one llama-server per model")
+    parser.add_argument("roots", nargs="+", help="experiment root directories")
+    parser.add_argument("--model", action="append", required=True, help="model.gguf[:output-name], can be repeated")
+    parser.add_argument("--server", default="llama-server", help="llama-server executable")
+    parser.add_argument("--tokenizer", default="llama-tokenize", help="llama-tokenize executable, used if llama_cpp is missing")
+    parser.add_argument("--token-cache", default=None, help="token count cache (default: $REACHABILITY_TOKEN_CACHE or token_cache.sqlite)")
+    parser.add_argument("--parallel", type=int, default=2)
+    parser.add_argument("--gpu-layers", type=int, default=24)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--n-predict", type=int, default=4096)
+    parser.add_argument("--budget", default=None, help="per-question n_predict model fitted by predict_budget.py ('default' for the unfitted one)")
+    parser.add_argument("--pin-slots", action="store_true", help="pin each server slot to one directory, warmed once")
+    parser.add_argument("--index", default=None, help="completion index file (default: $REACHABILITY_INDEX or completion_index.sqlite)")
+    parser.add_argument("--answer-store", default=None,
+                        help="reuse and record answers in this store (default: $REACHABILITY_ANSWER_STORE, unset: off)")
+    parser.add_argument("--auto-parallel", action="store_true",
+                        help="choose --parallel and --ctx-size per directory from the detected RAM/VRAM (see ctx_planner.py)")
+    parser.add_argument("--memory-gb", type=float, default=None, help="RAM/VRAM budget for --auto-parallel (implies it)")
+    parser.add_argument("--reserve-gb", type=float, default=1.0, help="memory kept for compute buffers")
+    parser.add_argument("--kv-bytes-per-token", type=int, default=None, help="override the KV footprint read from the GGUF")
+    parser.add_argument("--cache-type", default="f16", choices=sorted(CACHE_TYPE_BYTES), help="KV cache type (K and V)")
+    args = parser.parse_args()
+
+    asyncio.run(schedule(args.roots, [parse_model(m) for m in args.model], args))
@@ -0,0 +1,212 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==========================
+#   Stand-in llama-server
+# ==========================
+# Fakes the two endpoints used by the runners (/health and /completions) so the
+# clients can be exercised without a GPU or a model. Like llama-server, each slot
+# keeps the tokens of its last request and only the part of a new prompt that
+# differs from them is "processed" (reported as prompt_n, the reused part as cache_n).
+
+def fake_answer(prompt: str) -> str:
+    """Build a small step-by-step answer ending with FINAL ANSWER: YES/NO."""
+    methods = re.findall(r"`(\w+)`", prompt)
+    source, target = (methods[-2], methods[-1]) if len(methods) >= 2 else ("a", "b")
+    verdict = "YES" if sum(map(ord, prompt)) % 2 == 0 else "NO"
+    return (f"Let's think step by step. {source} calls some methods. "
+            f"Following the calls from {source} we look for {target}. "
+            f"FINAL ANSWER: {verdict}")
+
+
+def split_tokens(text: str) -> list:
+    """Fake tokenization: words with their leading space."""
+    return re.findall(r"\s*\S+", text)
+
+
+def common_prefix_length(a: list, b: list) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class FakeSlot:
+    def __init__(self, id_slot: int):
+        self.id = id_slot
+        self.tokens = []
+        self.lock = threading.Lock()
+
+
+class FakeLlamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/completions":
+            self._send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        prompt = payload.get("prompt", "")
+        if isinstance(prompt, list):
+            prompt = prompt[0] if prompt else ""
+
+        with self.server.lock:
+            self.server.n_requests += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        slot = self._acquire_slot(payload.get("id_slot", -1), split_tokens(prompt))
+        try:
+            self._complete(prompt, payload, slot)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up after its stop word, exactly like with llama-server
+            pass
+        finally:
+            slot.lock.release()
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _acquire_slot(self, id_slot: int, prompt_tokens: list) -> FakeSlot:
+        """Requested slot, or the idle slot sharing the longest prefix with the prompt (blocks if all are busy)."""
+        slots = self.server.slots
+        if 0 <= id_slot < len(slots):
+            slots[id_slot].lock.acquire()
+            return slots[id_slot]
+        while True:
+            for slot in sorted(slots, key=lambda s: -common_prefix_length(s.tokens, prompt_tokens)):
+                if slot.lock.acquire(blocking=False):
+                    return slot
+            time.sleep(0.001)
+
+    def _complete(self, prompt: str, payload: dict, slot: FakeSlot):
+        stop_words = payload.get("stop", [])
+        n_predict = payload.get("n_predict", -1)
+        tokens = split_tokens(self.server.answer_fn(prompt))
+        prompt_tokens = split_tokens(prompt)
+        n_cached = 0
+        if payload.get("cache_prompt", True):
+            # At least one token is always evaluated to get the logits
+            n_cached = min(common_prefix_length(slot.tokens, prompt_tokens), max(0, len(prompt_tokens) - 1))
+        n_prompt = len(prompt_tokens) - n_cached
+
+        t_start = time.perf_counter()
+        content = ""
+        stopping_word = ""
+        n_decoded = 0
+        pieces = []
+        for token in tokens:
+            if 0 <= n_predict <= n_decoded:
+                break
+            n_decoded += 1
+            candidate = content + token
+            hits = [(candidate.find(w), w) for w in stop_words if w in candidate]
+            if hits:
+                pos, stopping_word = min(hits)
+                pieces.append(candidate[len(content):pos])
+                content = candidate[:pos]
+                break
+            content = candidate
+            pieces.append(token)
+        t_gen = time.perf_counter() - t_start
+        slot.tokens = prompt_tokens + split_tokens(content)
+
+        timings = {
+            "prompt_n": n_prompt,
+            "cache_n": n_cached,
+            "predicted_n": n_decoded,
+            "prompt_ms": n_prompt * self.server.prompt_delay * 1000,
+            "predicted_ms": n_decoded * self.server.token_delay * 1000 or t_gen * 1000,
+        }
+        final = {"content": "", "stop": True, "stopping_word": stopping_word,
+                 "stop_type": "word" if stopping_word else ("limit" if 0 <= n_predict <= n_decoded else "eos"),
+                 "tokens_predicted": n_decoded, "tokens_evaluated": n_prompt,
+                 "timings": timings, "id_slot": slot.id}
+
+        if not payload.get("stream"):
+            time.sleep(n_prompt * self.server.prompt_delay + n_decoded * self.server.token_delay)
+            self._send_json(200, dict(final, content=content))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(n_prompt * self.server.prompt_delay)
+        for piece in pieces:
+            time.sleep(self.server.token_delay)
+            if piece:
+                event = {"content": piece, "stop": False, "id_slot": slot.id}
+                self._send_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self._send_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+        self._send_chunk(b"")
+
+
+def start_fake_server(port: int = 0, token_delay: float = 0.0, prompt_delay: float = 0.0,
+                      answer_fn=fake_answer, verbose: bool = False, n_slots: int = 1):
+    """
+    Start the stand-in server in a background thread.
+
+    Returns:
+        ThreadingHTTPServer: the running server (server.server_address[1] is the port,
+                             call server.shutdown() to stop it).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeLlamaHandler)
+    server.daemon_threads = True
+    server.token_delay = token_delay
+    server.prompt_delay = prompt_delay
+    server.answer_fn = answer_fn
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.n_requests = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.slots = [FakeSlot(i) for i in range(n_slots)]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in llama-server faking /health and /completions")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds per generated token")
+    parser.add_argument("--prompt-delay", type=float, default=0.0, help="seconds per prompt token")
+    parser.add_argument("--parallel", type=int, default=1, help="number of slots")
+    # Unknown llama-server options (--model, --ctx-size, ...) are accepted and ignored
+    args, _ = parser.parse_known_args()
+
+    server = start_fake_server(args.port, args.token_delay, args.prompt_delay, verbose=True, n_slots=args.parallel)
+    print(f"Fake llama-server listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
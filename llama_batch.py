@@ -0,0 +1,295 @@
+import codecs
+import ctypes
+import time
+
+import numpy as np
+import llama_cpp
+
+from ctx_planner import CTX_ALIGN
+from stop_matcher import FinalAnswerMatcher
+
+# ==========================
+#   Continuous batching
+# ==========================
+# Python counterpart of the client loop of reachability_bench.cpp, on the low-level
+# llama_cpp API: the system prompt is decoded once in sequence 0 and shared with every
+# client sequence (llama_memory_seq_cp), then each llama_decode call carries the next
+# token of every generating client plus the prompts of the clients that just got a
+# question, so the clients really overlap on the GPU.
+
+def _memory_seq_rm(ctx, seq_id, p0=-1, p1=-1):
+    # The KV cache functions were renamed twice across llama_cpp versions
+    if hasattr(llama_cpp, "llama_memory_seq_rm"):
+        llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), seq_id, p0, p1)
+    elif hasattr(llama_cpp, "llama_kv_self_seq_rm"):
+        llama_cpp.llama_kv_self_seq_rm(ctx, seq_id, p0, p1)
+    else:
+        llama_cpp.llama_kv_cache_seq_rm(ctx, seq_id, p0, p1)
+
+
+def _memory_seq_cp(ctx, src, dst, p0=-1, p1=-1):
+    if hasattr(llama_cpp, "llama_memory_seq_cp"):
+        llama_cpp.llama_memory_seq_cp(llama_cpp.llama_get_memory(ctx), src, dst, p0, p1)
+    elif hasattr(llama_cpp, "llama_kv_self_seq_cp"):
+        llama_cpp.llama_kv_self_seq_cp(ctx, src, dst, p0, p1)
+    else:
+        llama_cpp.llama_kv_cache_seq_cp(ctx, src, dst, p0, p1)
+
+
+def _model_pointer(llm):
+    # llama_model of a llama_cpp.Llama, only reachable through a private attribute
+    model = getattr(getattr(llm, "_model", None), "model", None)
+    if model is None:
+        raise RuntimeError(f"llama_cpp {getattr(llama_cpp, '__version__', '?')} does not expose Llama._model.model, "
+                           "BatchDecoder needs a llama-cpp-python version with the low-level model handle")
+    return model
+
+
+def _offset(pointer, i: int):
+    # pointer + i, for the batch views
+    return ctypes.cast(ctypes.addressof(pointer.contents) + i * ctypes.sizeof(pointer._type_), type(pointer))
+
+
+def shared_context(sys_tokens: int, n_clients: int, question_tokens: int = 100, answer_tokens: int = 256) -> int:
+    """n_ctx for the system prompt stored once plus one question and answer per client."""
+    need = sys_tokens + n_clients * (question_tokens + answer_tokens)
+    return -(-need // CTX_ALIGN) * CTX_ALIGN
+
+
+def batch_add(batch, token: int, pos: int, seq_id: int, logits: bool):
+    """Same as common_batch_add, for a single sequence id."""
+    i = batch.n_tokens
+    batch.token[i] = token
+    batch.pos[i] = pos
+    batch.n_seq_id[i] = 1
+    batch.seq_id[i][0] = seq_id
+    batch.logits[i] = logits
+    batch.n_tokens += 1
+    return i
+
+
+class BatchClient:
+    """State of one client (one KV sequence), as the client struct of the C++ runner."""
+
+    def __init__(self, cid: int):
+        self.id = cid
+        self.item = None  # (seq_id, distances, question) being answered, None when idle
+        self.max_tokens = 256
+        self.n_prompt = 0
+        self.n_decoded = 0
+        self.i_batch = -1
+        self.sampled = None
+        self.t_start_prompt = 0.0
+        self.t_start_gen = None
+        self.matcher = None
+        self.decoder = None
+
+
+class BatchDecoder:
+    """
+    Answer questions with n_clients sequences decoded together in one llama context.
+    Prompts are laid out as in reachability_bench.py: system prompt, "\\nUser: question\\nAssistant:".
+
+    Args:
+        llm: llama_cpp.Llama of the model, only used for its weights and tokenizer
+        n_ctx: context shared by all the clients (the system prompt is stored once)
+        temperature, top_k: sampling, temperature 0 for greedy decoding
+    """
+
+    def __init__(self, llm, system_prompt: str, n_clients: int = 8, n_ctx: int = 8192, n_batch: int = 2048,
+                 n_threads: int = 8, temperature: float = 0.8, top_k: int = 40, seed: int = 1234, stop=("User:",)):
+        self.llm = llm
+        self.n_clients = n_clients
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.temperature = temperature
+        self.top_k = top_k
+        self.stop = list(stop)
+        self.rng = np.random.default_rng(seed)
+        self.n_vocab = llm.n_vocab()
+        model = _model_pointer(llm)
+        self.vocab = llama_cpp.llama_model_get_vocab(model) if hasattr(llama_cpp, "llama_model_get_vocab") else None
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = min(512, n_batch)
+        params.n_seq_max = n_clients + 1
+        params.n_threads = params.n_threads_batch = n_threads
+        if hasattr(params, "kv_unified"):
+            # One KV buffer: the cells of the system prompt are shared by all the sequences
+            params.kv_unified = True
+        init = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+        self.ctx = init(model, params)
+        if not self.ctx:
+            raise RuntimeError(f"Could not create a llama context of {n_ctx} tokens for {n_clients} clients")
+        self.batch = llama_cpp.llama_batch_init(max(n_batch, n_ctx), 0, 1)
+
+        # ---- System prompt: decoded once in sequence 0, then shared ----
+        self.tokens_system = llm.tokenize(f"{system_prompt}\nUser:".encode("utf-8"), add_bos=True)
+        start = time.perf_counter()
+        for i in range(0, len(self.tokens_system), n_batch):
+            self.batch.n_tokens = 0
+            for pos in range(i, min(i + n_batch, len(self.tokens_system))):
+                batch_add(self.batch, self.tokens_system[pos], pos, 0, False)
+            self._decode()
+        for client_id in range(n_clients):
+            _memory_seq_cp(self.ctx, 0, client_id + 1)
+        self.t_system = time.perf_counter() - start
+        print(f"System prompt decoded once: {len(self.tokens_system)} tokens in {self.t_system:.2f}s, "
+              f"shared by {n_clients} clients")
+        self.n_total_prompt = 0
+        self.n_total_gen = 0
+
+    def _decode(self, on_chunk=None):
+        """
+        Decode self.batch in chunks of at most n_batch tokens. When llama_decode finds no room
+        in the KV cache the chunk is retried with half as many tokens, as reachability_bench.cpp
+        does. on_chunk(i, n_tokens) is called after each chunk, the logits of its tokens are
+        then at index i_batch - i.
+        """
+        n_batch = self.n_batch
+        i = 0
+        while i < self.batch.n_tokens:
+            n_tokens = min(n_batch, self.batch.n_tokens - i)
+            view = llama_cpp.llama_batch(n_tokens=n_tokens, token=_offset(self.batch.token, i), embd=None,
+                                         pos=_offset(self.batch.pos, i), n_seq_id=_offset(self.batch.n_seq_id, i),
+                                         seq_id=_offset(self.batch.seq_id, i), logits=_offset(self.batch.logits, i))
+            ret = llama_cpp.llama_decode(self.ctx, view)
+            if ret != 0:
+                if n_batch == 1 or ret < 0:
+                    raise RuntimeError(f"llama_decode failed ({ret}), n_ctx {self.n_ctx} may be too small "
+                                       f"for {self.n_clients} clients")
+                n_batch //= 2
+                print(f"⚠️ llama_decode failed ({ret}), retrying with n_batch = {n_batch}")
+                continue
+            if on_chunk is not None:
+                on_chunk(i, n_tokens)
+            i += n_tokens
+
+    def _is_eog(self, token: int) -> bool:
+        if self.vocab is not None:
+            return llama_cpp.llama_vocab_is_eog(self.vocab, token)
+        return token == self.llm.token_eos()
+
+    def _sample(self, i_logits: int) -> int:
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, i_logits), shape=(self.n_vocab,))
+        if self.temperature <= 0:
+            return int(np.argmax(logits))
+        top = np.argpartition(logits, -self.top_k)[-self.top_k:]
+        scaled = logits[top] / self.temperature
+        p = np.exp(scaled - scaled.max())
+        return int(top[self.rng.choice(len(top), p=p / p.sum())])
+
+    def _question_tokens(self, item) -> list:
+        # Do not prepend BOS, the system prompt has it
+        return self.llm.tokenize(f" {item[2]}\nAssistant:".encode("utf-8"), add_bos=False, special=False)
+
+    def _start(self, client: BatchClient, item, tokens: list, max_tokens: int):
+        client.item = item
+        client.max_tokens = max_tokens
+        for i, token in enumerate(tokens):
+            client.i_batch = batch_add(self.batch, token, len(self.tokens_system) + i, client.id + 1, i == len(tokens) - 1)
+        client.n_prompt = len(tokens)
+        client.n_decoded = 0
+        client.t_start_prompt = time.perf_counter()
+        client.t_start_gen = None
+        client.matcher = FinalAnswerMatcher(stop_words=self.stop)
+        client.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def _finish(self, client: BatchClient, stop_reason: str) -> dict:
+        now = time.perf_counter()
+        ttft = client.t_start_gen - client.t_start_prompt if client.t_start_gen is not None else None
+        result = {
+            "content": client.matcher.text.strip(),
+            "stop_reason": client.matcher.stop_reason or stop_reason,
+            "generated_tokens": client.n_decoded,
+            "prompt_tokens": client.n_prompt,
+            "cached_tokens": len(self.tokens_system),
+            "time_to_first_token": ttft,
+            "total_time": now - client.t_start_prompt,
+            "decode_tps": (client.n_decoded - 1) / (now - client.t_start_gen)
+                          if client.t_start_gen is not None and client.n_decoded > 1 and now > client.t_start_gen else None,
+            "slot_id": client.id,
+        }
+        self.n_total_prompt += client.n_prompt
+        self.n_total_gen += client.n_decoded
+        # Drop the generated part of the sequence, keep the system prompt
+        _memory_seq_rm(self.ctx, client.id + 1)
+        _memory_seq_cp(self.ctx, 0, client.id + 1)
+        client.item = None
+        return result
+
+    def run(self, questions: list, max_tokens=256, on_result=None) -> list[dict]:
+        """
+        Answer (seq_id, distances, question) tuples, `on_result(item, result)` is called as
+        soon as an answer is complete. max_tokens is an int or callable(distances) -> int.
+
+        Returns:
+            list[dict]: results in completion order, content plus telemetry fields
+        """
+        pending = list(reversed(questions))
+        clients = [BatchClient(i) for i in range(self.n_clients)]
+        results = []
+
+        def sample(i, n_tokens):
+            # Clients whose last token is in the chunk decoded at batch position i
+            for client in clients:
+                if client.item is None or not i <= client.i_batch < i + n_tokens:
+                    continue
+                token = self._sample(client.i_batch - i)
+                client.i_batch = -1
+                if client.t_start_gen is None:
+                    client.t_start_gen = time.perf_counter()
+                client.n_decoded += 1
+                client.sampled = token
+
+                stop_reason = None
+                if self._is_eog(token):
+                    stop_reason = "eos"
+                elif client.matcher.feed(client.decoder.decode(self.llm.detokenize([token]))):
+                    stop_reason = client.matcher.stop_reason
+                elif client.n_decoded >= client.max_tokens:
+                    stop_reason = "length"
+                if stop_reason is not None:
+                    item = client.item
+                    result = self._finish(client, stop_reason)
+                    client.sampled = None
+                    results.append((item, result))
+                    if on_result is not None:
+                        on_result(item, result)
+
+        while True:
+            self.batch.n_tokens = 0
+            # ---- Next token of every generating client ----
+            for client in clients:
+                if client.item is not None and client.sampled is not None:
+                    pos = len(self.tokens_system) + client.n_prompt + client.n_decoded - 1
+                    client.i_batch = batch_add(self.batch, client.sampled, pos, client.id + 1, True)
+            # ---- New questions for the idle clients (continuous batching) ----
+            for client in clients:
+                while client.item is None and pending:
+                    item = pending[-1]
+                    tokens = self._question_tokens(item)
+                    budget = max_tokens(item[1]) if callable(max_tokens) else max_tokens
+                    if len(self.tokens_system) + len(tokens) + budget > self.n_ctx:
+                        # Would not fit in the context even alone, llama_decode would fail at every step
+                        pending.pop()
+                        print(f"❌ Seq {item[0]}: {len(tokens)} question tokens + {budget} to generate do not fit "
+                              f"in n_ctx {self.n_ctx} after the system prompt, skipped")
+                        continue
+                    if self.batch.n_tokens > 0 and self.batch.n_tokens + len(tokens) > self.n_batch:
+                        break  # next step, a question longer than n_batch goes alone and is decoded in chunks
+                    pending.pop()
+                    client.sampled = None
+                    self._start(client, item, tokens, budget)
+                if client.item is None and pending:
+                    break
+            if self.batch.n_tokens == 0:
+                break
+            self._decode(sample)
+        return [r for _, r in results]
+
+    def close(self):
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
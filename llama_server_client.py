@@ -0,0 +1,279 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+# ==========================
+#       Transports
+# ==========================
+class StreamTransport:
+    """
+    Minimal interface used by the async client to talk to llama-server.
+    A transport only needs to know how to probe an endpoint and how to stream
+    the server-sent events of a POST request. Failures of the request (HTTP error,
+    connection dropped mid-stream) are raised as ConnectionError, the OSError the
+    runners catch to skip one question instead of aborting the directory.
+    """
+
+    async def get_status(self, path: str) -> int:
+        """Return the HTTP status code of a GET request on `path`."""
+        raise NotImplementedError
+
+    def stream_post(self, path: str, payload: dict):
+        """Async iterator over the JSON events sent back by a streamed POST on `path`."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class AsyncioTransport(StreamTransport):
+    """
+    Dependency free HTTP/1.1 transport built on asyncio streams.
+    One connection is opened per request, closing it early (when the stop word has
+    been seen) makes llama-server release the slot right away.
+    """
+
+    def __init__(self, base_url: str = "http://localhost:8080"):
+        url = urlsplit(base_url)
+        self.host = url.hostname or "localhost"
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip("/")
+
+    async def _request(self, method: str, path: str, body: bytes = b""):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        head = (
+            f"{method} {self.prefix}{path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Accept: text/event-stream, application/json\r\n"
+            f"Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("ascii") + body)
+        await writer.drain()
+
+        try:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError(f"Empty response from {self.host}:{self.port}{path}")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+        except (IndexError, ValueError) as e:
+            writer.close()
+            raise ConnectionError(f"Malformed response from {self.host}:{self.port}{path}") from e
+        except BaseException:
+            writer.close()
+            raise
+        return status, headers, reader, writer
+
+    @staticmethod
+    async def _iter_body(headers: dict, reader: asyncio.StreamReader):
+        """Yield the raw body chunks, handling chunked transfer encoding."""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await reader.readline()
+                if not size_line:
+                    return
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    return
+                data = await reader.readexactly(size)
+                await reader.readline()  # trailing CRLF
+                yield data
+        elif "content-length" in headers:
+            yield await reader.readexactly(int(headers["content-length"]))
+        else:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                yield data
+
+    async def get_status(self, path: str) -> int:
+        status, _, _, writer = await self._request("GET", path)
+        writer.close()
+        return status
+
+    async def stream_post(self, path: str, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        status, headers, reader, writer = await self._request("POST", path, body)
+        try:
+            if status != 200:
+                error = b"".join([chunk async for chunk in self._iter_body(headers, reader)])
+                raise ConnectionError(f"HTTP {status} on {path}: {error[:200]!r}")
+
+            if not headers.get("content-type", "").startswith("text/event-stream"):
+                # Server answered with a single JSON body (stream disabled)
+                data = b"".join([chunk async for chunk in self._iter_body(headers, reader)])
+                yield json.loads(data)
+                return
+
+            buffer = b""
+            async for chunk in self._iter_body(headers, reader):
+                buffer += chunk
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    line = line.strip()
+                    if line.startswith(b"data:"):
+                        data = line[len(b"data:"):].strip()
+                        if data and data != b"[DONE]":
+                            yield json.loads(data)
+        except asyncio.IncompleteReadError as e:
+            # Connection closed in the middle of a chunk (server killed, slot dropped)
+            raise ConnectionError(f"Connection closed during {path}: {e}") from e
+        finally:
+            writer.close()
+
+
+class AiohttpTransport(StreamTransport):
+    """Transport based on aiohttp (keeps a connection pool across requests)."""
+
+    def __init__(self, base_url: str = "http://localhost:8080"):
+        import aiohttp  # only needed for this transport
+        self._aiohttp = aiohttp
+        self.base_url = base_url.rstrip("/")
+        self.session = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = self._aiohttp.ClientSession(timeout=self._aiohttp.ClientTimeout(total=None))
+        return self.session
+
+    async def get_status(self, path: str) -> int:
+        try:
+            async with self._session().get(self.base_url + path) as r:
+                return r.status
+        except self._aiohttp.ClientError as e:
+            raise ConnectionError(f"GET {path} failed: {e}") from e
+
+    async def stream_post(self, path: str, payload: dict):
+        try:
+            async with self._session().post(self.base_url + path, json=payload) as r:
+                r.raise_for_status()
+                if r.content_type != "text/event-stream":
+                    yield await r.json()
+                    return
+                async for line in r.content:
+                    line = line.strip()
+                    if line.startswith(b"data:"):
+                        data = line[len(b"data:"):].strip()
+                        if data and data != b"[DONE]":
+                            yield json.loads(data)
+        except self._aiohttp.ClientError as e:
+            # HTTP errors (raise_for_status), payload cut mid-stream, disconnections
+            raise ConnectionError(f"POST {path} failed: {e}") from e
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+def make_transport(base_url: str = "http://localhost:8080", kind: str = "auto") -> StreamTransport:
+    """Build a transport: 'aiohttp', 'asyncio', or 'auto' (aiohttp when installed)."""
+    if kind in ("auto", "aiohttp"):
+        try:
+            return AiohttpTransport(base_url)
+        except ImportError:
+            if kind == "aiohttp":
+                raise
+    return AsyncioTransport(base_url)
+
+
+# ==========================
+#       Requests
+# ==========================
+async def wait_for_server_async(transport: StreamTransport, timeout: float = 60, interval: float = 1) -> bool:
+    """Async counterpart of wait_for_server: poll /health until it answers 200."""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            if await transport.get_status("/health") == 200:
+                print("✅ Server is ready")
+                return True
+        except OSError:
+            pass
+        print("⌛ Waiting for server...")
+        await asyncio.sleep(interval)
+    raise TimeoutError(f"Server not ready after {timeout} seconds")
+
+
+async def stream_completion(transport: StreamTransport, payload: dict, stop_words=("YES", "NO"), on_token=None) -> dict:
+    """
+    Stream a /completions request and return as soon as a stop word shows up.
+    `on_token(piece)` is called for every piece of generated text.
+
+    Returns:
+        dict: content (stop word excluded), stopping_word, the last `timings` reported
+              by the server, n_tokens streamed and time_to_first_token (seconds).
+    """
+    payload = dict(payload, stream=True)
+    content = ""
+    result = {"content": "", "stopping_word": "", "timings": {}, "n_tokens": 0,
+              "time_to_first_token": None, "stop_reason": "eos", "id_slot": None}
+    start = time.perf_counter()
+
+    events = transport.stream_post("/completions", payload)
+    try:
+        async for event in events:
+            piece = event.get("content", "")
+            if piece:
+                if result["time_to_first_token"] is None:
+                    result["time_to_first_token"] = time.perf_counter() - start
+                result["n_tokens"] += 1
+                content += piece
+                if on_token is not None:
+                    on_token(piece)
+            if "timings" in event:
+                result["timings"] = event["timings"]
+            if event.get("id_slot") is not None:
+                result["id_slot"] = event["id_slot"]
+
+            if event.get("stop"):
+                result["stopping_word"] = event.get("stopping_word", "")
+                if event.get("stop_type"):
+                    result["stop_reason"] = event["stop_type"]
+                elif result["stopping_word"]:
+                    result["stop_reason"] = "word"
+                break
+
+            # The server holds back partial matches, but a word can still arrive whole in a piece
+            found = [(content.find(w), w) for w in stop_words if w in content]
+            if found:
+                pos, word = min(found)
+                content = content[:pos]
+                result["stopping_word"] = word
+                result["stop_reason"] = "word"
+                break
+    finally:
+        await events.aclose()
+
+    result["content"] = content
+    return result
+
+
+async def run_bounded(items, handler, n_in_flight: int):
+    """
+    Run `handler(item)` over `items` keeping exactly `n_in_flight` calls running.
+    Workers pull from a shared queue so a new request only starts when one finishes.
+    """
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await handler(item)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, n_in_flight))))
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import pathlib
+import re
+
+# ==========================
+#   Per-question n_predict
+# ==========================
+# The distance columns of reachability_questions.txt (distance, then for trees
+# distance_with_backtracking and distance_height) tell how many hops the model has
+# to walk through, so they bound how long a reasonable answer is. A flat n_predict
+# sized for the hardest question keeps slots busy on rambling short-distance answers.
+
+FEATURES = ("distance", "distance_with_backtracking", "distance_height")
+
+
+def distance_features(distances) -> list[float]:
+    """Absolute values of the distance columns (negative distances are unreachable pairs), padded to 3."""
+    values = [abs(float(d)) for d in list(distances)[:len(FEATURES)]]
+    return values + [0.0] * (len(FEATURES) - len(values))
+
+
+class TokenBudget:
+    """
+    n_predict = margin * (base + per_hop . |distances|), clamped to [min_tokens, max_tokens].
+    The coefficients can be fitted from the answers of previous runs with `fit`.
+    """
+
+    def __init__(self, base=256.0, per_hop=(64.0, 0.0, 0.0), margin=2.0, min_tokens=128, max_tokens=4096):
+        self.base = base
+        self.per_hop = list(per_hop)
+        self.margin = margin
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+
+    def predict(self, distances) -> float:
+        """Expected response length, without margin nor clamping."""
+        return self.base + sum(c * x for c, x in zip(self.per_hop, distance_features(distances)))
+
+    def __call__(self, distances) -> int:
+        budget = int(self.margin * self.predict(distances) + 0.5)
+        return max(self.min_tokens, min(self.max_tokens, budget))
+
+    @classmethod
+    def fit(cls, samples, quantile=0.95, min_tokens=128, max_tokens=4096):
+        """
+        Least squares fit of the response length on the distance columns, the margin being
+        the `quantile` of observed/predicted so that most answers fit in their budget.
+
+        Args:
+            samples: list of (distances, n_tokens) pairs taken from previous runs
+            quantile (float): share of the observed answers that must fit in the budget
+
+        Returns:
+            TokenBudget: the fitted model
+        """
+        if not samples:
+            raise ValueError("No sample to fit the token budget on")
+        rows = [distance_features(d) for d, _ in samples]
+        ys = [float(n) for _, n in samples]
+        # Only the columns that vary can be fitted (linear experiments only have the distance)
+        used = [j for j in range(len(FEATURES)) if len({r[j] for r in rows}) > 1]
+        coefs = _least_squares([[1.0] + [r[j] for j in used] for r in rows], ys)
+
+        per_hop = [0.0] * len(FEATURES)
+        for j, c in zip(used, coefs[1:]):
+            per_hop[j] = max(0.0, c)  # a longer chain never needs a shorter answer
+        model = cls(max(1.0, coefs[0]), per_hop, 1.0, min_tokens, max_tokens)
+
+        ratios = sorted(y / max(1.0, model.predict(d)) for (d, _), y in zip(samples, ys))
+        model.margin = max(1.0, ratios[min(len(ratios) - 1, int(quantile * len(ratios)))])
+        return model
+
+    def to_dict(self) -> dict:
+        return {"base": self.base, "per_hop": self.per_hop, "margin": self.margin,
+                "min_tokens": self.min_tokens, "max_tokens": self.max_tokens}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+
+def _least_squares(xs: list, ys: list) -> list:
+    """Solve the (slightly regularized) normal equations with Gauss-Jordan elimination."""
+    n = len(xs[0])
+    a = [[sum(x[i] * x[j] for x in xs) + (1e-6 if i == j else 0.0) for j in range(n)]
+         + [sum(x[i] * y for x, y in zip(xs, ys))] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(n):
+            if r != col and a[col][col]:
+                f = a[r][col] / a[col][col]
+                a[r] = [v - f * p for v, p in zip(a[r], a[col])]
+    return [a[i][n] / a[i][i] if a[i][i] else 0.0 for i in range(n)]
+
+
+def load_budget(path=None):
+    """Budget given by path or $REACHABILITY_BUDGET ('default' for the unfitted model), None if unset."""
+    path = path or os.getenv("REACHABILITY_BUDGET")
+    if not path:
+        return None
+    return TokenBudget() if path == "default" else TokenBudget.load(path)
+
+# ==========================
+#   Samples from past runs
+# ==========================
+RESULT_PATTERN = re.compile(r'^\[Q\s*(\d+)\]\s*Distance=([^\n]*)\nQuestion:[^\n]*\nAnswer:(.*?)(?=^\[Q\s*\d+\]|\Z)',
+                            re.MULTILINE | re.DOTALL)
+
+
+def approx_token_count(text: str) -> int:
+    """Rough count (words and punctuation) for when the model tokenizer is not at hand."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def collect_samples(roots, count_tokens=approx_token_count) -> list:
+    """(distances, response length) for every answer found in the results.txt files under the roots."""
+    samples = []
+    for root in roots:
+        for results_file in sorted(pathlib.Path(root).rglob("results.txt")):
+            content = results_file.read_text(encoding="utf-8", errors="replace")
+            for m in RESULT_PATTERN.finditer(content):
+                distances = [d.strip() for d in m.group(2).split(",") if d.strip()]
+                samples.append((distances, count_tokens(m.group(3).strip())))
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the per-question n_predict budget on previous results")
+    parser.add_argument("roots", nargs="+", help="directories searched recursively for results.txt")
+    parser.add_argument("--output", default="budget.json")
+    parser.add_argument("--quantile", type=float, default=0.95, help="share of observed answers the budget must cover")
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--model", default=None, help="model.gguf to count tokens exactly (see token_cache.py)")
+    parser.add_argument("--tokenizer", default=None, help="llama-tokenize executable, used if llama_cpp is missing")
+    args = parser.parse_args()
+
+    count_tokens = approx_token_count
+    if args.model:
+        from token_cache import TokenCounter
+        count_tokens = TokenCounter(args.model, args.tokenizer)
+
+    samples = collect_samples(args.roots, count_tokens)
+    budget = TokenBudget.fit(samples, args.quantile, max_tokens=args.max_tokens)
+    budget.save(args.output)
+    print(f"Fitted on {len(samples)} answers: {budget.to_dict()}")
+    covered = sum(1 for d, n in samples if n <= budget(d))
+    print(f"{covered / len(samples):.1%} of the observed answers fit in their budget")
+    by_distance = {}
+    for d, _ in samples:
+        if d:
+            by_distance.setdefault(int(abs(float(d[0]))), []).append(budget(d))
+    for d, budgets in sorted(by_distance.items()):
+        print(f"distance {d:>3}: n_predict {min(budgets)}-{max(budgets)}")
@@ -19,6 +19,8 @@
 #include <iostream>
 #include <filesystem>
 #include <cstdlib> 
+#include <set>
+#include <unordered_map>
 
 static std::string WORK_DIR = "LLAMA_WORK_DIR";
 
@@ -128,6 +130,125 @@ void append_result_to_env_directory(const std::string& subDir, int seq_id, const
     }
 }
 
+static std::string json_escape(const std::string& s) {
+    std::string out;
+    for (const char c : s) {
+        switch (c) {
+            case '"':  out += "\\\""; break;
+            case '\\': out += "\\\\"; break;
+            case '\n': out += "\\n"; break;
+            case '\t': out += "\\t"; break;
+            case '\r': out += "\\r"; break;
+            default:   out += c;
+        }
+    }
+    return out;
+}
+
+static std::vector<std::string> split_string(const std::string& input, char delimiter);
+
+// One JSON line per answered question in <output dir>/telemetry.jsonl, same fields as telemetry.py
+void append_telemetry_to_env_directory(const std::string& subDir, int n_ctx, int seq_id, const std::string& distance_str,
+                                       int n_prompt, int n_cached, int n_decoded, double queue_wait, double time_to_first_token,
+                                       double total_time, const std::string& stop_reason, int slot_id) {
+    const char* baseDir = std::getenv(WORK_DIR.c_str());
+    if (!baseDir) {
+        return;
+    }
+    std::filesystem::path fullDirPath = std::filesystem::path(baseDir) / subDir;
+    std::filesystem::create_directories(fullDirPath);
+    std::ofstream outFile(fullDirPath / "telemetry.jsonl", std::ios::app);
+    if (!outFile) {
+        std::cerr << "Error: Unable to open file " << fullDirPath / "telemetry.jsonl" << std::endl;
+        return;
+    }
+    std::string distances = "[";
+    for (const auto& d : split_string(distance_str, ',')) {
+        distances += (distances.size() > 1 ? ", \"" : "\"") + json_escape(::trim(d)) + "\"";
+    }
+    distances += "]";
+    const double decode_time = total_time - time_to_first_token;
+    outFile << "{\"runner\": \"reachability_bench_cpp\", \"model\": \"" << json_escape(subDir)
+            << "\", \"exp_dir\": \"" << json_escape(baseDir) << "\", \"ctx_size\": " << n_ctx
+            << ", \"seq_id\": " << seq_id << ", \"distances\": " << distances
+            << ", \"prompt_tokens\": " << n_prompt << ", \"cached_tokens\": " << n_cached
+            << ", \"generated_tokens\": " << n_decoded << ", \"queue_wait\": " << queue_wait
+            << ", \"time_to_first_token\": " << time_to_first_token << ", \"total_time\": " << total_time
+            << ", \"decode_tps\": ";
+    if (n_decoded > 1 && decode_time > 0) {
+        outFile << (n_decoded - 1) / decode_time;
+    } else {
+        outFile << "null";
+    }
+    outFile << ", \"stop_reason\": \"" << stop_reason << "\", \"slot_id\": " << slot_id
+            << ", \"timestamp\": " << (long long) std::time(nullptr) << "}\n";
+}
+
+// One CSV row per answered question in <output dir>/sequences.csv, with what only this runner knows:
+// prompt/generation split of the time, occupancy of the batches the sequence was decoded in
+// (active clients per llama_decode step), cache misses and drafted tokens during the sequence
+void append_sequence_stats_to_env_directory(const std::string& subDir, int seq_id, const std::string& distance_str, int client_id,
+                                            int n_prompt, int n_decoded, double t_queue, double t_prompt, double t_gen,
+                                            const std::string& stop_reason, double batch_occupancy, int n_steps,
+                                            int n_cache_miss, int n_drafted, int n_accepted) {
+    const char* baseDir = std::getenv(WORK_DIR.c_str());
+    if (!baseDir) {
+        return;
+    }
+    std::filesystem::path fullDirPath = std::filesystem::path(baseDir) / subDir;
+    std::filesystem::create_directories(fullDirPath);
+    const std::filesystem::path fullFilePath = fullDirPath / "sequences.csv";
+    const bool new_file = !std::filesystem::exists(fullFilePath) || std::filesystem::file_size(fullFilePath) == 0;
+    std::ofstream outFile(fullFilePath, std::ios::app);
+    if (!outFile) {
+        std::cerr << "Error: Unable to open file " << fullFilePath << std::endl;
+        return;
+    }
+    if (new_file) {
+        outFile << "seq_id,distance,client,n_prompt,n_decoded,t_queue,t_prompt,t_gen,gen_tps,stop_reason,"
+                   "batch_occupancy,n_steps,cache_misses,n_drafted,n_accepted\n";
+    }
+    outFile << seq_id << ",\"" << distance_str << "\"," << client_id << "," << n_prompt << "," << n_decoded << ","
+            << t_queue << "," << t_prompt << "," << t_gen << ",";
+    if (n_decoded > 1 && t_gen > 0) {
+        outFile << (n_decoded - 1) / t_gen;
+    }
+    outFile << "," << stop_reason << "," << batch_occupancy << "," << n_steps << "," << n_cache_miss << ","
+            << n_drafted << "," << n_accepted << "\n";
+}
+
+// Sequence ids already answered in a previous (interrupted) run, one per line in
+// <output dir>/completed_seq_ids.txt, written by run_experiment.py from the completion index
+std::set<int> read_completed_seq_ids(const std::string& subDir) {
+    std::set<int> done;
+    const char* baseDir = std::getenv(WORK_DIR.c_str());
+    if (!baseDir) {
+        return done;
+    }
+    std::ifstream file(std::filesystem::path(baseDir) / subDir / "completed_seq_ids.txt");
+    int seq_id;
+    while (file >> seq_id) {
+        done.insert(seq_id);
+    }
+    return done;
+}
+
+// Per-question generation budget, line i of <output dir>/n_predict.txt being the budget of seq i,
+// written by run_experiment.py from the distances (see predict_budget.py)
+std::vector<int> read_n_predict_budgets(const std::string& subDir) {
+    std::vector<int> budgets;
+    const char* baseDir = std::getenv(WORK_DIR.c_str());
+    if (!baseDir) {
+        return budgets;
+    }
+    std::ifstream file(std::filesystem::path(baseDir) / subDir / "n_predict.txt");
+    int n_predict;
+    while (file >> n_predict) {
+        budgets.push_back(n_predict);
+    }
+    return budgets;
+}
+
 std::string getFileNameWithoutExtension(const std::string& path) {
     //std::__fs::filesystem::path p(path);
     std::filesystem::path p(path);
@@ -221,9 +342,194 @@ struct client {
     std::string prompt;
     std::string response;
     std::string distance; //195: added for reachability
+    int32_t max_tokens = -1; // per-question budget, -1 when n_predict.txt is missing
     struct common_sampler * smpl = nullptr;
+
+    // speculative decoding
+    std::vector<llama_token> tokens; // question and answer tokens, after the system prompt
+    std::vector<llama_token> draft;  // drafted tokens verified in the current step
+    int32_t n_past_dft  = 0;         // tokens of `tokens` already in the draft model cache
+    int32_t i_batch_dft = -1;
+    int32_t n_drafted   = 0;
+    int32_t n_accepted  = 0;
+
+    // batch occupancy, for sequences.csv
+    int32_t n_steps        = 0; // llama_decode steps the sequence took part in
+    int32_t n_active_sum   = 0; // active clients summed over these steps
+    int32_t n_cache_miss_0 = 0; // n_cache_miss when the sequence started
+};
+
+// Speculative decoding (added for reachability): answers are step-by-step chains that
+// mostly copy method names from the system prompt, so drafted tokens are often right.
+// Drafts come from a small draft model (--spec-model) or from the context itself
+// (--spec-lookup, prompt lookup decoding), and are verified by the target model in the
+// same batched llama_decode as the other clients.
+struct spec_params {
+    bool        lookup    = false; // draft by n-gram lookup in the system prompt, question and answer
+    int32_t     n_draft   = 8;     // max drafted tokens per client and step
+    int32_t     ngram_max = 4;     // longest n-gram matched by the lookup (down to 1)
+    std::string model_draft;       // draft model, must share the vocabulary of the target
+    int32_t     n_gpu_layers_draft = -1; // -1: same as the target
 };
 
+// Take the --spec-* options out of argv, common_params_parse rejects unknown options
+static bool parse_spec_params(int & argc, char ** argv, spec_params & spec) {
+    int n_kept = 1;
+    for (int i = 1; i < argc; ++i) {
+        const std::string arg = argv[i];
+        if (arg == "--spec-lookup") {
+            spec.lookup = true;
+        } else if (arg == "--spec-draft" || arg == "--spec-ngram" || arg == "--spec-model" || arg == "--spec-gpu-layers") {
+            if (i + 1 >= argc) {
+                fprintf(stderr, "error: %s needs a value\n", arg.c_str());
+                return false;
+            }
+            const std::string value = argv[++i];
+            if (arg == "--spec-draft") {
+                spec.n_draft = std::stoi(value);
+            } else if (arg == "--spec-ngram") {
+                spec.ngram_max = std::stoi(value);
+            } else if (arg == "--spec-model") {
+                spec.model_draft = value;
+            } else {
+                spec.n_gpu_layers_draft = std::stoi(value);
+            }
+        } else {
+            argv[n_kept++] = argv[i];
+        }
+    }
+    argc = n_kept;
+    return true;
+}
+
+// Positions of the n-grams of the system prompt (n = 1 .. ngram_max), built once: the system
+// prompt is ~100k tokens, scanning it at every step of every client would dominate the lookup
+struct ngram_index {
+    int32_t ngram_max = 0;
+    std::vector<std::unordered_map<uint64_t, std::vector<int32_t>>> starts; // [n - 1]: hash -> start positions, increasing
+
+    static uint64_t hash(const llama_token * tokens, int32_t n) {
+        uint64_t h = 14695981039346656037ULL;
+        for (int32_t k = 0; k < n; ++k) {
+            h = (h ^ (uint32_t) tokens[k]) * 1099511628211ULL;
+        }
+        return h;
+    }
+
+    ngram_index(const std::vector<llama_token> & tokens_system, int32_t ngram_max) : ngram_max(ngram_max), starts(std::max(0, ngram_max)) {
+        for (int32_t n = 1; n <= ngram_max; ++n) {
+            for (int32_t start = 0; start + n <= (int32_t) tokens_system.size(); ++start) {
+                starts[n - 1][hash(tokens_system.data() + start, n)].push_back(start);
+            }
+        }
+    }
+};
+
+// Prompt lookup: the tokens that followed the latest earlier occurrence of the last n-gram
+// of the context (system prompt + question + answer so far), longest n-gram first. Only the
+// client's own tokens are scanned, the occurrences inside the system prompt come from the index
+static std::vector<llama_token> draft_prompt_lookup(const std::vector<llama_token> & tokens_system, const ngram_index & index,
+                                                    const std::vector<llama_token> & tokens, const spec_params & spec) {
+    std::vector<llama_token> draft;
+    const int32_t n_sys = tokens_system.size();
+    const int32_t n_all = n_sys + tokens.size();
+    auto at = [&](int32_t i) { return i < n_sys ? tokens_system[i] : tokens[i - n_sys]; };
+    auto matches = [&](int32_t start, int32_t n) {
+        for (int32_t k = 0; k < n; ++k) {
+            if (at(start + k) != at(n_all - n + k)) {
+                return false;
+            }
+        }
+        return true;
+    };
+
+    for (int32_t n = std::min(std::min(spec.ngram_max, index.ngram_max), n_all - 1); n >= 1 && draft.empty(); --n) {
+        // occurrences ending in the question or answer, the latest ones
+        int32_t found = -1;
+        for (int32_t start = n_all - n - 1; start > n_sys - n && found < 0; --start) {
+            if (matches(start, n)) {
+                found = start;
+            }
+        }
+        // then the latest one inside the system prompt (hashes are checked, they may collide)
+        if (found < 0) {
+            std::vector<llama_token> last(n);
+            for (int32_t k = 0; k < n; ++k) {
+                last[k] = at(n_all - n + k);
+            }
+            const auto it = index.starts[n - 1].find(ngram_index::hash(last.data(), n));
+            if (it != index.starts[n - 1].end()) {
+                for (auto start = it->second.rbegin(); start != it->second.rend() && found < 0; ++start) {
+                    if (*start <= n_all - n - 1 && matches(*start, n)) {
+                        found = *start;
+                    }
+                }
+            }
+        }
+        if (found >= 0) {
+            for (int32_t k = found + n; k < n_all && (int32_t) draft.size() < spec.n_draft; ++k) {
+                draft.push_back(at(k));
+            }
+        }
+    }
+    return draft;
+}
+
+// Draft up to n_draft tokens greedily with the draft model, for all the clients being decoded at once.
+// The draft context mirrors the target one: the system prompt in sequence 0, copied to each client.
+static void draft_with_model(llama_context * ctx_dft, llama_batch & batch_dft, std::vector<client> & clients,
+                             int32_t n_tokens_system, const spec_params & spec) {
+    const llama_vocab * vocab_dft = llama_model_get_vocab(llama_get_model(ctx_dft));
+    const int32_t n_vocab = llama_vocab_n_tokens(vocab_dft);
+    auto argmax = [&](int32_t idx) {
+        const float * logits = llama_get_logits_ith(ctx_dft, idx);
+        return (llama_token) (std::max_element(logits, logits + n_vocab) - logits);
+    };
+
+    // catch up with the tokens the draft model has not seen yet (question, accepted tokens),
+    // the logits of the last one give the first drafted token
+    common_batch_clear(batch_dft);
+    for (auto & client : clients) {
+        client.draft.clear();
+        client.i_batch_dft = -1;
+        if (client.seq_id == -1 || client.n_past_dft >= (int32_t) client.tokens.size()) {
+            continue;
+        }
+        for (size_t k = client.n_past_dft; k < client.tokens.size(); ++k) {
+            common_batch_add(batch_dft, client.tokens[k], n_tokens_system + k, { client.id + 1 }, k + 1 == client.tokens.size());
+        }
+        client.n_past_dft  = client.tokens.size();
+        client.i_batch_dft = batch_dft.n_tokens - 1;
+    }
+
+    for (int32_t r = 0; r < spec.n_draft && batch_dft.n_tokens > 0; ++r) {
+        if (llama_decode(ctx_dft, batch_dft) != 0) {
+            LOG_ERR("%s: draft llama_decode() failed, no draft for this step\n", __func__);
+            break;
+        }
+        common_batch_clear(batch_dft);
+        for (auto & client : clients) {
+            if (client.i_batch_dft < 0) {
+                continue;
+            }
+            client.draft.push_back(argmax(client.i_batch_dft));
+            client.i_batch_dft = -1;
+            if (r + 1 < spec.n_draft) {
+                client.i_batch_dft = batch_dft.n_tokens;
+                common_batch_add(batch_dft, client.draft.back(), n_tokens_system + client.n_past_dft + r, { client.id + 1 }, true);
+            }
+        }
+    }
+
+    // the drafted tokens are not kept in the draft cache, the accepted ones come back with the next catch up
+    for (auto & client : clients) {
+        client.i_batch_dft = -1;
+        if (client.seq_id != -1) {
+            llama_memory_seq_rm(llama_get_memory(ctx_dft), client.id + 1, n_tokens_system + client.n_past_dft, -1);
+        }
+    }
+}
+
 static void print_date_time() {
     std::time_t current_time = std::time(nullptr);
     std::tm* local_time = std::localtime(&current_time);
@@ -254,6 +560,11 @@ int main(int argc, char ** argv) {
     // default value, should be toggled by command line
     params.n_predict = 128;
 
+    spec_params spec;
+    if (!parse_spec_params(argc, argv, spec)) {
+        return 1;
+    }
+
     if (!common_params_parse(argc, argv, params, LLAMA_EXAMPLE_PARALLEL)) {
         return 1;
     }
@@ -288,6 +599,33 @@ int main(int argc, char ** argv) {
     llama_context * ctx = llama_init.context.get();
     const llama_vocab * vocab = llama_model_get_vocab(model);
 
+    // load the draft model, with the same context settings as the target (one sequence per client)
+    llama_model   * model_dft = nullptr;
+    llama_context * ctx_dft   = nullptr;
+    if (!spec.model_draft.empty()) {
+        llama_model_params mparams_dft = common_model_params_to_llama(params);
+        if (spec.n_gpu_layers_draft >= 0) {
+            mparams_dft.n_gpu_layers = spec.n_gpu_layers_draft;
+        }
+        model_dft = llama_model_load_from_file(spec.model_draft.c_str(), mparams_dft);
+        if (model_dft == nullptr) {
+            LOG_ERR("%s: failed to load the draft model %s\n", __func__, spec.model_draft.c_str());
+            return 1;
+        }
+        const llama_vocab * vocab_dft = llama_model_get_vocab(model_dft);
+        if (llama_vocab_n_tokens(vocab_dft) != llama_vocab_n_tokens(vocab) ||
+            llama_vocab_bos(vocab_dft) != llama_vocab_bos(vocab) || llama_vocab_eos(vocab_dft) != llama_vocab_eos(vocab)) {
+            LOG_ERR("%s: the draft model does not share the vocabulary of the target model\n", __func__);
+            return 1;
+        }
+        ctx_dft = llama_init_from_model(model_dft, common_context_params_to_llama(params));
+        if (ctx_dft == nullptr) {
+            LOG_ERR("%s: failed to create the draft context\n", __func__);
+            return 1;
+        }
+    }
+    const bool speculative = spec.lookup || ctx_dft != nullptr;
+
     // 261-278 commented out for reachability
     // (although it's almost what we want)
     // load the prompts from an external file if there are any
@@ -326,15 +664,25 @@ int main(int argc, char ** argv) {
     std::vector<llama_token> tokens_system = common_tokenize(ctx, k_system, true);
     const int32_t n_tokens_system = tokens_system.size();
 
+    // n-gram positions of the system prompt for the prompt lookup, empty otherwise
+    const ngram_index lookup_index(tokens_system, spec.lookup && !ctx_dft ? spec.ngram_max : 0);
+
     llama_seq_id g_seq_id = 0;
 
     // the max batch size is as large as the context to handle cases where we get very long input prompt from multiple
     // users. regardless of the size, the main loop will chunk the batch into a maximum of params.n_batch tokens at a time
     llama_batch batch = llama_batch_init(n_ctx, 0, 1);
+    llama_batch batch_dft = ctx_dft ? llama_batch_init(n_ctx, 0, 1) : llama_batch{};
 
     int32_t n_total_prompt = 0;
     int32_t n_total_gen    = 0;
     int32_t n_cache_miss   = 0;
+    int32_t n_drafted      = 0;
+    int32_t n_accepted     = 0;
+    int32_t n_steps        = 0;
+    int64_t n_active_sum   = 0;
+    int64_t n_batch_tokens = 0;
+    int32_t n_answered     = 0;
     
     // Old: http://github.com/abetlen/llama-cpp-python/issues/2026
     // struct llama_kv_cache_view kvc_view = llama_kv_cache_view_init(ctx, n_clients);
@@ -366,14 +714,47 @@ int main(int argc, char ** argv) {
             llama_memory_seq_cp(llama_get_memory(ctx), 0, i, -1, -1);
         }
 
+        if (ctx_dft) {
+            common_batch_clear(batch_dft);
+            for (int32_t i = 0; i < n_tokens_system; ++i) {
+                common_batch_add(batch_dft, tokens_system[i], i, { 0 }, false);
+            }
+            if (llama_decode(ctx_dft, batch_dft) != 0) {
+                LOG_ERR("%s: draft llama_decode() failed\n", __func__);
+                return 1;
+            }
+            for (int32_t i = 1; i <= n_clients; ++i) {
+                llama_memory_seq_cp(llama_get_memory(ctx_dft), 0, i, -1, -1);
+            }
+        }
+
         LOG_INF("\n");
     }
+
+    const double t_system = (ggml_time_us() - t_main_start) / 1e6;
+
+    if (speculative) {
+        LOG_INF("%s: speculative decoding with %s, up to %d drafted tokens per step\n", __func__,
+                ctx_dft ? spec.model_draft.c_str() : "prompt lookup", spec.n_draft);
+    }
    
    LOG_INF("Processing requests ...\n\n");
 
     // 339-340: added for reachability
     std::string output_dir = "output-" + getFileNameWithoutExtension(params.model.path);
 
+    // resume: questions already answered are not asked again
+    const std::set<int> completed_seq_ids = read_completed_seq_ids(output_dir);
+    if (!completed_seq_ids.empty()) {
+        LOG_INF("%s: skipping %zu already answered sequences\n", __func__, completed_seq_ids.size());
+    }
+
+    // per-question n_predict derived from the distances
+    const std::vector<int> n_predict_budgets = read_n_predict_budgets(output_dir);
+    if (!n_predict_budgets.empty()) {
+        LOG_INF("%s: using per-question n_predict budgets for %zu sequences\n", __func__, n_predict_budgets.size());
+    }
+
     while (true) {
         if (dump_kv_cache) {
             // Old:
@@ -384,6 +765,10 @@ int main(int argc, char ** argv) {
 
         common_batch_clear(batch);
 
+        if (ctx_dft) {
+            draft_with_model(ctx_dft, batch_dft, clients, n_tokens_system, spec);
+        }
+
         // ---- 2. Resume active clients ---
         // decode any currently ongoing sequences
         for (auto & client : clients) {
@@ -393,9 +778,24 @@ int main(int argc, char ** argv) {
 
             client.i_batch = batch.n_tokens;
 
-            common_batch_add(batch, client.sampled, n_tokens_system + client.n_prompt + client.n_decoded, { client.id + 1 }, true);
+            const int32_t pos = n_tokens_system + client.n_prompt + client.n_decoded;
+            common_batch_add(batch, client.sampled, pos, { client.id + 1 }, true);
 
             client.n_decoded += 1;
+
+            if (speculative) {
+                if (spec.lookup && !ctx_dft) {
+                    client.draft = draft_prompt_lookup(tokens_system, lookup_index, client.tokens, spec);
+                }
+                // the drafted tokens are verified with the logits of the same chunk as the sampled token
+                const int32_t room = params.n_batch - 1 - client.i_batch % params.n_batch;
+                if ((int32_t) client.draft.size() > room) {
+                    client.draft.resize(room);
+                }
+                for (size_t k = 0; k < client.draft.size(); ++k) {
+                    common_batch_add(batch, client.draft[k], pos + 1 + k, { client.id + 1 }, true);
+                }
+            }
         }
 
         if (batch.n_tokens == 0) {
@@ -409,6 +809,10 @@ int main(int argc, char ** argv) {
                 llama_memory_seq_rm(llama_get_memory(ctx), i, -1, -1);
                 // but keep the system prompt
                 llama_memory_seq_cp(llama_get_memory(ctx), 0, i, -1, -1);
+                if (ctx_dft) {
+                    llama_memory_seq_rm(llama_get_memory(ctx_dft), i, -1, -1);
+                    llama_memory_seq_cp(llama_get_memory(ctx_dft), 0, i, -1, -1);
+                }
             }
 
             LOG_INF("%s: clearing the KV cache (restored to system prompt)\n", __func__);
@@ -418,6 +822,9 @@ int main(int argc, char ** argv) {
         // insert new sequences for decoding
         if (cont_batching || batch.n_tokens == 0) {
             for (auto & client : clients) {
+                while (g_seq_id < n_seq && completed_seq_ids.count(g_seq_id)) {
+                    g_seq_id += 1;
+                }
                 if (client.seq_id == -1 && g_seq_id < n_seq) {
                     client.seq_id = g_seq_id;
                     client.t_start_prompt = ggml_time_us();
@@ -438,6 +845,7 @@ int main(int argc, char ** argv) {
                         distances += input[j];
                     }
                     client.distance = distances;
+                    client.max_tokens = g_seq_id < (int) n_predict_budgets.size() ? n_predict_budgets[g_seq_id] : -1;
                     client.prompt   = client.input + "\nAssistant:";
                     client.response = "";
 
@@ -458,6 +866,14 @@ int main(int argc, char ** argv) {
                     client.n_prompt  = tokens_prompt.size();
                     client.n_decoded = 0;
                     client.i_batch   = batch.n_tokens - 1;
+                    client.tokens    = tokens_prompt;
+                    client.draft.clear();
+                    client.n_past_dft = 0;
+                    client.n_drafted  = 0;
+                    client.n_accepted = 0;
+                    client.n_steps        = 0;
+                    client.n_active_sum   = 0;
+                    client.n_cache_miss_0 = n_cache_miss;
 
                     LOG_INF("\033[31mClient %3d, seq %4d, started decoding ...\033[0m\n", client.id, client.seq_id);
 
@@ -475,10 +891,26 @@ int main(int argc, char ** argv) {
             break;
         }
 
+        // batch occupancy: clients decoded together in this step
+        const int32_t n_active = std::count_if(clients.begin(), clients.end(), [](const client & c) { return c.seq_id != -1; });
+        for (auto & client : clients) {
+            if (client.seq_id != -1) {
+                client.n_steps      += 1;
+                client.n_active_sum += n_active;
+            }
+        }
+        n_steps        += 1;
+        n_active_sum   += n_active;
+        n_batch_tokens += batch.n_tokens;
+
         // ---- 4. Process batches ----
         // process in chunks of params.n_batch
         int32_t n_batch = params.n_batch;
 
+        // (sequence, first position) of the steps undone by a retry with a smaller n_batch, their
+        // cells are removed once the whole batch is decoded (the leftover drafted tokens included)
+        std::vector<std::pair<llama_seq_id, llama_pos>> undone;
+
         for (int32_t i = 0; i < (int32_t) batch.n_tokens; i += n_batch) {
             // experiment: process in powers of 2
             //if (i + n_batch > (int32_t) batch.n_tokens && n_batch > 32) {
@@ -528,75 +960,154 @@ int main(int argc, char ** argv) {
                 //printf("client %d, seq %d, token %d, pos %d, batch %d\n",
                 //        client.id, client.seq_id, client.sampled, client.n_decoded, client.i_batch);
 
-                const llama_token id = common_sampler_sample(client.smpl, ctx, client.i_batch - i);
-                common_sampler_accept(client.smpl, id, true);
-
-                if (client.n_decoded == 1) {
-                    // start measuring generation time after the first token to make sure all concurrent clients
-                    // have their prompt already processed
-                    client.t_start_gen = ggml_time_us();
+                // drafted tokens cut from the sampled token by a retry with a smaller n_batch: the
+                // step is undone for this client, its sampled token is decoded again in the next one.
+                // The rest of its drafted tokens are still decoded by the next chunks, so its cells
+                // are only removed after the loop
+                if (client.i_batch + (int32_t) client.draft.size() >= (int32_t) (i + n_tokens)) {
+                    undone.emplace_back(client.id + 1, n_tokens_system + client.n_prompt + client.n_decoded - 1);
+                    client.n_decoded -= 1;
+                    client.draft.clear();
+                    client.i_batch = -1;
+                    continue;
                 }
 
-                const std::string token_str = common_token_to_piece(ctx, id);
-
-                client.response += token_str;
-                client.sampled = id;
-
-                //printf("client %d, seq %d, token %d, pos %d, batch %d: %s\n",
-                //        client.id, client.seq_id, id, client.n_decoded, client.i_batch, token_str.c_str());
-
-                // 498-505: added and changed for reachability, but should be debugged (threshold too small)
-		// commenting out max_tokens: let's figure it out in the generator, given the task, etc
-                //int max_tokens = std::max(500,std::abs(client.distance));
-                if (client.n_decoded > 2 &&
-                        (llama_vocab_is_eog(vocab, id) ||
-                         (params.n_predict > 0 && client.n_decoded + client.n_prompt >= params.n_predict) ||
-                         //(client.n_decoded + client.n_prompt >= max_tokens) || // added for reachability
-                         client.response.find("User:") != std::string::npos ||
-                         client.response.find("YES") != std::string::npos ||  // added for reachability
-                         client.response.find("NO") != std::string::npos  // added for reachability
-                        )) {
-                        // commented out to allow multi-line responses
-                        //client.response.find('\n') != std::string::npos
-                    // basic reverse prompt
-                    const size_t pos = client.response.find("User:");
-                    if (pos != std::string::npos) {
-                        client.response = client.response.substr(0, pos);
+                std::vector<llama_token> ids;
+                if (client.draft.empty()) {
+                    const llama_token id = common_sampler_sample(client.smpl, ctx, client.i_batch - i);
+                    common_sampler_accept(client.smpl, id, true);
+                    ids.push_back(id);
+                } else {
+                    // the target samples after the sampled token and after each drafted token,
+                    // and keeps the drafted tokens until the first one it disagrees with
+                    std::vector<int> idxs(client.draft.size() + 1);
+                    for (size_t k = 0; k < idxs.size(); ++k) {
+                        idxs[k] = client.i_batch - i + k;
                     }
+                    ids = common_sampler_sample_and_accept_n(client.smpl, ctx, idxs, client.draft);
 
-                    // delete only the generated part of the sequence, i.e. keep the system prompt in the cache
-                    // Old:
-                    // llama_kv_self_seq_rm(ctx,    client.id + 1, -1, -1);
-                    // llama_kv_self_seq_cp(ctx, 0, client.id + 1, -1, -1);
-                    // New:
-                    llama_memory_seq_rm(llama_get_memory(ctx),    client.id + 1, -1, -1);
-                    llama_memory_seq_cp(llama_get_memory(ctx), 0, client.id + 1, -1, -1);
-
-                    const auto t_main_end = ggml_time_us();
+                    client.n_drafted += client.draft.size();
+                    client.n_accepted += ids.size() - 1;
+                    n_drafted  += client.draft.size();
+                    n_accepted += ids.size() - 1;
 
-                    LOG_INF("\033[31mClient %3d, seq %3d/%3d, prompt %4d t, response %4d t, time %5.2f s, speed %5.2f t/s, cache miss %d \033[0m \n\nInput:    %s\n\033[35mResponse: %s\033[0m\n\n",
-                            client.id, client.seq_id, n_seq, client.n_prompt, client.n_decoded,
-                            (t_main_end - client.t_start_prompt) / 1e6,
-                            (double) (client.n_prompt + client.n_decoded) / (t_main_end - client.t_start_prompt) * 1e6,
-                            n_cache_miss,
-                            ::trim(client.input).c_str(),
-                            ::trim(client.response).c_str());
+                    // the rejected drafted tokens leave the cache
+                    llama_memory_seq_rm(llama_get_memory(ctx), client.id + 1, n_tokens_system + client.n_prompt + client.n_decoded + ids.size() - 1, -1);
+                    client.draft.clear();
+                }
 
-                    // 529-530: added for reachability
-                    // write_result_to_env_directory(output_dir, "result" + std::to_string(client.seq_id) + "_" + std::to_string(client.distance) + ".txt", ::trim(client.input), ::trim(client.response).c_str());
-                    
-                    // modified to avoid generating too many files
-                    append_result_to_env_directory(output_dir, client.seq_id, client.distance, ::trim(client.input), ::trim(client.response));
+                // one generated token per accepted id, the stop checks see them one by one
+                const int32_t n_decoded_step = client.n_decoded;
+                for (size_t k = 0; k < ids.size(); ++k) {
+                    client.n_decoded = n_decoded_step + k;
+                    const llama_token id = ids[k];
 
-                    n_total_prompt += client.n_prompt;
-                    n_total_gen    += client.n_decoded;
+                    if (client.n_decoded == 1) {
+                        // start measuring generation time after the first token to make sure all concurrent clients
+                        // have their prompt already processed
+                        client.t_start_gen = ggml_time_us();
+                    }
 
-                    client.seq_id = -1;
+                    const std::string token_str = common_token_to_piece(ctx, id);
+
+                    client.response += token_str;
+                    client.sampled = id;
+                    client.tokens.push_back(id);
+
+                    //printf("client %d, seq %d, token %d, pos %d, batch %d: %s\n",
+                    //        client.id, client.seq_id, id, client.n_decoded, client.i_batch, token_str.c_str());
+
+                    // 498-505: added and changed for reachability
+                    // max_tokens comes from the distances of the question (n_predict.txt), see predict_budget.py
+                    if (client.n_decoded > 2 &&
+                            (llama_vocab_is_eog(vocab, id) ||
+                             (params.n_predict > 0 && client.n_decoded + client.n_prompt >= params.n_predict) ||
+                             (client.max_tokens > 0 && client.n_decoded >= client.max_tokens) || // added for reachability
+                             client.response.find("User:") != std::string::npos ||
+                             client.response.find("YES") != std::string::npos ||  // added for reachability
+                             client.response.find("NO") != std::string::npos  // added for reachability
+                            )) {
+                            // commented out to allow multi-line responses
+                            //client.response.find('\n') != std::string::npos
+                        // same order as the condition above
+                        const std::string stop_reason =
+                            llama_vocab_is_eog(vocab, id) ? "eos" :
+                            (params.n_predict > 0 && client.n_decoded + client.n_prompt >= params.n_predict) ? "length" :
+                            (client.max_tokens > 0 && client.n_decoded >= client.max_tokens) ? "max_tokens" :
+                            client.response.find("User:") != std::string::npos ? "User:" :
+                            client.response.find("YES") != std::string::npos ? "YES" : "NO";
+
+                        // basic reverse prompt
+                        const size_t pos = client.response.find("User:");
+                        if (pos != std::string::npos) {
+                            client.response = client.response.substr(0, pos);
+                        }
+
+                        // delete only the generated part of the sequence, i.e. keep the system prompt in the cache
+                        // Old:
+                        // llama_kv_self_seq_rm(ctx,    client.id + 1, -1, -1);
+                        // llama_kv_self_seq_cp(ctx, 0, client.id + 1, -1, -1);
+                        // New:
+                        llama_memory_seq_rm(llama_get_memory(ctx),    client.id + 1, -1, -1);
+                        llama_memory_seq_cp(llama_get_memory(ctx), 0, client.id + 1, -1, -1);
+
+                        const auto t_main_end = ggml_time_us();
+
+                        LOG_INF("\033[31mClient %3d, seq %3d/%3d, prompt %4d t, response %4d t, time %5.2f s, speed %5.2f t/s, cache miss %d \033[0m \n\nInput:    %s\n\033[35mResponse: %s\033[0m\n\n",
+                                client.id, client.seq_id, n_seq, client.n_prompt, client.n_decoded,
+                                (t_main_end - client.t_start_prompt) / 1e6,
+                                (double) (client.n_prompt + client.n_decoded) / (t_main_end - client.t_start_prompt) * 1e6,
+                                n_cache_miss,
+                                ::trim(client.input).c_str(),
+                                ::trim(client.response).c_str());
+
+                        // 529-530: added for reachability
+                        // write_result_to_env_directory(output_dir, "result" + std::to_string(client.seq_id) + "_" + std::to_string(client.distance) + ".txt", ::trim(client.input), ::trim(client.response).c_str());
+                    
+                        // modified to avoid generating too many files
+                        append_result_to_env_directory(output_dir, client.seq_id, client.distance, ::trim(client.input), ::trim(client.response));
+                        append_telemetry_to_env_directory(output_dir, n_ctx, client.seq_id, client.distance,
+                                                          client.n_prompt, n_tokens_system, client.n_decoded,
+                                                          (client.t_start_prompt - t_main_start) / 1e6,
+                                                          (client.t_start_gen - client.t_start_prompt) / 1e6,
+                                                          (t_main_end - client.t_start_prompt) / 1e6,
+                                                          stop_reason, client.id);
+                        append_sequence_stats_to_env_directory(output_dir, client.seq_id, client.distance, client.id,
+                                                               client.n_prompt, client.n_decoded,
+                                                               (client.t_start_prompt - t_main_start) / 1e6,
+                                                               (client.t_start_gen - client.t_start_prompt) / 1e6,
+                                                               (t_main_end - client.t_start_gen) / 1e6,
+                                                               stop_reason,
+                                                               client.n_steps > 0 ? (double) client.n_active_sum / client.n_steps : 0.0,
+                                                               client.n_steps, n_cache_miss - client.n_cache_miss_0,
+                                                               client.n_drafted, client.n_accepted);
+
+                        n_total_prompt += client.n_prompt;
+                        n_total_gen    += client.n_decoded;
+                        n_answered     += 1;
+
+                        if (ctx_dft) {
+                            llama_memory_seq_rm(llama_get_memory(ctx_dft),    client.id + 1, -1, -1);
+                            llama_memory_seq_cp(llama_get_memory(ctx_dft), 0, client.id + 1, -1, -1);
+                        }
+
+                        if (speculative) {
+                            LOG_INF("Client %3d, seq %3d: %d/%d drafted tokens accepted\n", client.id, client.seq_id, client.n_accepted, client.n_drafted);
+                        }
+
+                        client.seq_id = -1;
+                        break;
+                    }
                 }
 
                 client.i_batch = -1;
             }
         }
+
+        // the undone steps leave the cache: sampled token and all its drafted tokens
+        for (const auto & step : undone) {
+            llama_memory_seq_rm(llama_get_memory(ctx), step.first, step.second, -1);
+        }
     }
 
     const auto t_main_end = ggml_time_us();
@@ -612,8 +1123,38 @@ int main(int argc, char ** argv) {
 
     LOG_INF("Total prompt tokens: %6d, speed: %5.2f t/s\n", n_total_prompt, (double) (n_total_prompt              ) / (t_main_end - t_main_start) * 1e6);
     LOG_INF("Total gen tokens:    %6d, speed: %5.2f t/s\n", n_total_gen,    (double) (n_total_gen                 ) / (t_main_end - t_main_start) * 1e6);
+    if (speculative) {
+        LOG_INF("Draft acceptance:    %6d/%d drafted tokens accepted (%.1f%%), %s\n", n_accepted, n_drafted,
+                n_drafted > 0 ? 100.0 * n_accepted / n_drafted : 0.0, ctx_dft ? "draft model" : "prompt lookup");
+    }
     LOG_INF("Total speed (AVG):   %6s  speed: %5.2f t/s\n", "",             (double) (n_total_prompt + n_total_gen) / (t_main_end - t_main_start) * 1e6);
     LOG_INF("Cache misses:        %6d\n", n_cache_miss);
+    LOG_INF("Batch occupancy:     %6.2f clients, %.1f tokens per step (%d steps)\n",
+            n_steps > 0 ? (double) n_active_sum / n_steps : 0.0, n_steps > 0 ? (double) n_batch_tokens / n_steps : 0.0, n_steps);
+
+    // run summary next to results.txt, one JSON line per run to compare llama.cpp versions and parameters
+    if (const char * baseDir = std::getenv(WORK_DIR.c_str())) {
+        std::filesystem::path fullDirPath = std::filesystem::path(baseDir) / output_dir;
+        std::filesystem::create_directories(fullDirPath);
+        std::ofstream outFile(fullDirPath / "run_summary.jsonl", std::ios::app);
+        const double t_total = (t_main_end - t_main_start) / 1e6;
+        outFile << "{\"runner\": \"reachability_bench_cpp\", \"model\": \"" << json_escape(params.model.path)
+                << "\", \"exp_dir\": \"" << json_escape(baseDir) << "\", \"llama_build\": " << LLAMA_BUILD_NUMBER
+                << ", \"llama_commit\": \"" << json_escape(LLAMA_COMMIT) << "\""
+                << ", \"n_parallel\": " << n_clients << ", \"n_batch\": " << params.n_batch << ", \"n_ubatch\": " << params.n_ubatch
+                << ", \"ctx_size\": " << n_ctx << ", \"cont_batching\": " << (cont_batching ? "true" : "false")
+                << ", \"speculative\": \"" << (ctx_dft ? "draft_model" : spec.lookup ? "prompt_lookup" : "none") << "\""
+                << ", \"n_sequences\": " << n_seq << ", \"n_answered\": " << n_answered
+                << ", \"system_tokens\": " << n_tokens_system << ", \"t_system\": " << t_system << ", \"t_total\": " << t_total
+                << ", \"prompt_tokens\": " << n_total_prompt << ", \"generated_tokens\": " << n_total_gen
+                << ", \"prompt_tps\": " << (t_total > 0 ? n_total_prompt / t_total : 0.0)
+                << ", \"gen_tps\": " << (t_total > 0 ? n_total_gen / t_total : 0.0)
+                << ", \"cache_misses\": " << n_cache_miss << ", \"n_steps\": " << n_steps
+                << ", \"batch_occupancy\": " << (n_steps > 0 ? (double) n_active_sum / n_steps : 0.0)
+                << ", \"tokens_per_step\": " << (n_steps > 0 ? (double) n_batch_tokens / n_steps : 0.0)
+                << ", \"drafted_tokens\": " << n_drafted << ", \"accepted_tokens\": " << n_accepted
+                << ", \"timestamp\": " << (long long) std::time(nullptr) << "}\n";
+    }
 
     LOG_INF("\n");
 
@@ -622,6 +1163,12 @@ int main(int argc, char ** argv) {
 
     llama_batch_free(batch);
 
+    if (ctx_dft) {
+        llama_batch_free(batch_dft);
+        llama_free(ctx_dft);
+        llama_model_free(model_dft);
+    }
+
     llama_backend_free();
 
     LOG("\n\n");
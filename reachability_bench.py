@@ -1,3 +1,4 @@
+import argparse
 import os
 import time
 import pathlib
@@ -6,6 +7,15 @@ import sys
 from datetime import datetime
 from llama_cpp import Llama
 
+from answer_store import load_store
+from completion_index import CompletionIndex, parse_results_seq_ids
+from experiment_files import parse_questions
+from llama_batch import BatchDecoder, shared_context
+from predict_budget import load_budget
+from result_writer import ResultWriter, chain_written, mark_in_index
+from stop_matcher import generate_until_answer
+from telemetry import TelemetryWriter, make_record
+
 # ==============================================================
 # Utility functions
 # ==============================================================
@@ -76,6 +86,7 @@ class Client:
         self.prompt = ""
         self.response = ""
         self.distance = 0
+        self.distances = []
         self.start_time = 0.0
 
 
@@ -87,15 +98,16 @@ def main():
 
     # --- Load system prompt and questions ---
     system_prompt = read_file_from_env_directory("system.txt")
-    questions = read_file_from_env_directory("reachability_questions.txt")
-    q_prompts = split_string(questions.strip(), "\n")
+    # (seq_id, distances, question), distances with the tree columns the budget uses
+    q_prompts = parse_questions(read_file_from_env_directory("reachability_questions.txt"))
     # --- Init llama model ---
     # NOTE: model can be adjusted here
     model_path = os.getenv("LLAMA_MODEL", "../models/Mistral-7B-Instruct-v0.3.IQ1_S.gguf")
     # model_path = os.getenv("LLAMA_MODEL", "../models/qwen2.5-coder-7b-instruct-q4_k_m.gguf")
     model_name = "Mistral-7B-test-2"
     # model_name = "Qwen-Coder-7B"
-    llm = Llama(model_path=model_path, n_ctx=2048, n_threads=8)
+    n_ctx = 2048
+    llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=8)
 
     # --- Parallel clients setup ---
     n_clients = 2  # could be param
@@ -104,65 +116,178 @@ def main():
     # Output directory
     # output_dir = "output-" + pathlib.Path(model_path).stem # Older version, could be better
     output_dir = model_name
+    work_dir = os.getenv("LLAMA_WORK_DIR")
+    index = CompletionIndex()
+    budget = load_budget()
+    store = load_store()
+    telemetry = TelemetryWriter(pathlib.Path(work_dir) / output_dir / "telemetry.jsonl")
+    # Answers of a previous run, before the index existed
+    in_results = parse_results_seq_ids(pathlib.Path(work_dir) / output_dir / "results.txt")
+    results = ResultWriter(pathlib.Path(work_dir) / output_dir, on_written=chain_written(
+        mark_in_index(index, work_dir, output_dir, system_prompt), store and store.filler(output_dir, system_prompt)))
+    # The system prompt is tokenized once, only the question part is counted per request
+    n_system_tokens = len(llm.tokenize(system_prompt.encode("utf-8"), add_bos=True))
 
     # --- Processing loop ---
     seq_counter = 0
     all_elasped = 0
+    t_run_start = time.time()
     while seq_counter < len(q_prompts):
         for client in clients:
             if client.seq_id == -1 and seq_counter < len(q_prompts):
                 # Assign new sequence to this client
-                parts = split_string(q_prompts[seq_counter], "\t")
-                if len(parts) >= 2:
-                    client.distance = int(parts[0])
-                    client.input = parts[1]
-                else:
-                    client.distance = 0
-                    client.input = q_prompts[seq_counter]
+                seq_id, client.distances, client.input = q_prompts[seq_counter]
+                client.distance = int(client.distances[0])
+
+                # Resume: skip questions answered by a previous run
+                fname = f"result{seq_id}_{client.distance}.txt"
+                if seq_id in in_results or (pathlib.Path(work_dir) / output_dir / fname).exists():
+                    index.mark_done(work_dir, output_dir, seq_id, system_prompt, client.input)
+                if index.is_done(work_dir, output_dir, seq_id, system_prompt, client.input):
+                    print(f"Seq {seq_id} already answered, skipping")
+                    seq_counter += 1
+                    continue
+                # Same prompt answered by this model in another run or directory
+                stored = store.get(output_dir, system_prompt, client.input) if store is not None else None
+                if stored is not None:
+                    print(f"Seq {seq_id} found in the answer store")
+                    results.put(seq_id, client.distances, client.input, stored["answer"])
+                    seq_counter += 1
+                    continue
 
                 client.prompt = f"{system_prompt}\nUser: {client.input}\nAssistant:"
                 
                 # print("Client prompt is :", client.prompt)
-                client.seq_id = seq_counter
+                client.seq_id = seq_id
                 client.start_time = time.time()
 
                 print(f"Client {client.id} started seq {client.seq_id} with input: {client.input}")
 
-                # Generate response
-                output = llm(client.prompt, max_tokens=256, stop=["User:"])
-                client.response = output["choices"][0]["text"]
+                # Generate response, stopping as soon as the final answer is given
+                max_tokens = budget(client.distances) if budget is not None else 256
+                stats = {}
+                client.response, stop_reason, n_tokens = generate_until_answer(llm, client.prompt, max_tokens=max_tokens, stop=["User:"], stats=stats)
 
                 elapsed = time.time() - client.start_time
                 all_elasped += elapsed
 
-                print(f"Client {client.id}, seq {client.seq_id}, time {elapsed:.2f}s")
+                print(f"Client {client.id}, seq {client.seq_id}, time {elapsed:.2f}s, {n_tokens} tokens, stop: {stop_reason}")
                 print(f"Q: {client.input}\nA: {client.response}\n")
 
-                # Write result
-                fname = f"result{client.seq_id}_{client.distance}.txt"
-                write_result_to_env_directory(output_dir, fname, trim(client.input), trim(client.response))
+                # Queued, written (and marked in the index) by the result writer thread
+                results.put(client.seq_id, client.distances, client.input, trim(client.response),
+                            generated_tokens=n_tokens, stop_reason=stop_reason,
+                            params={"max_tokens": max_tokens, "stop": ["User:"]})
+                n_question_tokens = len(llm.tokenize(f"\nUser: {client.input}\nAssistant:".encode("utf-8"), add_bos=False))
+                telemetry.write(make_record(
+                    runner="reachability_bench", model=output_dir, exp_dir=work_dir, ctx_size=n_ctx,
+                    seq_id=client.seq_id, distances=client.distances,
+                    prompt_tokens=n_system_tokens + n_question_tokens, generated_tokens=n_tokens,
+                    queue_wait=client.start_time - t_run_start, total_time=elapsed,
+                    stop_reason=stop_reason, slot_id=client.id, **stats))
 
                 # Reset client for next question
                 client.seq_id = -1
 
                 seq_counter += 1
 
+    results.close()
+    telemetry.close()
     print(f"All sequences processed, time {all_elasped:.2f}s.")
 
 
+def main_batch(n_clients: int):
+    """
+    Same questions and outputs as main(), answered by n_clients sequences decoded
+    together (llama_batch.BatchDecoder), as the client loop of reachability_bench.cpp.
+    """
+    system_prompt = read_file_from_env_directory("system.txt")
+    q_prompts = parse_questions(read_file_from_env_directory("reachability_questions.txt"))
+    model_path = os.getenv("LLAMA_MODEL", "../models/Mistral-7B-Instruct-v0.3.IQ1_S.gguf")
+    model_name = "Mistral-7B-test-2"
+    # Only the weights and the tokenizer are used, the decoder makes its own context
+    llm = Llama(model_path=model_path, n_ctx=512, n_threads=8)
+
+    output_dir = model_name
+    work_dir = os.getenv("LLAMA_WORK_DIR")
+    index = CompletionIndex()
+    budget = load_budget()
+    store = load_store()
+    in_results = parse_results_seq_ids(pathlib.Path(work_dir) / output_dir / "results.txt")
+
+    items = []
+    for seq_id, distances, question in q_prompts:
+        if seq_id in in_results or (pathlib.Path(work_dir) / output_dir / f"result{seq_id}_{int(distances[0])}.txt").exists():
+            index.mark_done(work_dir, output_dir, seq_id, system_prompt, question)
+        if index.is_done(work_dir, output_dir, seq_id, system_prompt, question):
+            print(f"Seq {seq_id} already answered, skipping")
+            continue
+        items.append((seq_id, distances, question))
+
+    telemetry = TelemetryWriter(pathlib.Path(work_dir) / output_dir / "telemetry.jsonl")
+    results = ResultWriter(pathlib.Path(work_dir) / output_dir, on_written=chain_written(
+        mark_in_index(index, work_dir, output_dir, system_prompt), store and store.filler(output_dir, system_prompt)))
+    if store is not None:
+        items = store.serve(results, output_dir, system_prompt, items)
+    if not items:
+        results.close()
+        telemetry.close()
+        print("All sequences processed, nothing to do.")
+        return
+
+    def max_tokens(distances):
+        return budget(distances) if budget is not None else 256
+
+    n_system_tokens = len(llm.tokenize(f"{system_prompt}\nUser:".encode("utf-8"), add_bos=True))
+    longest = max(len(llm.tokenize(f" {q}\nAssistant:".encode("utf-8"), add_bos=False)) for _, _, q in items)
+    n_ctx = shared_context(n_system_tokens, n_clients, longest, max(max_tokens(d) for _, d, _ in items))
+    decoder = BatchDecoder(llm, system_prompt, n_clients=n_clients, n_ctx=n_ctx)
+    t_run_start = time.time()
+
+    def on_result(item, result):
+        seq_id, distances, question = item
+        print(f"Client {result['slot_id']}, seq {seq_id}, time {result['total_time']:.2f}s, "
+              f"{result['generated_tokens']} tokens, stop: {result['stop_reason']}")
+        results.put(seq_id, distances, question, trim(result["content"]), prompt_tokens=result["prompt_tokens"],
+                    generated_tokens=result["generated_tokens"], stop_reason=result["stop_reason"],
+                    params={"max_tokens": max_tokens(distances), "stop": decoder.stop,
+                            "temperature": decoder.temperature, "top_k": decoder.top_k})
+        telemetry.write(make_record(
+            runner="reachability_bench", model=output_dir, exp_dir=work_dir, ctx_size=n_ctx,
+            seq_id=seq_id, distances=[str(d) for d in distances],
+            queue_wait=time.time() - result["total_time"] - t_run_start,
+            **{k: v for k, v in result.items() if k != "content"}))
+
+    try:
+        decoder.run(items, max_tokens, on_result)
+    finally:
+        decoder.close()
+        results.close()
+        telemetry.close()
+    elapsed = time.time() - t_run_start
+    print(f"All sequences processed, time {elapsed:.2f}s, {n_clients} clients, "
+          f"{decoder.n_total_prompt} prompt + {decoder.n_total_gen} generated tokens "
+          f"({decoder.n_total_gen / elapsed:.1f} t/s)")
+
+
 if __name__ == "__main__":
     # Minimal change: accept 1 argument as the directory that contains the .txt files,
     # set the LLAMA_WORK_DIR environment variable accordingly, then run main().
-    if len(sys.argv) != 2:
-        print("Usage: python reachability_bench.py /path/to/dir_containing_txt_files")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python reachability_bench.py /path/to/dir_containing_txt_files [--batch N]")
+    parser.add_argument("dir")
+    parser.add_argument("--batch", type=int, default=0, metavar="N",
+                        help="decode N clients together in one llama context (continuous batching)")
+    args = parser.parse_args()
 
-    provided_dir = pathlib.Path(sys.argv[1]).expanduser().resolve()
+    provided_dir = pathlib.Path(args.dir).expanduser().resolve()
     if not provided_dir.exists() or not provided_dir.is_dir():
         print(f"Provided path is not a directory: {provided_dir}", file=sys.stderr)
         sys.exit(1)
 
     # Set the environment variable used by the helper functions (no other changes).
     os.environ["LLAMA_WORK_DIR"] = str(provided_dir)
-    
-    main()
+
+    if args.batch > 0:
+        main_batch(args.batch)
+    else:
+        main()
@@ -1,14 +1,25 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
 import os
 import pathlib
 import random
-import re
 import subprocess
 import sys
-import tempfile
 import time
 import requests
 
+from answer_store import load_store
+from completion_index import CompletionIndex
+from ctx_planner import GIB, SlotPlanner
+from experiment_files import parse_questions, read_text
+from experiment_scheduler import SERVER_TEMPLATE, answer_meta
+from llama_server_client import make_transport, run_bounded, stream_completion, wait_for_server_async
+from predict_budget import load_budget
+from result_writer import ResultWriter, append_stop_word, chain_written, mark_in_index
+from slot_scheduler import Experiment, SlotScheduler
+from telemetry import TelemetryWriter, record_from_server_result
+from token_cache import TokenCounter
+
 # ==========================
 #       Utilities
 # ==========================
@@ -18,16 +29,7 @@ def read_file_from_env_directory(filename: str, work_dir_var: str = "LLAMA_WORK_
     if not dir_path:
         print(f"Error: Environment variable {work_dir_var} is not set.")
         return ""
-    file_path = pathlib.Path(dir_path) / filename
-    
-    for encoding in ["utf-8", "cp1252"]: # Small issue with windows encoding....
-        try:
-            with open(file_path, "r", encoding=encoding) as f:
-                return f.read()
-        except UnicodeDecodeError:
-            continue
-    print(f"Error: Could not decode {file_path} with utf-8 or cp1252.")
-    return ""
+    return read_text(pathlib.Path(dir_path) / filename)
 
 def write_file_to_env_model_dir(filename: str, content: str, model_name: str, work_dir_var: str = "LLAMA_WORK_DIR"):
     """Write a file under the env/model_name directory."""
@@ -43,55 +45,30 @@ def write_file_to_env_model_dir(filename: str, content: str, model_name: str, wo
     with open(file_path, "w", encoding="utf-8") as f:
         f.write(content)
 
-def append_file_to_env_model_dir(filename: str, content: str, model_name: str, work_dir_var: str = "LLAMA_WORK_DIR"):
-    """Append text to a file under the env/model_name directory."""
-    work_dir = os.getenv(work_dir_var)
-    if not work_dir:
-        print(f"Error: Environment variable {work_dir_var} is not set.")
-        return
-    
-    output_dir = pathlib.Path(work_dir) / model_name
-    output_dir.mkdir(parents=True, exist_ok=True)  # create dir if missing
-
-    file_path = output_dir / filename
-    with open(file_path, "a", encoding="utf-8") as f:
-        f.write(content + "\n")  # add newline separator
-
 def count_tokens_in_file(model_path, tokenizer_path, file_path):
+    """Token count of a file, cached per (model, content) so a system prompt is only tokenized once."""
     print(f"Tokenizing file: {file_path}")
     start_time = time.time()
-
-    with open(file_path, "r", encoding="cp1252") as file:
-        text = file.read()
-
-    with tempfile.NamedTemporaryFile("w+", encoding="cp1252", delete=False, suffix=".txt") as tmp_file:
-        tmp_file.write(text)
-        tmp_file_path = tmp_file.name
-
     try:
-        result = subprocess.run(
-            [tokenizer_path, "-m", model_path, "-f", tmp_file_path],
-            capture_output=True,
-            text=True
-        )
-    finally:
-        os.remove(tmp_file_path)
-
-    if result.returncode != 0:
-        print(f"❌ Error tokenizing {file_path}:\n{result.stderr}")
-        return None, None
-
-    output = result.stdout
-    tokens = []
-    for line in output.strip().split("\n"):
-        match = re.match(r"\s*(\d+)\s*->", line)
-        if match:
-            tokens.append(int(match.group(1)))
-
-    token_count = len(tokens)
+        token_count = TokenCounter(model_path, tokenizer_path).count_file(file_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"❌ Error tokenizing {file_path}:\n{e}")
+        return None
     elapsed = time.time() - start_time
     print(f"✅ Token count: {token_count} (processed in {elapsed:.2f} seconds)\n")
-    return token_count, output
+    return token_count
+
+def estimate_token_count(text):
+    """Upper estimate (3 characters per token, code tokenizes densely) when no tokenizer is at hand."""
+    return -(-len(text) // 3)
+
+def count_tokens(text):
+    """Token count from the token cache or the tokenizer, the estimate if neither works."""
+    try:
+        return TokenCounter(MODEL_PATH, TOKENIZER_PATH)(text)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"⚠️ Could not count tokens ({e}), estimated from {len(text)} characters")
+        return estimate_token_count(text)
 
 def wait_for_server(url="http://localhost:8080/health", timeout=60, interval=1):
     """
@@ -114,12 +91,19 @@ def wait_for_server(url="http://localhost:8080/health", timeout=60, interval=1):
 # ==========================
 #       Question worker
 # ==========================
-def ask_question(seq_id, distances, actual_question, system_prompt, model_name, timings_list):
+def record_telemetry(telemetry, result, seq_id, distances, model_name, queue_wait, total_time):
+    if telemetry is not None:
+        telemetry.write(record_from_server_result(
+            result, queue_wait, total_time, runner="reachability_bench_server_v2", model=model_name,
+            exp_dir=os.getenv("LLAMA_WORK_DIR"), ctx_size=ctx_size, seq_id=seq_id, distances=distances))
+
+def ask_question(seq_id, distances, actual_question, system_prompt, model_name, timings_list, results,
+                 telemetry=None, queued_at=None):
     prompt = f"{system_prompt}\n{actual_question}"
 
     payload = {
         "prompt": [prompt],
-        "n_predict": 4096,
+        "n_predict": n_predict_for(distances),
         "cache_prompt": True,
         # "id_slot": 0,   # ! IMPORTANT: must be -1 (auto) if multiple slots
         "stop": ["User:", "YES", "NO"],
@@ -136,18 +120,14 @@ def ask_question(seq_id, distances, actual_question, system_prompt, model_name,
         result = response.json()
         answer = result.get("content", "").strip()
         stopped_word = result.get("stopping_word", "")
-        if stopped_word in ["YES", "NO"]:
-            if not answer.endswith(" "):
-                answer += " "
-            answer += stopped_word
-
-        distance_str = ", ".join(distances)
-        global_content = f"[Q{seq_id}] Distance={distance_str}\nQuestion: {actual_question}\nAnswer: {answer}\n"
-        append_file_to_env_model_dir("results.txt", global_content, model_name)
+        results.put(seq_id, distances, actual_question, append_stop_word(answer, stopped_word),
+                    **answer_meta(result, {"n_predict": payload["n_predict"], "stop": payload["stop"]}))
         
         # Record timing
         generation_time = result.get("timing", {}).get("generation_time", end_total - start_total)
         total_time = end_total - start_total
+        record_telemetry(telemetry, result, seq_id, distances, model_name,
+                         start_total - queued_at if queued_at is not None else None, total_time)
         timings_list.append({
             "id": seq_id,
             "generation_time": generation_time,
@@ -159,40 +139,198 @@ def ask_question(seq_id, distances, actual_question, system_prompt, model_name,
         print(f"[Q{seq_id}] ❌ Error:", e)
 
 
+async def ask_question_async(transport, seq_id, distances, actual_question, system_prompt, model_name, timings_list, results,
+                             telemetry=None, queued_at=None):
+    """Streaming version of ask_question: the answer is written as soon as YES/NO arrives."""
+    prompt = f"{system_prompt}\n{actual_question}"
+
+    payload = {
+        "prompt": prompt,
+        "n_predict": n_predict_for(distances),
+        "cache_prompt": True,
+        "stop": ["User:", "YES", "NO"],
+        "n_keep": ctx_size
+    }
+
+    try:
+        print(f"[Q{seq_id}] ⌛ Starting")
+        start_total = time.perf_counter()
+        result = await stream_completion(transport, payload, stop_words=("YES", "NO"))
+        end_total = time.perf_counter()
+
+        answer = result["content"].strip()
+        results.put(seq_id, distances, actual_question, append_stop_word(answer, result["stopping_word"]),
+                    **answer_meta(result, {"n_predict": payload["n_predict"], "stop": payload["stop"]}))
+
+        timings = result["timings"]
+        total_time = end_total - start_total
+        record_telemetry(telemetry, result, seq_id, distances, model_name,
+                         start_total - queued_at if queued_at is not None else None, total_time)
+        timings_list.append({
+            "id": seq_id,
+            "generation_time": timings.get("predicted_ms", total_time * 1000) / 1000,
+            "total_time": total_time
+        })
+
+        print(f"[Q{seq_id}] ✅ done")
+    except (OSError, ValueError) as e:
+        print(f"[Q{seq_id}] ❌ Error:", e)
+
+
+async def run_questions_async(questions, system_prompt, model_name, timings_list, results,
+                              base_url="http://localhost:8080", transport=None, telemetry=None):
+    """
+    Ask all (seq_id, distances, question) tuples keeping exactly n_parallel requests in flight,
+    one per llama-server slot.
+    """
+    own_transport = transport is None
+    if own_transport:
+        transport = make_transport(base_url)
+    try:
+        await wait_for_server_async(transport)
+        queued_at = time.perf_counter()
+
+        async def handle(item):
+            seq_id, distances, actual_question = item
+            await ask_question_async(transport, seq_id, distances, actual_question, system_prompt, model_name, timings_list, results,
+                                     telemetry, queued_at)
+
+        await run_bounded(questions, handle, n_parallel)
+    finally:
+        if own_transport:
+            await transport.close()
+
+
+async def run_questions_pinned(questions, system_prompt, model_name, timings_list, results,
+                               base_url="http://localhost:8080", transport=None, telemetry=None):
+    """
+    Same as run_questions_async but every request is sent to an explicit slot (id_slot),
+    warmed once with the system prompt, and questions are ordered for prefix reuse.
+    """
+    own_transport = transport is None
+    if own_transport:
+        transport = make_transport(base_url)
+
+    def on_result(item, result):
+        seq_id, distances, actual_question = item
+        answer = result["content"].strip()
+        results.put(seq_id, distances, actual_question, append_stop_word(answer, result["stopping_word"]),
+                    **answer_meta(result, {"n_predict": n_predict_for(distances), "stop": ["User:", "YES", "NO"]}))
+        record_telemetry(telemetry, result, seq_id, distances, model_name, result["queue_wait"], result["total_time"])
+        timings = result["timings"]
+        timings_list.append({
+            "id": seq_id,
+            "generation_time": timings.get("predicted_ms", 0) / 1000,
+            "total_time": result["total_time"]
+        })
+        print(f"[Q{seq_id}] ✅ done (slot {result['id_slot']})")
+
+    try:
+        await wait_for_server_async(transport)
+        scheduler = SlotScheduler(transport, n_parallel, payload={
+            "n_predict": 4096,
+            "stop": ["User:", "YES", "NO"],
+            "n_keep": ctx_size
+        }, n_predict_fn=token_budget)
+        await scheduler.run([Experiment(os.getenv("LLAMA_WORK_DIR"), system_prompt, questions, on_result)])
+        print(scheduler.report())
+    finally:
+        if own_transport:
+            await transport.close()
+
+
 # ==========================
 #       Main Function
 # ==========================
 
 
-sys_token_count, _ = count_tokens_in_file(r"..\models\Mistral-7B-Instruct-v0.3.IQ1_S.gguf",
-                                          r"..\llama-cpp-win\llama-tokenize.exe",
-                                          r".\experiments\adv_lin\ctx_10_depths_1--8_com_0_var_0_loop_0_if_0_qs_0--16_java\system.txt")
-    
-# Add padding (for question)
-token_count = sys_token_count + 100
-# Add padding (for response)  
-token_count += 500
-# Take closest power of 2 above
-next_pow2 = 1 << (token_count - 1).bit_length()
-
-# Take into account the number of slots
+# Windows setup by default, overridable from the environment
+MODEL_PATH = os.getenv("LLAMA_MODEL", r"..\models\Mistral-7B-Instruct-v0.3.IQ1_S.gguf")
+TOKENIZER_PATH = os.getenv("LLAMA_TOKENIZER", r"..\llama-cpp-win\llama-tokenize.exe")
+SERVER_PATH = os.getenv("LLAMA_SERVER", r"..\llama-cpp-win-newer\llama-server.exe")
+
+# Set by plan_server() for the directory being run
 n_parallel = 2
-ctx_size = n_parallel*next_pow2
+ctx_size = None
+
+# Per-question generation budget from the distances ($REACHABILITY_BUDGET, see predict_budget.py)
+token_budget = load_budget()
 
-def main():
+def plan_server(system_prompt, questions):
+    """
+    Largest --parallel and the --ctx-size (not rounded to a power of 2) whose KV cache fits
+    in $LLAMA_MEMORY_GB (detected RAM/VRAM when unset), see ctx_planner.py.
+    """
+    global n_parallel, ctx_size
+    memory_gb = os.getenv("LLAMA_MEMORY_GB")
+    planner = SlotPlanner(MODEL_PATH, count_tokens,
+                          int(float(memory_gb) * GIB) if memory_gb else None)
+    answer_tokens = max((token_budget(d) for _, d, _ in questions), default=None) if token_budget is not None else None
+    plan = planner.plan(system_prompt, questions, answer_tokens)
+    print(f"Planned {plan}")
+    n_parallel, ctx_size = plan.n_parallel, plan.ctx_size
+    return plan
+
+def n_predict_for(distances):
+    return token_budget(distances) if token_budget is not None else 4096
+
+def main(use_async=False, pinned=False):
     random.seed(1234)
 
     # Read prompts
     system_prompt = read_file_from_env_directory("system.txt")
-    questions_raw = read_file_from_env_directory("reachability_questions.txt").splitlines()
+    questions_raw = read_file_from_env_directory("reachability_questions.txt")
     
     # print("System prompt:", system_prompt)
     # print("Questions:", questions_raw)
+
+    model_name = "Mistral-7B-Server-Parallel-4"
+    timings_list = []
+
+    # For effective KV caching, we process the first question before starting the parallel computations
+    """
+    question_line = questions_raw[0]
+    parts = question_line.split("\t")
+    actual_question = parts[1]
+    distances = [parts[0]] + (parts[2:] if len(parts) > 2 else [])
     
+    ask_question(0, distances, actual_question, system_prompt, model_name, timings_list)
+    """
+    
+
+    questions = parse_questions(questions_raw)
+
+    # Resume: answers already in results.txt (or recorded in the index) are not asked again
+    index = CompletionIndex()
+    work_dir = os.getenv("LLAMA_WORK_DIR")
+    index.ingest_results_file(work_dir, model_name, pathlib.Path(work_dir) / model_name / "results.txt",
+                              system_prompt, [(seq_id, q) for seq_id, _, q in questions])
+    questions = index.pending(work_dir, model_name, system_prompt, questions)
+    # Answers are queued by the workers and written in batches by a single thread
+    store = load_store()
+    results = ResultWriter(pathlib.Path(work_dir) / model_name, on_written=chain_written(
+        mark_in_index(index, work_dir, model_name, system_prompt),
+        store and store.filler(model_name, system_prompt, SERVER_TEMPLATE)))
+    if store is not None:
+        # Prompts this model already answered, here or in another directory
+        questions = store.serve(results, model_name, system_prompt, questions, SERVER_TEMPLATE)
+        if not questions:
+            results.close()
+            print("All questions found in the answer store, no server started.")
+            return
+
+    # Slots and context sized for this directory
+    sys_token_count = count_tokens_in_file(MODEL_PATH, TOKENIZER_PATH, pathlib.Path(work_dir) / "system.txt")
+    if sys_token_count is None:
+        # Neither cached nor tokenizable here, --keep only needs to cover the system prompt
+        sys_token_count = estimate_token_count(system_prompt)
+        print(f"⚠️ Using an estimate of {sys_token_count} system prompt tokens")
+    plan_server(system_prompt, questions)
+
     # Start llama-server in a subprocess
     server_cmd = [
-        r"..\llama-cpp-win-newer\llama-server.exe",
-        "--model", r"..\models\Mistral-7B-Instruct-v0.3.IQ1_S.gguf",
+        SERVER_PATH,
+        "--model", MODEL_PATH,
         "--ctx-size", str(ctx_size), # Total ctx so divide by parallel to get ctx_slot, ex: 32768=4096*8
         "--keep", str(sys_token_count+10),
         "--gpu-layers", "24",
@@ -206,40 +344,29 @@ def main():
     print("Starting LLaMA server...")
     server_proc = subprocess.Popen(server_cmd)
     wait_for_server()
-    
-    model_name = "Mistral-7B-Server-Parallel-4"
-    timings_list = []
     start_all = time.time()
-    
-    # For effective KV caching, we process the first question before starting the parallel computations
-    """
-    question_line = questions_raw[0]
-    parts = question_line.split("\t")
-    actual_question = parts[1]
-    distances = [parts[0]] + (parts[2:] if len(parts) > 2 else [])
-    
-    ask_question(0, distances, actual_question, system_prompt, model_name, timings_list)
-    """
-    
+    telemetry = TelemetryWriter(pathlib.Path(work_dir) / model_name / "telemetry.jsonl")
 
-    with ThreadPoolExecutor(max_workers=n_parallel) as executor: # Check if it should be a lower max_workers value (8/None)
-        futures = []
-        for seq_id, question_line in enumerate(questions_raw): # questions_raw[1:]):
-            # seq_id += 1 # To take into account the first seq_id
-            try:
-                parts = question_line.split("\t")
-                actual_question = parts[1]
-                distances = [parts[0]] + (parts[2:] if len(parts) > 2 else [])
-            except ValueError:
-                print(f"Skipping malformed question line: {question_line}")
-                continue
-            futures.append(executor.submit(ask_question, seq_id, distances, actual_question, system_prompt, model_name, timings_list))
-            
-        # Wait for all to finish
-        for future in as_completed(futures):
-            pass
+    if pinned:
+        # One slot per worker, warmed once, questions ordered for prefix reuse
+        asyncio.run(run_questions_pinned(questions, system_prompt, model_name, timings_list, results, telemetry=telemetry))
+    elif use_async:
+        # Streaming client, exactly n_parallel requests in flight
+        asyncio.run(run_questions_async(questions, system_prompt, model_name, timings_list, results, telemetry=telemetry))
+    else:
+        queued_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor: # Check if it should be a lower max_workers value (8/None)
+            futures = [executor.submit(ask_question, seq_id, distances, actual_question, system_prompt, model_name, timings_list, results,
+                                       telemetry, queued_at)
+                       for seq_id, distances, actual_question in questions]
+
+            # Wait for all to finish
+            for future in as_completed(futures):
+                pass
     
     end_all = time.time()
+    results.close()
+    telemetry.close()
     
     # Print all timings
     print("\n=== Per-request timings ===")
@@ -259,8 +386,9 @@ def main():
 #       Entry Point
 # ==========================
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python reachability_bench_server.py /path/to/data")
+    args = [a for a in sys.argv[1:] if a not in ("--async", "--pinned")]
+    if len(args) != 1:
+        print("Usage: python reachability_bench_server_v2.py /path/to/data [--async | --pinned]")
         sys.exit(1)
-    os.environ["LLAMA_WORK_DIR"] = sys.argv[1]
-    main()
\ No newline at end of file
+    os.environ["LLAMA_WORK_DIR"] = args[0]
+    main(use_async="--async" in sys.argv[1:], pinned="--pinned" in sys.argv[1:])
\ No newline at end of file
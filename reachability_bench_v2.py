@@ -7,6 +7,14 @@ from threading import Thread
 from queue import Queue
 from llama_cpp import Llama
 
+from answer_store import load_store
+from completion_index import CompletionIndex
+from experiment_files import parse_questions
+from predict_budget import load_budget
+from result_writer import ResultWriter, chain_written, mark_in_index
+from stop_matcher import generate_until_answer
+from telemetry import TelemetryWriter, make_record
+
 # ==========================
 # Utilities
 # ==========================
@@ -20,78 +28,158 @@ def read_file_from_env_directory(filename: str):
         print(f"Error reading {file_path}: {e}")
         return ""
 
-def append_result(output_dir, file_name, seq_id, distance, question, response):
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
-    path = pathlib.Path(output_dir) / file_name
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(f"=== seq={seq_id}, distance={distance} ===\n")
-        f.write(f"Q: {question}\nA:\n{response}\n\n")
-
 # ==========================
 # Worker Thread
 # ==========================
 class Worker(Thread):
-    def __init__(self, cid, task_queue, system_prompt, model_path, output_dir, big_file):
+    def __init__(self, cid, task_queue, system_prompt, model_path, results, budget=None, telemetry=None, t_queued=None):
         super().__init__()
         self.cid = cid
         self.task_queue = task_queue
         self.system_prompt = system_prompt
         self.model_path = model_path
-        self.output_dir = output_dir
-        self.big_file = big_file
+        self.results = results
+        self.budget = budget
+        self.telemetry = telemetry
+        self.t_queued = t_queued or time.time()
         # Each thread must have its own Llama instance
-        self.llm = Llama(model_path=self.model_path, n_ctx=2048, n_threads=4)
+        self.n_ctx = 2048
+        self.llm = Llama(model_path=self.model_path, n_ctx=self.n_ctx, n_threads=4)
 
     def run(self):
         while not self.task_queue.empty():
             try:
-                seq_id, distance, question = self.task_queue.get_nowait()
+                seq_id, distances, question = self.task_queue.get_nowait()
             except:
                 break
 
             prompt = f"{self.system_prompt}\nUser: {question}\nAssistant:"
             start = time.time()
-            output = self.llm(prompt, max_tokens=256, stop=["User:"])
-            response = output["choices"][0]["text"]
+            max_tokens = self.budget(distances) if self.budget is not None else 256
+            stats = {}
+            response, stop_reason, n_tokens = generate_until_answer(self.llm, prompt, max_tokens=max_tokens, stop=["User:"], stats=stats)
             elapsed = time.time() - start
-            print(f"[Worker {self.cid}] seq={seq_id}, time={elapsed:.2f}s")
-            append_result(self.output_dir, self.big_file, seq_id, distance, question, response)
+            print(f"[Worker {self.cid}] seq={seq_id}, time={elapsed:.2f}s, tokens={n_tokens}, stop={stop_reason}")
+            self.results.put(seq_id, distances, question, response.strip(), generated_tokens=n_tokens,
+                             stop_reason=stop_reason, params={"max_tokens": max_tokens, "stop": ["User:"]})
+            if self.telemetry is not None:
+                self.telemetry.write(make_record(
+                    runner="reachability_bench_v2", model=pathlib.Path(self.model_path).stem,
+                    exp_dir=os.getenv("LLAMA_WORK_DIR"), ctx_size=self.n_ctx, seq_id=seq_id, distances=distances,
+                    prompt_tokens=len(self.llm.tokenize(prompt.encode("utf-8"))), generated_tokens=n_tokens,
+                    queue_wait=start - self.t_queued, total_time=elapsed, stop_reason=stop_reason, slot_id=self.cid,
+                    **stats))
             self.task_queue.task_done()
 
+# ==========================
+# Shared model with prefix reuse
+# ==========================
+class SharedPrefixRunner:
+    """
+    Single Llama instance for all questions: the system prompt is evaluated once,
+    its KV state is saved and restored before each question so only the question
+    tokens go through prompt processing.
+    """
+    def __init__(self, llm, system_prompt):
+        self.llm = llm
+        self.system_prompt = system_prompt
+        # Prompt is split on a token boundary so the prefix tokens are reused as is
+        self.prefix_tokens = llm.tokenize(f"{system_prompt}\nUser:".encode("utf-8"), add_bos=True)
+        start = time.time()
+        llm.reset()
+        llm.eval(self.prefix_tokens)
+        self.prefix_state = llm.save_state()
+        print(f"System prompt evaluated once: {len(self.prefix_tokens)} tokens in {time.time() - start:.2f}s")
+
+    def ask(self, question, max_tokens=256, stats=None):
+        # Back to "system prompt evaluated, nothing else" before each question
+        self.llm.load_state(self.prefix_state)
+        question_tokens = self.llm.tokenize(f" {question}\nAssistant:".encode("utf-8"), add_bos=False, special=False)
+        if stats is not None:
+            stats["prompt_tokens"] = len(question_tokens)
+            stats["cached_tokens"] = len(self.prefix_tokens)
+        return generate_until_answer(self.llm, self.prefix_tokens + question_tokens, max_tokens=max_tokens, stop=["User:"], stats=stats)
+
+    def run(self, task_queue, results, model_name="", budget=None, telemetry=None):
+        t_queued = time.time()
+        while not task_queue.empty():
+            seq_id, distances, question = task_queue.get_nowait()
+            start = time.time()
+            stats = {}
+            max_tokens = budget(distances) if budget is not None else 256
+            response, stop_reason, n_tokens = self.ask(question, max_tokens, stats)
+            elapsed = time.time() - start
+            print(f"[Shared] seq={seq_id}, time={elapsed:.2f}s, tokens={n_tokens}, stop={stop_reason}")
+            results.put(seq_id, distances, question, response.strip(), prompt_tokens=stats.get("prompt_tokens"),
+                        generated_tokens=n_tokens, stop_reason=stop_reason,
+                        params={"max_tokens": max_tokens, "stop": ["User:"]})
+            if telemetry is not None:
+                telemetry.write(make_record(
+                    runner="reachability_bench_v2", model=model_name, exp_dir=os.getenv("LLAMA_WORK_DIR"),
+                    ctx_size=self.llm.n_ctx(), seq_id=seq_id, distances=distances, generated_tokens=n_tokens,
+                    queue_wait=start - t_queued, total_time=elapsed, stop_reason=stop_reason, **stats))
+            task_queue.task_done()
+
 # ==========================
 # Main Function
 # ==========================
-def main():
+def main(shared=False):
     random.seed(1234)
 
     # Read prompts
     system_prompt = read_file_from_env_directory("system.txt")
-    questions_raw = read_file_from_env_directory("reachability_questions.txt").splitlines()
-
-    # Fill queue with tasks
-    tasks = Queue()
-    for seq_id, q in enumerate(questions_raw):
-        parts = q.split("\t")
-        if len(parts) >= 2:
-            distance = int(parts[0])
-            question = parts[1]
-        else:
-            distance = 0
-            question = q
-        tasks.put((seq_id, distance, question))
+    # (seq_id, distances, question), distances with the tree columns the budget uses
+    questions = parse_questions(read_file_from_env_directory("reachability_questions.txt"))
 
     # Model & output settings
     model_path = os.getenv("LLAMA_MODEL", "../models/Mistral-7B-Instruct-v0.3.IQ1_S.gguf")
-    output_dir = "results"
-    big_file = "all_results.txt"
+    model_name = pathlib.Path(model_path).stem
+    # Next to the questions, one directory per model, as the other runners
+    work_dir = os.getenv("LLAMA_WORK_DIR")
+    output_dir = pathlib.Path(work_dir) / model_name
+
+    # Fill queue with tasks, leaving out the ones answered by a previous run
+    index = CompletionIndex()
+    budget = load_budget()
+    store = load_store()
+    telemetry = TelemetryWriter(output_dir / "telemetry.jsonl")
+    # Worker threads only queue their answers, a single thread writes them
+    results = ResultWriter(output_dir, on_written=chain_written(
+        mark_in_index(index, work_dir, model_name, system_prompt),
+        store and store.filler(model_name, system_prompt)))
+    t_queued = time.time()
+    tasks = Queue()
+    # Answers of this directory written before the index was in use
+    index.ingest_results_file(work_dir, model_name, output_dir / "results.txt", system_prompt,
+                              [(seq_id, q) for seq_id, _, q in questions])
+    pending = index.pending(work_dir, model_name, system_prompt, questions)
+    if store is not None:
+        # Answers already given to the same prompt by this model, in any directory
+        remaining = {q[0] for q in store.serve(results, model_name, system_prompt, pending)}
+        pending = [task for task in pending if task[0] in remaining]
+    for task in pending:
+        tasks.put(task)
+
+    if shared:
+        # One model load, one system prompt evaluation
+        n_ctx = int(os.getenv("LLAMA_N_CTX", "2048"))
+        llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=8)
+        SharedPrefixRunner(llm, system_prompt).run(tasks, results, model_name, budget, telemetry)
+        results.close()
+        telemetry.close()
+        print("All sequences processed.")
+        return
 
     # Start worker threads
     n_workers = 2
-    workers = [Worker(i, tasks, system_prompt, model_path, output_dir, big_file) for i in range(n_workers)]
+    workers = [Worker(i, tasks, system_prompt, model_path, results, budget, telemetry, t_queued)
+               for i in range(n_workers)]
     for w in workers:
         w.start()
     for w in workers:
         w.join()
+    results.close()
+    telemetry.close()
 
     print("All sequences processed.")
 
@@ -99,8 +187,9 @@ def main():
 # Entry Point
 # ==========================
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python reachability_bench.py /path/to/data")
+    args = [a for a in sys.argv[1:] if a != "--shared"]
+    if len(args) != 1:
+        print("Usage: python reachability_bench_v2.py /path/to/data [--shared]")
         sys.exit(1)
-    os.environ["LLAMA_WORK_DIR"] = sys.argv[1]
-    main()
+    os.environ["LLAMA_WORK_DIR"] = args[0]
+    main(shared="--shared" in sys.argv[1:])
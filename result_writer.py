@@ -0,0 +1,171 @@
+import json
+import os
+import pathlib
+import queue
+import threading
+import time
+
+try:
+    import fcntl  # POSIX only, for lock=True
+except ImportError:
+    fcntl = None
+
+# ==========================
+#   Background result writer
+# ==========================
+# Workers (threads, asyncio tasks, slot workers) only queue their answers; a single
+# thread appends them in batches to results.jsonl (one JSON object per answer, the
+# format the analysis reads) and results.txt (the [Q<id>] blocks of the C++ binary,
+# still read by the completion index and predict_budget.py).
+
+_CLOSE = object()
+
+
+def append_stop_word(answer: str, stopping_word: str = "") -> str:
+    """The server stops before YES/NO, the final answer is put back at the end of the text."""
+    if stopping_word in ["YES", "NO"]:
+        if not answer.endswith(" "):
+            answer += " "
+        answer += stopping_word
+    return answer
+
+
+def format_result(seq_id, distances, question: str, answer: str) -> str:
+    """One results.txt entry, same layout as the C++ binary."""
+    return f"[Q{seq_id}] Distance={', '.join(str(d) for d in distances)}\nQuestion: {question}\nAnswer: {answer}\n"
+
+
+class ResultWriter:
+    """
+    Queue-fed writer of the answers of one output directory. `put` never touches the
+    disk; the writer thread writes whatever is queued in one go, flushes, calls
+    `on_written(records)` (e.g. to mark them in the completion index, which is then
+    never ahead of the files) and fsyncs every `fsync_interval` seconds and on close.
+    """
+
+    def __init__(self, output_dir, txt_name="results.txt", batch_size=256, fsync_interval=5.0, on_written=None,
+                 lock=False):
+        self.output_dir = pathlib.Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.on_written = on_written
+        # Several processes (work_queue workers) appending to the same files: each batch is
+        # written under an exclusive lock of results.jsonl, so batches are never interleaved
+        self.lock = lock and fcntl is not None
+        self.jsonl = open(self.output_dir / "results.jsonl", "a", encoding="utf-8")
+        self.txt = open(self.output_dir / txt_name, "a", encoding="utf-8")
+        self.queue = queue.Queue()
+        self.error = None
+        self.n_written = 0
+        self.n_batches = 0
+        self.thread = threading.Thread(target=self._run, name=f"ResultWriter({self.output_dir})", daemon=True)
+        self.thread.start()
+
+    def put(self, seq_id, distances, question: str, answer: str, **meta):
+        """
+        Queue one answer (thread-safe, returns immediately). `meta` (token counts, sampler
+        params) is not written to the files, only handed to on_written.
+        """
+        if self.error is not None:
+            raise RuntimeError(f"Result writer for {self.output_dir} failed") from self.error
+        record = {"seq_id": seq_id, "distances": [str(d) for d in distances], "question": question, "answer": answer}
+        if meta:
+            record["meta"] = meta
+        self.queue.put(record)
+
+    def flush(self):
+        """Wait until everything queued so far is written."""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Result writer for {self.output_dir} failed") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, records: list):
+        if self.lock:
+            fcntl.flock(self.jsonl.fileno(), fcntl.LOCK_EX)
+        try:
+            self.jsonl.write("".join(json.dumps({k: v for k, v in r.items() if k != "meta"}, ensure_ascii=False) + "\n"
+                                     for r in records))
+            self.txt.write("".join(format_result(r["seq_id"], r["distances"], r["question"], r["answer"]) + "\n"
+                                   for r in records))
+            self.jsonl.flush()
+            self.txt.flush()
+        finally:
+            if self.lock:
+                fcntl.flock(self.jsonl.fileno(), fcntl.LOCK_UN)
+        self.n_written += len(records)
+        self.n_batches += 1
+        if self.on_written is not None:
+            self.on_written(records)
+
+    def _sync(self):
+        for f in (self.jsonl, self.txt):
+            os.fsync(f.fileno())
+
+    def _run(self):
+        last_sync = time.monotonic()
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = any(r is _CLOSE for r in batch)
+            records = [r for r in batch if r is not _CLOSE]
+            try:
+                if records and self.error is None:
+                    self._write(records)
+                if closing or time.monotonic() - last_sync >= self.fsync_interval:
+                    self._sync()
+                    last_sync = time.monotonic()
+            except Exception as e:  # reported to the producers by put/close
+                self.error = e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+        self.jsonl.close()
+        self.txt.close()
+
+
+def mark_in_index(index, exp_dir, model: str, system_prompt: str):
+    """on_written callback recording the written answers in a CompletionIndex (None without index)."""
+    if index is None:
+        return None
+    return lambda records: index.mark_many_done(exp_dir, model, system_prompt,
+                                                [(r["seq_id"], r["question"]) for r in records])
+
+
+def chain_written(*callbacks):
+    """Combine on_written callbacks, the None ones are skipped."""
+    callbacks = [c for c in callbacks if c is not None]
+    if not callbacks:
+        return None
+
+    def on_written(records):
+        for callback in callbacks:
+            callback(records)
+    return on_written
+
+
+def read_results(path) -> list:
+    """Records of a results.jsonl (the last line may be cut if the run was killed mid-write)."""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
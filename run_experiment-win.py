@@ -37,6 +37,8 @@ def extract_assistant_answer(full_text):
             # If nothing found, return the whole text
             return full_text.strip()
 
+# One llama-cli process (model load + system prompt evaluation) per question, see
+# run_experiment_chat.py for the same prompts sent to a single llama-server per model
 def run_one_prompt(dir, question, prompt, idx, model_with_name, distance):
     print(f"Running prompt {idx} in: {dir}")
 
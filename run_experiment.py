@@ -4,7 +4,50 @@ import sys
 import select
 import time
 
-def run_one_dir(dir):
+from completion_index import CompletionIndex
+from experiment_files import parse_questions, read_text
+from predict_budget import load_budget
+
+# Per-question n_predict ($REACHABILITY_BUDGET), the C++ binary reads it from n_predict.txt
+budget = load_budget()
+
+def write_budgets(dir, output_dir):
+    """One n_predict per line of reachability_questions.txt, computed from its distance columns."""
+    lines = read_text(os.path.join(dir, "reachability_questions.txt")).splitlines()
+    os.makedirs(os.path.join(dir, output_dir), exist_ok=True)
+    with open(os.path.join(dir, output_dir, "n_predict.txt"), "w") as f:
+        for line in lines:
+            parts = line.split("\t")
+            f.write(f"{budget([parts[0]] + parts[2:]) if len(parts) >= 2 else -1}\n")
+
+def sync_index(index, dir, output_dir):
+    """Mark as done in the completion index every question found in the results.txt of the C++ binary."""
+    system_prompt = read_text(os.path.join(dir, "system.txt"))
+    questions = [(seq_id, q) for seq_id, _, q in parse_questions(read_text(os.path.join(dir, "reachability_questions.txt")))]
+    index.ingest_results_file(dir, output_dir, os.path.join(dir, output_dir, "results.txt"), system_prompt, questions)
+    return system_prompt, questions
+
+def prepare_resume(index, dir, output_dir):
+    """
+    Sync the completion index with the results.txt of a previous run and tell the
+    C++ binary which questions to skip. Returns False when nothing is left to ask.
+    """
+    system_prompt, questions = sync_index(index, dir, output_dir)
+    results_dir = os.path.join(dir, output_dir)
+    done = index.done_seq_ids(dir, output_dir, system_prompt, questions)
+    if len(done) == len(questions):
+        print(f"All {len(questions)} questions already answered, skipping {dir}")
+        return False
+    if done:
+        os.makedirs(results_dir, exist_ok=True)
+        with open(os.path.join(results_dir, "completed_seq_ids.txt"), "w") as f:
+            f.write("\n".join(str(seq_id) for seq_id in sorted(done)) + "\n")
+        print(f"Resuming {dir}: {len(done)} of {len(questions)} questions already answered")
+    elif os.path.exists(os.path.join(results_dir, "completed_seq_ids.txt")):
+        os.remove(os.path.join(results_dir, "completed_seq_ids.txt"))
+    return True
+
+def run_one_dir(dir, index):
     print("dir is", dir)
     where_is_llama =  "../llama.cpp-master"
     where_is_llama =  "../newllama/llama.cpp/build/bin"
@@ -21,6 +64,14 @@ def run_one_dir(dir):
     model = "Mistral-Small-3.1-24B-Instruct-2503-Q6_K.gguf"
     #model = "Qwen2.5-Coder-1.5B.Q8_0.gguf"
 
+    # Same name as the output directory of the C++ binary
+    output_dir = "output-" + os.path.splitext(model)[0]
+    if not prepare_resume(index, dir, output_dir):
+        return
+    if budget is not None:
+        write_budgets(dir, output_dir)
+    elif os.path.exists(os.path.join(dir, output_dir, "n_predict.txt")):
+        os.remove(os.path.join(dir, output_dir, "n_predict.txt"))
 
     # Call the program with the specific environment
     command =  f"reachability-bench -m ../models/{model} -ns 60 -np 42 -b 50000 -c 100000"
@@ -51,7 +102,7 @@ def run_one_dir(dir):
         if rlist:
             # Wait for either stdout or stderr to have data ready
             ready_to_read, _, _ = select.select(rlist, [], [])
-            
+
             for stream in ready_to_read:
                 output = stream.readline()
                 if output:  # Check if there's any output
@@ -67,23 +118,27 @@ def run_one_dir(dir):
         if process.poll() is not None and process.stdout.closed and process.stderr.closed:
             break
 
+    # Record what this run answered (also what an interrupted run managed to write)
+    sync_index(index, dir, output_dir)
+
 
 def get_subdirectories(directory):
     # List all entries in the directory
     return [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
 
-def run_experiment(directory):
+def run_experiment(directory, index):
     dirs = get_subdirectories(directory)
     for dir in dirs:
-        run_one_dir(directory + "/" + dir)
+        run_one_dir(directory + "/" + dir, index)
 
 if len(sys.argv) > 1:
+    index = CompletionIndex()
     for directory in sys.argv[1:]:
-        run_experiment(directory)
+        run_experiment(directory, index)
         # cool down a bit
         # not needed on JZ
         # time.sleep(120)
-    
+
 else:
     print("no work to do!")
 # Wait for the process to finish and also check for errors
@@ -91,4 +146,4 @@ else:
 
 # Check if there was any error
 #if stderr:
-#    print("Error:", stderr)
\ No newline at end of file
+#    print("Error:", stderr)
@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import pathlib
+import time
+
+from answer_store import load_store
+from completion_index import CompletionIndex
+from experiment_files import find_experiment_dirs, parse_questions, read_text
+from experiment_scheduler import LlamaServer, answer_meta, parse_model
+from llama_server_client import run_bounded, stream_completion
+from predict_budget import load_budget
+from result_writer import ResultWriter, chain_written, mark_in_index
+from telemetry import TelemetryWriter, record_from_server_result
+
+# ==========================
+#   Chat formatted runner
+# ==========================
+# Same prompts as run_experiment-win.py (ChatML, <|im_start|> template) but sent to one
+# llama-server per model instead of one llama-cli process per question: the model is
+# loaded once, the system prompt stays in the slot caches, and the server only sends
+# back the assistant turn, so there is nothing to trim from a console transcript.
+
+CHAT_STOP = ["<|im_end|>", "<|im_start|>"]
+CHAT_TEMPLATE = "chatml"  # answer store template
+
+
+def chat_prompt(system_prompt: str, question: str) -> str:
+    """ChatML prompt, the system turn is an identical prefix for all the questions of a directory."""
+    return (
+        f"<|im_start|>system\n"
+        f"{system_prompt}\n"
+        f"<|im_end|>\n"
+        f"<|im_start|>user\n"
+        f"{question}\n"
+        f"<|im_end|>\n"
+        f"<|im_start|>assistant\n"
+    )
+
+
+async def run_directory(transport, exp_dir: pathlib.Path, model_name: str, n_parallel: int, n_predict: int,
+                        index: CompletionIndex, budget=None, ctx_size=None, store=None):
+    """Ask every question of exp_dir, answers go to exp_dir/model_name (results.jsonl, results.txt)."""
+    system_prompt = read_text(exp_dir / "system.txt")
+    questions = parse_questions(read_text(exp_dir / "reachability_questions.txt"))
+    output_dir = exp_dir / model_name
+    index.ingest_results_file(exp_dir, model_name, output_dir / "results.txt", system_prompt,
+                              [(seq_id, q) for seq_id, _, q in questions])
+    questions = index.pending(exp_dir, model_name, system_prompt, questions)
+    if not questions:
+        return 0
+
+    telemetry = TelemetryWriter(output_dir / "telemetry.jsonl")
+    queued_at = time.perf_counter()
+    on_written = chain_written(mark_in_index(index, exp_dir, model_name, system_prompt),
+                               store and store.filler(model_name, system_prompt, CHAT_TEMPLATE))
+    with ResultWriter(output_dir, on_written=on_written) as results:
+        if store is not None:
+            questions = store.serve(results, model_name, system_prompt, questions, CHAT_TEMPLATE)
+
+        async def handle(item):
+            seq_id, distances, question = item
+            payload = {
+                "prompt": chat_prompt(system_prompt, question),
+                "n_predict": budget(distances) if budget is not None else n_predict,
+                "cache_prompt": True,
+                "stop": CHAT_STOP,
+            }
+            try:
+                start = time.perf_counter()
+                # The whole assistant turn is kept (no early stop on YES/NO), as with llama-cli
+                result = await stream_completion(transport, payload, stop_words=())
+            except (OSError, ValueError) as e:
+                print(f"[Q{seq_id}] ❌ Error:", e)
+                return
+            results.put(seq_id, distances, question.strip(), result["content"].strip(),
+                        **answer_meta(result, {"n_predict": payload["n_predict"], "stop": CHAT_STOP}))
+            telemetry.write(record_from_server_result(
+                result, start - queued_at, time.perf_counter() - start, runner="run_experiment_chat",
+                model=model_name, exp_dir=str(exp_dir), ctx_size=ctx_size, seq_id=seq_id, distances=distances))
+
+        await run_bounded(questions, handle, n_parallel)
+    telemetry.close()
+    return len(questions)
+
+
+async def run_experiments(roots, models, args):
+    dirs = [d for root in roots for d in find_experiment_dirs(root)]
+    print(f"Found {len(dirs)} experiment directories")
+    index = CompletionIndex(args.index)
+    budget = load_budget(args.budget)
+    store = load_store(args.answer_store)
+
+    for model_path, model_name in models:
+        print("With model:", model_name)
+        server = LlamaServer(args.server, model_path, args.parallel, args.gpu_layers, args.port)
+        start_all = time.time()
+        try:
+            # One context for the whole run (-c of the llama-cli runner), per slot
+            await server.ensure(args.ctx_size * args.parallel, 0)
+            for d in dirs:
+                start = time.time()
+                n_questions = await run_directory(server.transport, d, model_name, args.parallel, args.n_predict,
+                                                  index, budget, server.ctx_size, store)
+                print(f"[{model_name}] {d}: {n_questions} questions in {time.time() - start:.2f}s")
+        finally:
+            await server.close()
+        print(f"[{model_name}] {len(dirs)} directories in {time.time() - start_all:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the chat formatted experiments with one llama-server per model")
+    parser.add_argument("roots", nargs="+", help="experiment root directories")
+    parser.add_argument("--model", action="append", required=True,
+                        help="model.gguf[:output-name], can be repeated (e.g. qwen2.5-coder-3b-instruct-q4_k_m.gguf:Coder-3B)")
+    parser.add_argument("--server", default="llama-server", help="llama-server executable")
+    parser.add_argument("--ctx-size", type=int, default=32768, help="context size per slot")
+    parser.add_argument("--parallel", type=int, default=1)
+    parser.add_argument("--gpu-layers", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--n-predict", type=int, default=512)
+    parser.add_argument("--budget", default=None, help="per-question n_predict model fitted by predict_budget.py ('default' for the unfitted one)")
+    parser.add_argument("--index", default=None, help="completion index file (default: $REACHABILITY_INDEX or completion_index.sqlite)")
+    parser.add_argument("--answer-store", default=None,
+                        help="reuse and record answers in this store (default: $REACHABILITY_ANSWER_STORE, unset: off)")
+    args = parser.parse_args()
+
+    asyncio.run(run_experiments(args.roots, [parse_model(m) for m in args.model], args))
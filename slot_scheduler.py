@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import deque
+
+from llama_server_client import stream_completion
+
+# ==========================
+#   Slot pinned dispatching
+# ==========================
+# llama-server keeps, per slot, the tokens of the last request it served and only
+# processes the part of a new prompt that differs from them (cache_prompt). With
+# id_slot left to auto, consecutive questions of an experiment land on any slot and
+# prompts from different system prompts evict each other. Here every slot is pinned
+# to one experiment: it is warmed with the system prompt once, then only gets that
+# experiment's questions, sorted so that consecutive prompts share the longest prefix.
+
+def order_for_prefix_sharing(questions: list) -> list:
+    """
+    Sort (seq_id, distances, question) tuples on the question text: neighbours in
+    lexicographic order share the longest common prefix (same source method, ...).
+    """
+    return sorted(questions, key=lambda q: (q[-1], q[0]))
+
+
+class Experiment:
+    """
+    Questions sharing one system prompt, `on_result(item, result)` is called for every answer.
+    `payload` holds request fields specific to this experiment (e.g. n_keep).
+    """
+
+    def __init__(self, key, system_prompt: str, questions: list, on_result, payload: dict = None):
+        self.key = key
+        self.system_prompt = system_prompt
+        self.pending = deque(order_for_prefix_sharing(questions))
+        self.on_result = on_result
+        self.payload = payload or {}
+        self.n_slots = 0  # slots currently pinned to this experiment
+
+
+class SlotStats:
+    """Prefix reuse of one slot, from the `timings` sent back by the server."""
+
+    def __init__(self, id_slot: int):
+        self.id_slot = id_slot
+        self.n_requests = 0
+        self.n_warmups = 0
+        self.warmup_prompt_n = 0
+        self.prompt_n = 0  # prompt tokens the server had to process
+        self.cache_n = 0   # prompt tokens reused from the slot cache
+        self.n_misrouted = 0
+
+    def add(self, result: dict):
+        self.n_requests += 1
+        timings = result.get("timings", {})
+        self.prompt_n += timings.get("prompt_n", 0)
+        self.cache_n += timings.get("cache_n", 0)
+        if result.get("id_slot") not in (None, self.id_slot):
+            self.n_misrouted += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.prompt_n + self.cache_n
+        return self.cache_n / total if total else 0.0
+
+
+class SlotScheduler:
+    """
+    One worker per server slot. A worker keeps asking questions of the experiment
+    its slot is pinned to, and only moves (and warms again) once that experiment
+    has no question left.
+    """
+
+    def __init__(self, transport, n_slots: int, payload: dict = None, stop_words=("YES", "NO"), n_predict_fn=None):
+        self.transport = transport
+        self.n_slots = n_slots
+        # Extra request fields (n_predict, n_keep, stop, ...)
+        self.payload = payload or {}
+        # Optional callable(distances) -> n_predict for each question (see predict_budget)
+        self.n_predict_fn = n_predict_fn
+        self.stop_words = stop_words
+        self.stats = [SlotStats(i) for i in range(n_slots)]
+        self.experiments = []
+        self.t_start = None
+
+    def _pick(self, current):
+        """Stay on the current experiment while it has work, else join the least served one."""
+        if current is not None and current.pending:
+            return current
+        if current is not None:
+            current.n_slots -= 1
+        candidates = [e for e in self.experiments if e.pending]
+        if not candidates:
+            return None
+        chosen = min(candidates, key=lambda e: (e.n_slots, -len(e.pending)))
+        chosen.n_slots += 1
+        return chosen
+
+    async def _warm(self, id_slot: int, experiment: Experiment):
+        # One generated token is enough, the point is to have the system prompt in the slot cache
+        payload = dict(self.payload, **experiment.payload)
+        payload.update(prompt=experiment.system_prompt, n_predict=1, id_slot=id_slot, cache_prompt=True)
+        result = await stream_completion(self.transport, payload, stop_words=())
+        self.stats[id_slot].n_warmups += 1
+        self.stats[id_slot].warmup_prompt_n += result["timings"].get("prompt_n", 0)
+        return result
+
+    async def _slot_worker(self, id_slot: int):
+        stats = self.stats[id_slot]
+        experiment = None
+        while True:
+            previous = experiment
+            experiment = self._pick(experiment)
+            if experiment is None:
+                return
+            try:
+                if experiment is not previous:
+                    await self._warm(id_slot, experiment)
+                item = experiment.pending.popleft()
+                seq_id, distances, question = item
+                payload = dict(self.payload, **experiment.payload)
+                payload.update(prompt=f"{experiment.system_prompt}\n{question}", id_slot=id_slot, cache_prompt=True)
+                if self.n_predict_fn is not None:
+                    payload["n_predict"] = self.n_predict_fn(distances)
+                t_request = time.perf_counter()
+                result = await stream_completion(self.transport, payload, stop_words=self.stop_words)
+                # Every question is queued when run() starts
+                result["queue_wait"] = t_request - self.t_start
+                result["total_time"] = time.perf_counter() - t_request
+            except (OSError, ValueError) as e:
+                print(f"[slot {id_slot}] ❌ Error:", e)
+                continue
+            stats.add(result)
+            experiment.on_result(item, result)
+
+    async def run(self, experiments: list):
+        """Answer every question of the experiments, returns the per-slot statistics."""
+        self.experiments = list(experiments)
+        self.t_start = time.perf_counter()
+        await asyncio.gather(*(self._slot_worker(i) for i in range(self.n_slots)))
+        return self.stats
+
+    def report(self) -> str:
+        lines = ["=== Per-slot prefix reuse ==="]
+        for s in self.stats:
+            lines.append(f"slot {s.id_slot:>2}: {s.n_requests:>5} requests, {s.n_warmups} warm-up(s) ({s.warmup_prompt_n} t), "
+                         f"cached {s.cache_n} / processed {s.prompt_n} prompt tokens, hit rate {s.hit_rate:.1%}"
+                         + (f", {s.n_misrouted} misrouted" if s.n_misrouted else ""))
+        cache_n = sum(s.cache_n for s in self.stats)
+        total = cache_n + sum(s.prompt_n for s in self.stats)
+        lines.append(f"overall hit rate {cache_n / total if total else 0.0:.1%}")
+        return "\n".join(lines)
@@ -0,0 +1,90 @@
+import re
+import time
+
+# Same pattern as extract_answer in content_analysis_v2.py
+FINAL_ANSWER_PATTERN = re.compile(r'final answer\s*:\s*(yes|no)', re.IGNORECASE)
+
+# Longest text a match can span once whitespace is taken into account, used to
+# only re-scan the tail of the response when a new token arrives
+MATCH_WINDOW = 64
+
+
+class FinalAnswerMatcher:
+    """
+    Incremental matcher fed with the generated pieces one at a time.
+    It only re-scans the last MATCH_WINDOW characters so the cost per token
+    does not grow with the length of the response.
+    """
+
+    def __init__(self, stop_words=("User:",), pattern=FINAL_ANSWER_PATTERN):
+        self.stop_words = list(stop_words)
+        self.pattern = pattern
+        self.text = ""
+        self.answer = None       # "YES" / "NO" once the final answer is seen
+        self.stop_reason = None  # "answer" / "stop_word"
+
+    def feed(self, piece: str) -> bool:
+        """Add a piece of generated text, return True when generation should stop."""
+        if self.stop_reason is not None:
+            return True
+        start = max(0, len(self.text) - MATCH_WINDOW)
+        self.text += piece
+        tail = self.text[start:]
+
+        match = self.pattern.search(tail)
+        stop_hits = [(tail.find(w), w) for w in self.stop_words if w in tail]
+
+        if stop_hits and (match is None or min(stop_hits)[0] < match.start()):
+            # Reverse prompt, same as the C++ runner: drop it from the response
+            pos, _ = min(stop_hits)
+            self.text = self.text[:start + pos]
+            self.stop_reason = "stop_word"
+            return True
+        if match is not None:
+            self.text = self.text[:start + match.end()]
+            self.answer = match.group(1).upper()
+            self.stop_reason = "answer"
+            return True
+        return False
+
+
+def generate_until_answer(llm, prompt: str, max_tokens: int = 256, stop=("User:",), stats: dict = None, on_token=None):
+    """
+    Stream a llama_cpp completion and abort it as soon as the final answer is given.
+    If a `stats` dict is given, time_to_first_token and decode_tps are stored in it,
+    `on_token(piece)` is called for every generated piece.
+
+    Returns:
+        tuple[str, str, int]: response text, stop reason ("answer", "stop_word" or "length")
+                              and the number of streamed tokens.
+    """
+    matcher = FinalAnswerMatcher(stop_words=stop)
+    n_tokens = 0
+    finish_reason = None
+    start = time.perf_counter()
+    t_first = None
+    chunks = llm(prompt, max_tokens=max_tokens, stop=list(stop), stream=True)
+    try:
+        for chunk in chunks:
+            n_tokens += 1
+            if t_first is None:
+                t_first = time.perf_counter()
+            choice = chunk["choices"][0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            if on_token is not None:
+                on_token(choice["text"])
+            if matcher.feed(choice["text"]):
+                break
+    finally:
+        # Closing the generator stops llama_cpp from decoding any further token
+        chunks.close()
+
+    if stats is not None and t_first is not None:
+        stats["time_to_first_token"] = t_first - start
+        decode_time = time.perf_counter() - t_first
+        stats["decode_tps"] = (n_tokens - 1) / decode_time if n_tokens > 1 and decode_time > 0 else None
+
+    if matcher.stop_reason is not None:
+        return matcher.text, matcher.stop_reason, n_tokens
+    # llama_cpp reports "stop" when it hit one of the stop words itself (or EOS)
+    return matcher.text, "stop_word" if finish_reason == "stop" else "length", n_tokens
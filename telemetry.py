@@ -0,0 +1,199 @@
+import argparse
+import json
+import math
+import pathlib
+import threading
+import time
+from collections import defaultdict
+
+# ==========================
+#   Per-request telemetry
+# ==========================
+# Every runner (python, server, C++) writes one JSON line per answered question to
+# telemetry.jsonl, next to its results.txt. Times are in seconds.
+FIELDS = (
+    "runner",               # which runner produced the record
+    "model",                # output directory name of the model
+    "exp_dir",              # experiment directory
+    "ctx_size",             # context size the model/server was started with
+    "seq_id",
+    "distances",            # distance columns of the question, as strings
+    "prompt_tokens",        # prompt tokens processed for this request
+    "cached_tokens",        # prompt tokens reused from the cache (system prompt, slot cache)
+    "generated_tokens",
+    "queue_wait",           # from the question being queued to its request starting
+    "time_to_first_token",
+    "total_time",           # request start to answer
+    "decode_tps",           # generated tokens per second, after the first token
+    "stop_reason",          # answer / word / stop_word / length / eos / ...
+    "slot_id",              # server slot or C++ client, None for single sequence runners
+    "timestamp",            # unix time the record was written
+)
+
+
+def make_record(**values) -> dict:
+    """Telemetry record with every field of FIELDS (missing ones set to None)."""
+    unknown = set(values) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown telemetry fields: {sorted(unknown)}")
+    record = {field: values.get(field) for field in FIELDS}
+    if record["timestamp"] is None:
+        record["timestamp"] = time.time()
+    return record
+
+
+def record_from_server_result(result: dict, queue_wait=None, total_time=None, **values) -> dict:
+    """Build a record from what llama_server_client.stream_completion (or a /completions JSON) returned."""
+    timings = result.get("timings", {})
+    predicted_n = timings.get("predicted_n", result.get("n_tokens"))
+    predicted_ms = timings.get("predicted_ms")
+    return make_record(
+        prompt_tokens=timings.get("prompt_n"),
+        cached_tokens=timings.get("cache_n"),
+        generated_tokens=predicted_n,
+        queue_wait=queue_wait,
+        time_to_first_token=result.get("time_to_first_token"),
+        total_time=total_time,
+        decode_tps=predicted_n / (predicted_ms / 1000) if predicted_n and predicted_ms else None,
+        stop_reason=result.get("stop_reason") or result.get("stop_type"),
+        slot_id=result.get("id_slot"),
+        **values,
+    )
+
+
+class TelemetryWriter:
+    """Thread-safe JSONL appender, one file kept open for the whole run."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# ==========================
+#       Aggregation
+# ==========================
+def read_records(roots) -> list:
+    records = []
+    for root in roots:
+        for path in sorted(pathlib.Path(root).rglob("telemetry.jsonl")):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        records.append(json.loads(line))
+    return records
+
+
+def percentile(values: list, q: float):
+    """Nearest-rank percentile, None for an empty list."""
+    if not values:
+        return None
+    values = sorted(values)
+    # q * n / 100 rather than q / 100 * n: exact for integer ranks (e.g. p90 of 10 values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values) / 100) - 1))]
+
+
+def summarize(records: list) -> list:
+    """One summary dict per (model, ctx_size): throughput, cache reuse and latency percentiles."""
+    groups = defaultdict(list)
+    for r in records:
+        groups[(r.get("model"), r.get("ctx_size"))].append(r)
+
+    summaries = []
+    for (model, ctx_size), rs in sorted(groups.items(), key=lambda g: (str(g[0][0]), g[0][1] or 0)):
+        def values(field):
+            return [r[field] for r in rs if r.get(field) is not None]
+        generated = sum(values("generated_tokens"))
+        # Wall clock span of the group: first request start to last answer
+        starts = [r["timestamp"] - r["total_time"] for r in rs if r.get("total_time") is not None]
+        span = max(r["timestamp"] for r in rs) - min(starts) if starts else None
+        cached, processed = sum(values("cached_tokens")), sum(values("prompt_tokens"))
+        summary = {
+            "model": model,
+            "ctx_size": ctx_size,
+            "n_requests": len(rs),
+            "generated_tokens": generated,
+            "throughput_tps": generated / span if span else None,
+            "cache_hit_rate": cached / (cached + processed) if cached + processed else None,
+        }
+        for field in ("queue_wait", "time_to_first_token", "total_time", "decode_tps"):
+            for q in (50, 90, 99):
+                summary[f"{field}_p{q}"] = percentile(values(field), q)
+        stop_reasons = defaultdict(int)
+        for r in rs:
+            stop_reasons[str(r.get("stop_reason"))] += 1
+        summary["stop_reasons"] = dict(sorted(stop_reasons.items()))
+        summaries.append(summary)
+    return summaries
+
+
+def format_summary(summary: dict) -> str:
+    def fmt(v, unit=""):
+        return "-" if v is None else (f"{v:.2f}{unit}" if isinstance(v, float) else f"{v}{unit}")
+    lines = [f"=== {summary['model']} (ctx {summary['ctx_size']}) ===",
+             f"requests {summary['n_requests']}, generated {summary['generated_tokens']} tokens, "
+             f"throughput {fmt(summary['throughput_tps'], ' t/s')}, cache hit rate "
+             + ("-" if summary["cache_hit_rate"] is None else f"{summary['cache_hit_rate']:.1%}")]
+    for field, unit in (("queue_wait", "s"), ("time_to_first_token", "s"), ("total_time", "s"), ("decode_tps", " t/s")):
+        lines.append(f"{field:<20} p50 {fmt(summary[field + '_p50'], unit)}  p90 {fmt(summary[field + '_p90'], unit)}"
+                     f"  p99 {fmt(summary[field + '_p99'], unit)}")
+    lines.append(f"stop reasons: {summary['stop_reasons']}")
+    return "\n".join(lines)
+
+
+# ==========================
+#   C++ run summaries
+# ==========================
+# reachability_bench.cpp also appends one line per run to run_summary.jsonl (parameters,
+# llama.cpp build, totals, batch occupancy) and per-sequence timings to sequences.csv.
+RUN_COLUMNS = ("llama_build", "n_parallel", "n_batch", "ctx_size", "speculative", "n_answered", "t_total",
+               "prompt_tps", "gen_tps", "cache_misses", "batch_occupancy")
+
+
+def read_run_summaries(roots) -> list:
+    runs = []
+    for root in roots:
+        for path in sorted(pathlib.Path(root).rglob("run_summary.jsonl")):
+            with open(path, "r", encoding="utf-8") as f:
+                runs.extend(json.loads(line) for line in f if line.strip())
+    return sorted(runs, key=lambda r: r.get("timestamp", 0))
+
+
+def format_runs(runs: list) -> str:
+    """One row per C++ run, to spot throughput changes between llama.cpp builds or parameter sets."""
+    def fmt(v):
+        return "-" if v is None else (f"{v:.2f}" if isinstance(v, float) else str(v))
+    rows = [("model",) + RUN_COLUMNS]
+    rows += [(pathlib.Path(str(r.get("model"))).stem,) + tuple(fmt(r.get(c)) for c in RUN_COLUMNS) for r in runs]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize telemetry.jsonl files per model and context size")
+    parser.add_argument("roots", nargs="+", help="directories searched recursively for telemetry.jsonl")
+    parser.add_argument("--json", action="store_true", help="print the summaries as JSON")
+    parser.add_argument("--runs", action="store_true", help="compare the C++ runs (run_summary.jsonl) instead")
+    args = parser.parse_args()
+
+    if args.runs:
+        runs = read_run_summaries(args.roots)
+        print(json.dumps(runs, indent=4) if args.json else format_runs(runs))
+        raise SystemExit(0)
+
+    summaries = summarize(read_records(args.roots))
+    if args.json:
+        print(json.dumps(summaries, indent=4))
+    else:
+        print("\n\n".join(format_summary(s) for s in summaries))
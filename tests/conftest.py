@@ -0,0 +1,9 @@
+import pathlib
+import sys
+
+# The runners live at the root of the repository and the generators in code_generation,
+# both import their modules by plain name
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+for path in (ROOT, ROOT / "code_generation"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
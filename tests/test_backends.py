@@ -0,0 +1,44 @@
+import pytest
+
+from backends import Backend, LlamaServerBackend, make_result
+from fake_llama_server import start_fake_server
+
+
+def answer_or_fail(prompt):
+    if "broken" in prompt:
+        raise RuntimeError("the server dies on this one")
+    return "a calls b, FINAL ANSWER: YES"
+
+
+@pytest.fixture
+def server():
+    server = start_fake_server(answer_fn=answer_or_fail, n_slots=2)
+    yield server
+    server.shutdown()
+
+
+def test_failed_request_only_skips_its_question(server):
+    backend = LlamaServerBackend(f"http://127.0.0.1:{server.server_address[1]}", n_parallel=2)
+    backend.open_experiment("exp", "system")
+    questions = [(0, ["1"], "first"), (1, ["1"], "broken"), (2, ["-1"], "third")]
+    answered = []
+
+    results = backend.complete_batch(questions, on_result=lambda item, result: answered.append(item[0]))
+    assert sorted(answered) == [0, 2]
+    assert [r["content"] for r in results] == ["a calls b, FINAL ANSWER: YES"] * 2
+    with pytest.raises(ConnectionError):
+        backend.complete(questions[1])
+
+
+class FlakyBackend(Backend):
+    def complete(self, item, n_predict=256, on_token=None):
+        if item[0] == 1:
+            raise ChildProcessError("exited with code 1")
+        return make_result(f"answer {item[0]}")
+
+
+def test_process_failure_is_not_written():
+    answered = []
+    results = FlakyBackend().complete_batch([(0, ["1"], "a"), (1, ["1"], "b"), (2, ["1"], "c")],
+                                            on_result=lambda item, result: answered.append(item[0]))
+    assert answered == [0, 2] and [r["content"] for r in results] == ["answer 0", "answer 2"]
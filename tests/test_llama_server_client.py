@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from fake_llama_server import start_fake_server
+from llama_server_client import AsyncioTransport, run_bounded, stream_completion, wait_for_server_async
+
+
+@pytest.fixture
+def server():
+    server = start_fake_server(answer_fn=lambda prompt: "a calls b then FINAL ANSWER: YES and more text")
+    yield server
+    server.shutdown()
+
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_stream_stops_at_the_stop_word(server):
+    async def main():
+        transport = AsyncioTransport(url(server))
+        assert await wait_for_server_async(transport, timeout=5, interval=0.05)
+        pieces = []
+        result = await stream_completion(transport, {"prompt": "Does `a` call `b`?", "stop": ["YES", "NO"]},
+                                         on_token=pieces.append)
+        return result, pieces
+
+    result, pieces = asyncio.run(main())
+    assert result["content"].strip() == "a calls b then FINAL ANSWER:"
+    assert (result["stopping_word"], result["stop_reason"]) == ("YES", "word")
+    assert "".join(pieces) == result["content"]
+    assert result["n_tokens"] == len(pieces) and result["id_slot"] == 0
+
+
+def test_run_bounded_keeps_the_requests_in_flight():
+    server_2 = start_fake_server(token_delay=0.005, n_slots=4)
+    try:
+        async def main():
+            transport = AsyncioTransport(url(server_2))
+            done = []
+
+            async def handle(i):
+                await stream_completion(transport, {"prompt": f"question {i}"})
+                done.append(i)
+            await run_bounded(range(10), handle, n_in_flight=3)
+            return done
+
+        assert sorted(asyncio.run(main())) == list(range(10))
+        assert server_2.n_requests == 10 and server_2.max_in_flight <= 3
+    finally:
+        server_2.shutdown()
+
+
+def test_http_error_is_a_connection_error(server):
+    async def main():
+        # The fake server only knows /completions, any other path is a 404
+        events = AsyncioTransport(url(server)).stream_post("/unknown", {"prompt": "p"})
+        return [event async for event in events]
+
+    # ConnectionError is an OSError, what the runners catch to skip one question
+    with pytest.raises(ConnectionError, match="HTTP 404"):
+        asyncio.run(main())
@@ -0,0 +1,56 @@
+import itertools
+import random
+
+import pytest
+
+from generate_chain import MethodNameAllocator, format_method_name
+
+WORDS = (["get", "set", "is"], ["Data", "Item"], ["ById", "OrDefault", "AsList"])
+
+
+def test_every_name_exactly_once():
+    allocator = MethodNameAllocator(seed=1, words=WORDS)
+    names = allocator.allocate(allocator.size)
+    assert sorted(names) == sorted(v + n + c for v, n, c in itertools.product(*WORDS))
+    assert allocator.remaining == 0
+    with pytest.raises(ValueError):
+        allocator.allocate(1)
+
+
+def test_allocations_never_repeat_and_are_seeded():
+    allocator = MethodNameAllocator(seed=7)
+    first, second = allocator.allocate(500), allocator.allocate(500)
+    assert len(set(first + second)) == 1000
+    assert MethodNameAllocator(seed=7).allocate(1000) == first + second
+    assert MethodNameAllocator(seed=8).allocate(1000) != first + second
+
+
+def test_unseeded_allocator_draws_from_the_global_random():
+    random.seed(3)
+    a = MethodNameAllocator(words=WORDS).allocate(10)
+    random.seed(3)
+    assert MethodNameAllocator(words=WORDS).allocate(10) == a
+
+
+def test_stream_and_overdraw():
+    allocator = MethodNameAllocator(seed=0, words=WORDS)
+    head = allocator.allocate(5)
+    rest = list(allocator.stream())
+    assert len(rest) == allocator.size - 5 and not set(head) & set(rest)
+    with pytest.raises(ValueError):
+        MethodNameAllocator(seed=0, words=WORDS).allocate(19)
+
+
+def test_naming_styles():
+    assert format_method_name("get", "Data", "ById") == "getDataById"
+    assert format_method_name("get", "Data", "ById", "PascalCase") == "GetDataById"
+    assert format_method_name("get", "Data", "ById", "snake_case") == "get_data_byid"
+    assert MethodNameAllocator(seed=0, style="snake_case", words=WORDS).allocate(1)[0].islower()
+
+
+def test_shared_allocator_across_contexts():
+    from generator_8lang import MethodNameGenerator
+    names = MethodNameGenerator.allocator(seed=5)
+    contexts = [MethodNameGenerator.generate_unique_method_names(200, names=names) for _ in range(5)]
+    assert len({name for context in contexts for name in context}) == 1000
+    assert contexts[0] == MethodNameGenerator.generate_unique_method_names(200, seed=5)
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from predict_budget import TokenBudget, collect_samples
+from result_writer import format_result
+
+
+def test_fit_recovers_a_linear_length_model():
+    # Linear experiments: only the distance varies, negative distances count by their absolute value
+    samples = [([str(d)], 50 + 30 * abs(d)) for d in range(-8, 9) if d != 0]
+    budget = TokenBudget.fit(samples, min_tokens=1)
+    assert budget.base == pytest.approx(50, abs=1e-3)
+    assert budget.per_hop == pytest.approx([30, 0, 0], abs=1e-3)
+    assert budget.margin == pytest.approx(1.0)
+    assert budget(["-4"]) == 170
+
+
+def test_fit_margin_covers_the_quantile():
+    rng = random.Random(0)
+    samples = [([d, 2 * d - h, h], int((40 + 20 * d + 5 * h) * rng.uniform(0.7, 1.5)))
+               for d in range(1, 10) for h in range(1, d + 1) for _ in range(5)]
+    budget = TokenBudget.fit(samples, quantile=0.9, min_tokens=1)
+    covered = sum(1 for d, n in samples if n <= budget(d)) / len(samples)
+    assert covered >= 0.9
+    assert budget.margin > 1.0
+    assert all(c >= 0 for c in budget.per_hop)
+
+
+def test_budget_is_clamped():
+    budget = TokenBudget(base=10, per_hop=(1000, 0, 0), margin=1.0, min_tokens=128, max_tokens=512)
+    assert budget(["0"]) == 128
+    assert budget(["3"]) == 512
+
+
+def test_fit_without_samples():
+    with pytest.raises(ValueError):
+        TokenBudget.fit([])
+
+
+def test_save_load_and_samples_from_results(tmp_path):
+    budget = TokenBudget(base=100, per_hop=(10, 2, 1), margin=1.5)
+    budget.save(tmp_path / "budget.json")
+    assert TokenBudget.load(tmp_path / "budget.json").to_dict() == budget.to_dict()
+
+    run = tmp_path / "xp" / "model"
+    run.mkdir(parents=True)
+    (run / "results.txt").write_text(format_result(0, ["3", "4", "2"], "q", "a b c") + "\n"
+                                     + format_result(1, ["-1"], "q", "one two") + "\n", encoding="utf-8")
+    assert collect_samples([tmp_path]) == [(["3", "4", "2"], 3), (["-1"], 2)]
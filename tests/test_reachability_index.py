@@ -0,0 +1,52 @@
+import pytest
+
+import method_tree
+from method_tree import CallTree, ReachabilityIndex
+
+
+def names(n):
+    return [f"m{i}" for i in range(n)]
+
+
+TREES = {
+    "binary": lambda store: method_tree.build_binary_tree(3, names(15), store=store),
+    "comb": lambda store: method_tree.build_comb_tree(4, 3, names(40), store=store),
+    "unbalanced": lambda store: method_tree.build_unbalanced_binary_tree(4, names(40), store=store),
+    "diamond": lambda store: method_tree.build_diamond_tree(names(40), 4, store=store),
+    "branch": lambda store: method_tree.build_branch(names(6), store=store),
+}
+
+
+@pytest.fixture(params=[(shape, compact) for shape in TREES for compact in (False, True)],
+                ids=lambda p: f"{p[0]}-{'store' if p[1] else 'nodes'}")
+def root(request):
+    shape, compact = request.param
+    return TREES[shape](CallTree() if compact else None)
+
+
+def test_chains_match_the_depth_first_search(root):
+    index = ReachabilityIndex(root)
+    assert index.valid_chains() == method_tree.find_all_valid_chains_depth_first(root)
+    assert index.invalid_chains() == method_tree.find_all_invalid_chains_depth_first(root)
+
+
+def test_reachability_is_the_descendant_relation(root):
+    index = ReachabilityIndex(root)
+    nodes = index.nodes
+    assert [n.name for n in nodes] == [n.name for n in root.get_list_of_nodes()]
+    for a, node in enumerate(nodes):
+        descendants = {n.name for n in node.get_list_of_nodes()} - {node.name}
+        assert index.size(a) == len(descendants) + 1
+        assert {index.names[d] for d in range(len(nodes)) if index.is_reachable(a, d)} == descendants
+        assert set(index.unreachable(a)) == set(index.names) - descendants - {node.name}
+        assert index.traversal(a) == method_tree.depth_first_traversal(node)
+
+
+def test_distances_of_a_reachable_pair(root):
+    index = ReachabilityIndex(root)
+    for a, node in enumerate(index.nodes):
+        for d in range(a + 1, a + index.size(a)):
+            chain, distance, distance_with_backtracking, height = method_tree.depth_first_search(node, index.nodes[d])
+            assert index.chain(a, d) == chain
+            assert (index.distance(a, d), index.distance_with_backtracking(a, d), index.distance_height(a, d)) \
+                == (distance, distance_with_backtracking, height)
@@ -0,0 +1,106 @@
+import sys
+import types
+from queue import Queue
+
+
+class FakeLlama:
+    """
+    Stand-in for llama_cpp.Llama recording the calls SharedPrefixRunner makes: tokens are
+    the bytes of the text, the KV state is the list of evaluated tokens, a completion
+    streams `pieces` one chunk at a time.
+    """
+
+    def __init__(self, pieces=("Step ", "one. ", "FINAL ", "ANSWER: ", "YES", " and more")):
+        self.pieces = list(pieces)
+        self.calls = []
+        self.evaluated = []
+
+    def tokenize(self, text: bytes, add_bos=True, special=False):
+        return ([1] if add_bos else []) + list(text)
+
+    def reset(self):
+        self.calls.append(("reset",))
+        self.evaluated = []
+
+    def eval(self, tokens):
+        self.calls.append(("eval", list(tokens)))
+        self.evaluated += list(tokens)
+
+    def save_state(self):
+        self.calls.append(("save_state",))
+        return ("state", tuple(self.evaluated))
+
+    def load_state(self, state):
+        self.calls.append(("load_state", state))
+        self.evaluated = list(state[1])
+
+    def n_ctx(self):
+        return 4096
+
+    def __call__(self, prompt, max_tokens=16, stop=None, stream=False):
+        self.calls.append(("complete", list(prompt), max_tokens))
+        return ({"choices": [{"text": piece, "finish_reason": None}]} for piece in self.pieces)
+
+
+try:
+    import llama_cpp  # noqa: F401
+except ImportError:
+    # Only the import of reachability_bench_v2 needs it, the runner is given the fake
+    sys.modules["llama_cpp"] = types.SimpleNamespace(Llama=FakeLlama)
+
+from reachability_bench_v2 import SharedPrefixRunner  # noqa: E402
+
+
+class ListResults:
+    """ResultWriter stand-in keeping what is put."""
+
+    def __init__(self):
+        self.records = []
+
+    def put(self, seq_id, distances, question, answer, **meta):
+        self.records.append((seq_id, distances, question, answer, meta))
+
+
+def test_prefix_is_evaluated_once_and_restored_for_each_question():
+    llm = FakeLlama()
+    runner = SharedPrefixRunner(llm, "SYSTEM")
+    prefix = llm.tokenize(b"SYSTEM\nUser:", add_bos=True)
+    assert llm.calls == [("reset",), ("eval", prefix), ("save_state",)]
+
+    llm.calls.clear()
+    for question in ("Does a call b?", "Does b call c?"):
+        runner.ask(question, max_tokens=32)
+    question_tokens = [llm.tokenize(f" {q}\nAssistant:".encode("utf-8"), add_bos=False)
+                       for q in ("Does a call b?", "Does b call c?")]
+    # No evaluation of the prefix again: load the saved state, then complete prefix + question
+    assert llm.calls == [
+        ("load_state", ("state", tuple(prefix))), ("complete", prefix + question_tokens[0], 32),
+        ("load_state", ("state", tuple(prefix))), ("complete", prefix + question_tokens[1], 32),
+    ]
+
+
+def test_ask_stops_at_the_final_answer_and_reports_cached_tokens():
+    llm = FakeLlama()
+    runner = SharedPrefixRunner(llm, "SYSTEM")
+    stats = {}
+    response, stop_reason, n_tokens = runner.ask("Q", stats=stats)
+    assert (response, stop_reason, n_tokens) == ("Step one. FINAL ANSWER: YES", "answer", 5)
+    assert stats["cached_tokens"] == len(runner.prefix_tokens)
+    assert stats["prompt_tokens"] == len(llm.tokenize(b" Q\nAssistant:", add_bos=False))
+
+
+def test_run_answers_every_queued_question_with_its_budget():
+    llm = FakeLlama()
+    runner = SharedPrefixRunner(llm, "SYSTEM")
+    tasks = Queue()
+    for task in [(0, ["2", "4", "1"], "first"), (1, ["-3"], "second")]:
+        tasks.put(task)
+    results = ListResults()
+    runner.run(tasks, results, budget=lambda distances: 100 + sum(abs(int(d)) for d in distances))
+
+    assert tasks.empty()
+    # The budget sees every distance column, not only the first one
+    assert [r[:4] for r in results.records] == [(0, ["2", "4", "1"], "first", "Step one. FINAL ANSWER: YES"),
+                                                (1, ["-3"], "second", "Step one. FINAL ANSWER: YES")]
+    assert [r[4]["params"]["max_tokens"] for r in results.records] == [107, 103]
+    assert [c[2] for c in llm.calls if c[0] == "complete"] == [107, 103]
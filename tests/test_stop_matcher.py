@@ -0,0 +1,77 @@
+from stop_matcher import MATCH_WINDOW, FinalAnswerMatcher, generate_until_answer
+
+
+def feed_all(matcher, pieces):
+    """Number of pieces fed until the matcher asks to stop (all of them if it never does)."""
+    for n, piece in enumerate(pieces, 1):
+        if matcher.feed(piece):
+            return n
+    return len(pieces)
+
+
+def test_final_answer_split_across_pieces():
+    matcher = FinalAnswerMatcher()
+    n = feed_all(matcher, ["a calls b. Final ", "ans", "wer :", " no", " trailing"])
+    assert n == 4
+    assert (matcher.answer, matcher.stop_reason) == ("NO", "answer")
+    assert matcher.text == "a calls b. Final answer : no"
+
+
+def test_stop_word_is_cut_from_the_response():
+    matcher = FinalAnswerMatcher()
+    assert feed_all(matcher, ["thinking", "\nUs", "er: next question"]) == 3
+    assert (matcher.answer, matcher.stop_reason) == (None, "stop_word")
+    assert matcher.text == "thinking\n"
+
+
+def test_earliest_of_stop_word_and_answer_wins():
+    matcher = FinalAnswerMatcher()
+    matcher.feed("User: FINAL ANSWER: YES")
+    assert (matcher.stop_reason, matcher.text) == ("stop_word", "")
+
+    matcher = FinalAnswerMatcher()
+    matcher.feed("FINAL ANSWER: YES\nUser:")
+    assert (matcher.stop_reason, matcher.answer, matcher.text) == ("answer", "YES", "FINAL ANSWER: YES")
+
+
+def test_answer_found_after_a_long_response():
+    matcher = FinalAnswerMatcher()
+    pieces = ["x" * 7] * (10 * MATCH_WINDOW) + ["FINAL", " ANSWER:", " YES"]
+    assert feed_all(matcher, pieces) == len(pieces)
+    assert matcher.answer == "YES"
+    # Stays stopped once stopped
+    assert matcher.feed("more") and matcher.text.endswith("FINAL ANSWER: YES")
+
+
+class ScriptedLlama:
+    """llama_cpp.Llama completion stand-in, streams the pieces and records whether it was closed."""
+
+    def __init__(self, pieces, finish_reason=None):
+        self.pieces = pieces
+        self.finish_reason = finish_reason
+        self.n_streamed = 0
+        self.closed = False
+
+    def __call__(self, prompt, max_tokens=16, stop=None, stream=False):
+        def chunks():
+            try:
+                for i, piece in enumerate(self.pieces):
+                    self.n_streamed += 1
+                    last = i == len(self.pieces) - 1
+                    yield {"choices": [{"text": piece, "finish_reason": self.finish_reason if last else None}]}
+            finally:
+                self.closed = True
+        return chunks()
+
+
+def test_generation_is_aborted_at_the_answer():
+    llm = ScriptedLlama(["Step. ", "FINAL ANSWER: ", "NO", " extra", " tokens"])
+    stats = {}
+    assert generate_until_answer(llm, "prompt", stats=stats) == ("Step. FINAL ANSWER: NO", "answer", 3)
+    assert llm.n_streamed == 3 and llm.closed
+    assert stats["time_to_first_token"] >= 0
+
+
+def test_stop_reason_without_answer_comes_from_llama_cpp():
+    assert generate_until_answer(ScriptedLlama(["no", " answer"], "stop"), "p") == ("no answer", "stop_word", 2)
+    assert generate_until_answer(ScriptedLlama(["no", " answer"], "length"), "p") == ("no answer", "length", 2)
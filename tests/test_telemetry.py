@@ -0,0 +1,13 @@
+from telemetry import percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(10, 0, -1))
+    assert [percentile(values, q) for q in (10, 50, 90, 95, 99, 100)] == [1, 5, 9, 10, 10, 10]
+    assert percentile(values, 0) == 1 and percentile(values, 11) == 2
+
+
+def test_percentile_of_few_values():
+    assert percentile([], 50) is None
+    assert percentile([3.5], 99) == 3.5
+    assert [percentile([1, 2, 3], q) for q in (33, 34, 66, 67)] == [1, 2, 2, 3]
@@ -0,0 +1,44 @@
+from backends import OfflineBackend
+from work_queue import DONE, PENDING, WorkQueue, run_worker
+
+
+class DroppingBackend(OfflineBackend):
+    """Offline answers, except for the seq_ids in `drop` whose requests fail."""
+
+    def __init__(self, drop):
+        super().__init__(time_scale=0)
+        self.drop = set(drop)
+
+    def complete(self, item, n_predict=256, on_token=None, id_slot=0):
+        if item[0] in self.drop:
+            raise ConnectionError("request failed")
+        return super().complete(item, n_predict, on_token, id_slot)
+
+
+def make_experiment(root):
+    exp = root / "exp"
+    exp.mkdir()
+    (exp / "system.txt").write_text("a calls b\n", encoding="utf-8")
+    (exp / "chains.txt").write_text("a b\na b\na b\n", encoding="utf-8")
+    (exp / "reachability_questions.txt").write_text(
+        "".join(f"1\tDoes `a` call `b`? ({i})\n" for i in range(3)), encoding="utf-8")
+    return exp
+
+
+def states(queue):
+    return dict(queue.conn.execute("SELECT seq_id, state FROM units").fetchall())
+
+
+def test_only_written_answers_are_completed(tmp_path):
+    make_experiment(tmp_path)
+    queue = WorkQueue(tmp_path / "queue.sqlite", max_attempts=2)
+    queue.enqueue([tmp_path], "offline")
+
+    assert run_worker(queue, DroppingBackend({1}), "offline") == 2
+    assert states(queue) == {0: DONE, 1: "failed", 2: DONE}
+
+    queue.reset_failed()
+    assert states(queue)[1] == PENDING
+    assert run_worker(queue, DroppingBackend(set()), "offline") == 1
+    assert set(states(queue).values()) == {DONE}
+    queue.close()
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "token_cache.sqlite"
+
+# ==========================
+#       Tokenizers
+# ==========================
+class LlamaTokenizeCounter:
+    """Count tokens by shelling out to llama-tokenize (one line per token in its output)."""
+
+    def __init__(self, tokenizer_path: str, model_path: str):
+        self.tokenizer_path = tokenizer_path
+        self.model_path = model_path
+
+    def __call__(self, text: str) -> int:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, suffix=".txt") as tmp_file:
+            tmp_file.write(text)
+            tmp_file_path = tmp_file.name
+        try:
+            result = subprocess.run([self.tokenizer_path, "-m", self.model_path, "-f", tmp_file_path],
+                                    capture_output=True, text=True)
+        finally:
+            os.remove(tmp_file_path)
+        if result.returncode != 0:
+            raise RuntimeError(f"llama-tokenize failed:\n{result.stderr}")
+        return sum(1 for line in result.stdout.splitlines() if re.match(r"\s*\d+\s*->", line))
+
+
+class LlamaCppCounter:
+    """In-process tokenizer: only the vocabulary of the model is loaded (no weights, no KV cache)."""
+
+    def __init__(self, model_path: str):
+        from llama_cpp import Llama  # optional, the subprocess counter is the fallback
+        self.llm = Llama(model_path=model_path, vocab_only=True, verbose=False)
+
+    def __call__(self, text: str) -> int:
+        # Same as llama-tokenize: BOS added, special tokens not parsed
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=True, special=False))
+
+
+def make_tokenizer(model_path: str, tokenizer_path: str = None):
+    """In-process llama_cpp tokenizer when available, llama-tokenize otherwise."""
+    try:
+        return LlamaCppCounter(model_path)
+    except Exception as e:  # ImportError, or a llama_cpp too old to read this model
+        if tokenizer_path is None:
+            raise RuntimeError(f"llama_cpp tokenizer unavailable ({e}) and no llama-tokenize given") from e
+        print(f"llama_cpp tokenizer unavailable ({e}), using {tokenizer_path}")
+        return LlamaTokenizeCounter(tokenizer_path, model_path)
+
+# ==========================
+#       Persistent cache
+# ==========================
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """
+    Token counts keyed by (model file hash, content hash), so a given system prompt
+    is tokenized once for a given model, whatever the path or machine it is run from.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or os.getenv("REACHABILITY_TOKEN_CACHE", DEFAULT_CACHE_PATH))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS token_counts ("
+                              " model_hash TEXT, content_hash TEXT, n_tokens INTEGER,"
+                              " PRIMARY KEY (model_hash, content_hash))")
+            # Hashing a model of several GB takes a while, it is only redone when the file changes
+            self.conn.execute("CREATE TABLE IF NOT EXISTS model_hashes ("
+                              " path TEXT, size INTEGER, mtime_ns INTEGER, model_hash TEXT,"
+                              " PRIMARY KEY (path, size, mtime_ns))")
+
+    def model_hash(self, model_path) -> str:
+        path = pathlib.Path(model_path).resolve()
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            row = self.conn.execute("SELECT model_hash FROM model_hashes WHERE path=? AND size=? AND mtime_ns=?",
+                                    key).fetchone()
+        if row is not None:
+            return row[0]
+
+        start = time.time()
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        print(f"Hashed {path.name} in {time.time() - start:.2f}s")
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO model_hashes VALUES (?, ?, ?, ?)", key + (digest,))
+        return digest
+
+    def get(self, model_hash: str, text_hash: str):
+        with self.lock:
+            row = self.conn.execute("SELECT n_tokens FROM token_counts WHERE model_hash=? AND content_hash=?",
+                                    (model_hash, text_hash)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, model_hash: str, text_hash: str, n_tokens: int):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)", (model_hash, text_hash, n_tokens))
+
+    def close(self):
+        self.conn.close()
+
+
+class TokenCounter:
+    """
+    Cached token counting for one model: callable(text) -> number of tokens.
+    The tokenizer itself is only loaded on the first cache miss.
+    """
+
+    def __init__(self, model_path: str, tokenizer_path: str = None, cache: TokenCache = None):
+        self.model_path = model_path
+        self.tokenizer_path = tokenizer_path
+        self.cache = cache or TokenCache()
+        self.model_hash = self.cache.model_hash(model_path)
+        self.tokenizer = None
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __call__(self, text: str) -> int:
+        text_hash = content_hash(text)
+        n_tokens = self.cache.get(self.model_hash, text_hash)
+        if n_tokens is not None:
+            self.n_hits += 1
+            return n_tokens
+        if self.tokenizer is None:
+            self.tokenizer = make_tokenizer(self.model_path, self.tokenizer_path)
+        n_tokens = self.tokenizer(text)
+        self.cache.put(self.model_hash, text_hash, n_tokens)
+        self.n_misses += 1
+        return n_tokens
+
+    def count_file(self, file_path) -> int:
+        """Token count of a text file (utf-8, falling back to cp1252 like the runners)."""
+        for encoding in ["utf-8", "cp1252"]:
+            try:
+                with open(file_path, "r", encoding=encoding) as f:
+                    return self(f.read())
+            except UnicodeDecodeError:
+                continue
+        raise ValueError(f"Could not decode {file_path} with utf-8 or cp1252.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the token count of system.txt for every experiment directory")
+    parser.add_argument("roots", nargs="+", help="experiment directories (searched recursively)")
+    parser.add_argument("--model", required=True, help="model.gguf whose tokenizer is used")
+    parser.add_argument("--tokenizer", default=None, help="llama-tokenize executable, used if llama_cpp is missing")
+    args = parser.parse_args()
+
+    counter = TokenCounter(args.model, args.tokenizer)
+    for root in args.roots:
+        for system_file in sorted(pathlib.Path(root).rglob("system.txt")):
+            print(f"{counter.count_file(system_file)}\t{system_file.parent}")
+    print(f"{counter.n_hits} cached, {counter.n_misses} tokenized", file=sys.stderr)
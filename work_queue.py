@@ -0,0 +1,393 @@
+import argparse
+import os
+import pathlib
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from completion_index import parse_results_seq_ids
+from experiment_files import find_experiment_dirs, parse_questions, read_text
+from experiment_scheduler import parse_model
+
+DEFAULT_QUEUE_PATH = "work_queue.sqlite"
+
+# ==========================
+#   Leased work queue
+# ==========================
+# A coordinator lists every (experiment directory, question) of a tree once; workers
+# (local processes or SLURM array tasks sharing the file system) then lease a few
+# questions of one directory at a time, answer them and mark them done. A lease that is
+# not renewed expires and its questions go back to the other workers, so the work of a
+# job killed at its time limit is picked up by whoever is still running.
+#
+# The queue is a SQLite file on the shared storage. It stays in rollback journal mode:
+# WAL needs shared memory between the processes, which nodes of a cluster do not have.
+# The completion index and answer store given to the workers (--index, --answer-store)
+# are opened the same way; no runner outside the workers may use them in WAL mode meanwhile.
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class WorkQueue:
+    """
+    Units of work are (exp_dir, model, seq_id). A lease takes up to n units of a single
+    directory, preferring the one the worker leased last (system prompt already in its
+    cache); a unit leased more than max_attempts times is marked failed.
+    """
+
+    def __init__(self, path=None, max_attempts: int = 3):
+        self.path = str(path or os.getenv("REACHABILITY_QUEUE", DEFAULT_QUEUE_PATH))
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # isolation_level=None: transactions are opened explicitly (BEGIN IMMEDIATE)
+        self.conn = sqlite3.connect(self.path, timeout=120, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                " exp_dir TEXT, model TEXT, seq_id INTEGER, state TEXT, owner TEXT, lease_expires REAL,"
+                " attempts INTEGER DEFAULT 0, updated_at REAL,"
+                " PRIMARY KEY (exp_dir, model, seq_id))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS units_state ON units (model, state, exp_dir)")
+
+    def _transaction(self, statements):
+        """Run callable(conn) in a write transaction, taken before reading so two leases never overlap."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # ==========================
+    #       Coordinator
+    # ==========================
+    def enqueue(self, roots, model: str) -> tuple:
+        """
+        Add the questions of every experiment directory under roots, for one model.
+        Questions already in the directory's results.txt are added as done.
+
+        Returns:
+            tuple: (number of new units, number of them already done)
+        """
+        now = time.time()
+        rows = []
+        for root in roots:
+            for d in find_experiment_dirs(root):
+                exp_dir = str(pathlib.Path(d).resolve())
+                answered = parse_results_seq_ids(pathlib.Path(d) / model / "results.txt")
+                for seq_id, _, _ in parse_questions(read_text(pathlib.Path(d) / "reachability_questions.txt")):
+                    rows.append((exp_dir, model, seq_id, DONE if seq_id in answered else PENDING, now))
+
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO units (exp_dir, model, seq_id, state, updated_at) "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+        n_new = self._transaction(insert)
+        return n_new, sum(1 for r in rows if r[3] == DONE)
+
+    def status(self) -> list:
+        """(model, state, number of units) rows, expired leases counted as pending."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT model, CASE WHEN state=? AND lease_expires < ? THEN ? ELSE state END AS s, COUNT(*) "
+                "FROM units GROUP BY model, s ORDER BY model, s", (LEASED, time.time(), PENDING)).fetchall()
+
+    def reset_failed(self, model: str = None) -> int:
+        """Put the failed units back in the queue (e.g. after fixing a crashing backend)."""
+        def reset(conn):
+            query = "UPDATE units SET state=?, attempts=0, owner=NULL WHERE state=?"
+            args = (PENDING, FAILED)
+            if model:
+                query, args = query + " AND model=?", args + (model,)
+            return conn.execute(query, args).rowcount
+        return self._transaction(reset)
+
+    # ==========================
+    #         Workers
+    # ==========================
+    def lease(self, worker: str, model: str, n: int = 16, lease_seconds: float = 600, prefer_dir: str = None):
+        """
+        Lease up to n available units of one directory (pending, or leased with an expired lease).
+
+        Returns:
+            tuple: (exp_dir, [seq_id, ...]), or (None, []) when nothing is left to lease.
+        """
+        available = "model=? AND (state=? OR (state=? AND lease_expires < ?))"
+
+        def take(conn):
+            now = time.time()
+            args = (model, PENDING, LEASED, now)
+            # Units whose leases kept expiring (crashing worker, question too long for the time limit)
+            conn.execute(f"UPDATE units SET state=?, updated_at=? WHERE {available} AND attempts >= ?",
+                         (FAILED, now) + args + (self.max_attempts,))
+            row = None
+            if prefer_dir is not None:
+                row = conn.execute(f"SELECT exp_dir FROM units WHERE {available} AND exp_dir=? LIMIT 1",
+                                   args + (prefer_dir,)).fetchone()
+            if row is None:
+                row = conn.execute(f"SELECT exp_dir FROM units WHERE {available} ORDER BY exp_dir LIMIT 1", args).fetchone()
+            if row is None:
+                return None, []
+            exp_dir = row[0]
+            seq_ids = [r[0] for r in conn.execute(
+                f"SELECT seq_id FROM units WHERE {available} AND exp_dir=? ORDER BY seq_id LIMIT ?", args + (exp_dir, n))]
+            conn.executemany("UPDATE units SET state=?, owner=?, lease_expires=?, attempts=attempts+1, updated_at=? "
+                             "WHERE exp_dir=? AND model=? AND seq_id=?",
+                             [(LEASED, worker, now + lease_seconds, now, exp_dir, model, s) for s in seq_ids])
+            return exp_dir, seq_ids
+        return self._transaction(take)
+
+    def renew(self, worker: str, model: str, exp_dir: str, seq_ids, lease_seconds: float = 600) -> int:
+        """Extend the leases still held by worker, returns how many were (the others were re-issued)."""
+        def extend(conn):
+            now = time.time()
+            return sum(conn.execute("UPDATE units SET lease_expires=?, updated_at=? WHERE exp_dir=? AND model=? "
+                                    "AND seq_id=? AND state=? AND owner=?",
+                                    (now + lease_seconds, now, exp_dir, model, s, LEASED, worker)).rowcount
+                       for s in seq_ids)
+        return self._transaction(extend)
+
+    def complete(self, worker: str, model: str, exp_dir: str, seq_ids):
+        """Mark units done, even if their lease was re-issued meanwhile: the answer is written anyway."""
+        def done(conn):
+            now = time.time()
+            conn.executemany("UPDATE units SET state=?, owner=?, updated_at=? WHERE exp_dir=? AND model=? AND seq_id=?",
+                             [(DONE, worker, now, exp_dir, model, s) for s in seq_ids])
+        self._transaction(done)
+
+    def release(self, worker: str, model: str, exp_dir: str, seq_ids):
+        """Give unfinished units back (worker stopping before its lease ends)."""
+        def back(conn):
+            conn.executemany("UPDATE units SET state=?, owner=NULL, lease_expires=NULL WHERE exp_dir=? AND model=? "
+                             "AND seq_id=? AND state=? AND owner=?",
+                             [(PENDING, exp_dir, model, s, LEASED, worker) for s in seq_ids])
+        self._transaction(back)
+
+    def close(self):
+        self.conn.close()
+
+
+class LeaseKeeper(threading.Thread):
+    """Renews the current lease of a worker every lease_seconds / 3 while it is being processed."""
+
+    def __init__(self, queue: WorkQueue, worker: str, model: str, lease_seconds: float):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.model = model
+        self.lease_seconds = lease_seconds
+        self.current = None  # (exp_dir, seq_ids)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            current = self.current
+            if current is not None:
+                self.queue.renew(self.worker, self.model, current[0], current[1], self.lease_seconds)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def default_worker_id() -> str:
+    """host:pid, plus the SLURM job/array ids when run as a SLURM job."""
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    if os.getenv("SLURM_JOB_ID"):
+        worker += f":slurm-{os.getenv('SLURM_JOB_ID')}-{os.getenv('SLURM_ARRAY_TASK_ID', '0')}"
+    return worker
+
+
+def run_worker(queue: WorkQueue, backend, model_name: str, n_predict=256, lease_size: int = 16,
+               lease_seconds: float = 600, worker: str = None, index=None, store=None, deadline: float = None) -> int:
+    """
+    Lease, answer and complete units until the queue is empty (or until `deadline`, a
+    time.time() after which no new lease is taken). Only the units whose answers were
+    written are completed, the others are released for another attempt. Returns the
+    number of units done.
+    """
+    from backends import run_directory  # backends imports the runners, only needed by workers
+
+    worker = worker or default_worker_id()
+    keeper = LeaseKeeper(queue, worker, model_name, lease_seconds)
+    keeper.start()
+    n_done = 0
+    exp_dir = None
+    try:
+        while deadline is None or time.time() < deadline:
+            exp_dir, seq_ids = queue.lease(worker, model_name, lease_size, lease_seconds, prefer_dir=exp_dir)
+            if not seq_ids:
+                break
+            keeper.current = (exp_dir, seq_ids)
+            start = time.time()
+            answered = set()
+            try:
+                run_directory(backend, pathlib.Path(exp_dir), model_name, n_predict, index, store,
+                              seq_ids=seq_ids, lock_writes=True, answered=answered)
+            except BaseException:
+                keeper.current = None
+                queue.complete(worker, model_name, exp_dir, [s for s in seq_ids if s in answered])
+                queue.release(worker, model_name, exp_dir, [s for s in seq_ids if s not in answered])
+                raise
+            keeper.current = None
+            done = [s for s in seq_ids if s in answered]
+            failed = [s for s in seq_ids if s not in answered]
+            queue.complete(worker, model_name, exp_dir, done)
+            # Dropped or failed questions are leased again, until max_attempts
+            queue.release(worker, model_name, exp_dir, failed)
+            n_done += len(done)
+            print(f"[{worker}] {'⚠️' if failed else '✅'} {len(done)} questions of {exp_dir} in {time.time() - start:.2f}s"
+                  + (f", {len(failed)} released" if failed else ""))
+    finally:
+        keeper.stop()
+        backend.close()
+    return n_done
+
+# ==========================
+#   Local and SLURM workers
+# ==========================
+def spawn_local_workers(n_workers: int, queue_path: str, worker_args: list) -> int:
+    """Start n_workers `work_queue.py work` processes and wait for them, returns the number that failed."""
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--queue", queue_path, "work", *worker_args,
+                               "--worker-id", f"{socket.gethostname()}:local-{i}"])
+             for i in range(n_workers)]
+    return sum(1 for p in procs if p.wait() != 0)
+
+
+def write_slurm_script(name: str, n_workers: int, time_limit: str, queue_path: str, worker_args: list,
+                       account: str = "spk@h100") -> str:
+    """SLURM array job of n_workers tasks, one H100 each, all draining the same queue."""
+    contents = f"""#! /usr/bin/bash
+#SBATCH --job-name=reachability-{name}
+#SBATCH --array=0-{n_workers - 1}
+#SBATCH --nodes=1
+#SBATCH --gres=gpu:h100:1
+#SBATCH --constraint=h100
+#SBATCH --ntasks-per-node=1
+#SBATCH --account={account}
+#SBATCH --time={time_limit}
+#SBATCH --output=logs/%x_%A_%a.out
+#SBATCH --error=logs/%x_%A_%a.out
+
+module load arch/h100
+module load cuda/12.8.0
+cd $WORK
+python work_queue.py --queue {queue_path} work {" ".join(worker_args)}
+"""
+    path = f"reachability-{name}-workers.slurm"
+    with open(path, "w") as f:
+        f.write(contents)
+    return path
+
+
+def parse_time_limit(time_limit: str) -> float:
+    """SLURM [days-]hh:mm:ss time limit in seconds."""
+    days, _, clock = time_limit.rpartition("-")
+    parts = [int(p) for p in clock.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return int(days or 0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share the questions of an experiment tree between workers through a leased queue")
+    parser.add_argument("--queue", default=None, help="queue file on shared storage (default: $REACHABILITY_QUEUE or work_queue.sqlite)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_cmd = commands.add_parser("enqueue", help="add the questions of every experiment directory under the roots")
+    enqueue_cmd.add_argument("roots", nargs="+")
+    enqueue_cmd.add_argument("--model-name", required=True, help="output directory name of the model")
+
+    status_cmd = commands.add_parser("status", help="units per model and state")
+    status_cmd.add_argument("--reset-failed", action="store_true", help="put the failed units back in the queue")
+
+    worker_parser = argparse.ArgumentParser(add_help=False)
+    worker_parser.add_argument("--backend", default="offline", choices=["offline", "llama_cpp", "llama_server", "cpp", "llama_cli"])
+    worker_parser.add_argument("--model", default=None, help="model.gguf[:output-name] (output name 'offline' for the offline backend)")
+    worker_parser.add_argument("--parallel", type=int, default=2, help="requests in flight (llama_server) or simulated slots (offline)")
+    worker_parser.add_argument("--n-predict", type=int, default=256)
+    worker_parser.add_argument("--budget", default=None, help="per-question n_predict model fitted by predict_budget.py")
+    worker_parser.add_argument("--url", default="http://localhost:8080", help="llama-server url")
+    worker_parser.add_argument("--time-scale", type=float, default=1.0, help="offline: 0 to skip the simulated delays")
+    worker_parser.add_argument("--accuracy", type=float, default=1.0, help="offline: share of correct answers")
+    worker_parser.add_argument("--seed", type=int, default=0)
+    worker_parser.add_argument("--lease-size", type=int, default=16, help="questions per lease")
+    worker_parser.add_argument("--lease-seconds", type=float, default=600, help="lease duration, renewed while working")
+    worker_parser.add_argument("--index", default=None,
+                               help="also mark answers in this completion index (opened in rollback journal mode, not WAL)")
+    worker_parser.add_argument("--answer-store", default=None,
+                               help="answer store (default: $REACHABILITY_ANSWER_STORE, unset: off), opened in rollback journal mode")
+
+    work_cmd = commands.add_parser("work", parents=[worker_parser], help="run one worker until the queue is empty")
+    work_cmd.add_argument("--worker-id", default=None, help="default: host:pid[:slurm-job-task]")
+    work_cmd.add_argument("--stop-after", default=None, help="take no new lease after this [days-]hh:mm:ss (SLURM time limit margin)")
+    local_cmd = commands.add_parser("local", parents=[worker_parser], help="run N local worker processes")
+    local_cmd.add_argument("--workers", type=int, default=2)
+    slurm_cmd = commands.add_parser("slurm", parents=[worker_parser], help="write a SLURM array job of N workers")
+    slurm_cmd.add_argument("--workers", type=int, default=4)
+    slurm_cmd.add_argument("--name", default="queue")
+    slurm_cmd.add_argument("--time", default="20:00:00")
+    slurm_cmd.add_argument("--account", default="spk@h100")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.command == "enqueue":
+        n_new, n_done = queue.enqueue(args.roots, args.model_name)
+        print(f"✅ {n_new} units added for {args.model_name} ({n_done} already answered)")
+    elif args.command == "status":
+        if args.reset_failed:
+            print(f"{queue.reset_failed()} failed units back in the queue")
+        for model, state, count in queue.status():
+            print(f"{model}\t{state}\t{count}")
+    elif args.command in ("local", "slurm"):
+        # The workers get the same options, and the queue path resolved for another working directory
+        queue_path = os.path.abspath(queue.path)
+        forwarded = sys.argv[sys.argv.index(args.command) + 1:]
+        drop = {"--workers", "--name", "--time", "--account"}
+        worker_args = []
+        skip = False
+        for a in forwarded:
+            if skip:
+                skip = False
+            elif a.split("=")[0] in drop:
+                skip = "=" not in a
+            else:
+                worker_args.append(a)
+        if args.command == "local":
+            failed = spawn_local_workers(args.workers, queue_path, worker_args)
+            print(f"{'❌' if failed else '✅'} {args.workers} local workers done, {failed} failed")
+        else:
+            # Stop leasing 15 minutes before the time limit, the running lease has time to finish
+            worker_args += ["--stop-after", str(max(0, parse_time_limit(args.time) - 900))]
+            print(f"✅ {write_slurm_script(args.name, args.workers, args.time, queue_path, worker_args, args.account)} written")
+    else:
+        from answer_store import load_store
+        from backends import LlamaServerBackend, OfflineBackend, make_backend
+        from completion_index import CompletionIndex
+        from predict_budget import load_budget
+
+        model_path, model_name = parse_model(args.model) if args.model else (None, "offline")
+        if args.backend == "offline":
+            backend = OfflineBackend(n_parallel=args.parallel, time_scale=args.time_scale, accuracy=args.accuracy, seed=args.seed)
+        elif args.backend == "llama_server":
+            backend = LlamaServerBackend(args.url, args.parallel)
+        else:
+            backend = make_backend(args.backend, model_path)
+        deadline = None
+        if args.stop_after:
+            deadline = time.time() + (float(args.stop_after) if args.stop_after.replace(".", "").isdigit()
+                                      else parse_time_limit(args.stop_after))
+        n_done = run_worker(queue, backend, model_name, load_budget(args.budget) or args.n_predict, args.lease_size,
+                            args.lease_seconds, args.worker_id,
+                            CompletionIndex(args.index, journal_mode="DELETE") if args.index else None,
+                            load_store(args.answer_store, journal_mode="DELETE"), deadline)
+        print(f"✅ Worker done, {n_done} questions answered")
+    queue.close()